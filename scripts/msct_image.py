@@ -194,11 +194,113 @@ def decompose_affine_transform(A44):
     return T, Rmat, np.array([sx, sy, sz]), np.array([sxy, sxz, syz])
 
 
+class ImageCache(object):
+    """
+    In-memory cache of images read from or written to disk, keyed by absolute path. It is used when SCT tools are
+    chained within the same python process (see sct_utils.run_in_process): an image written by one step and read by the
+    next one is then taken from memory instead of being decompressed and parsed again.
+    Each entry is validated against the modification time and size of the file, so that files modified by another
+    program (e.g., ANTs binaries) are read again from disk. Data are copied when stored and when retrieved, so that
+    modifying an Image in place does not modify the cache.
+    """
+    def __init__(self, max_bytes=1024 ** 3):
+        from collections import OrderedDict
+        self.enabled = False
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, path):
+        """
+        :param path: file name
+        :return: (data, hdr) copies, or None if the image is not in the cache or if the file changed
+        """
+        from os.path import abspath
+        if not self.enabled:
+            return None
+        key = abspath(path)
+        if key not in self.entries:
+            return None
+        stat, data, hdr = self.entries.pop(key)
+        if stat != self.file_stat(key):
+            self.nbytes -= data.nbytes
+            return None
+        # most recently used at the end
+        self.entries[key] = (stat, data, hdr)
+        return data.copy(), hdr.copy()
+
+    def put(self, path, data, hdr):
+        from os.path import abspath
+        if not self.enabled:
+            return
+        key = abspath(path)
+        self.remove(key)
+        # do not let one single image flush the whole cache
+        if data.nbytes > self.max_bytes / 4:
+            return
+        stat = self.file_stat(key)
+        if stat is None:
+            return
+        self.entries[key] = (stat, np.array(data), hdr.copy())
+        self.nbytes += data.nbytes
+        # remove least recently used images
+        while self.nbytes > self.max_bytes:
+            key_lru, (stat_lru, data_lru, hdr_lru) = self.entries.popitem(last=False)
+            self.nbytes -= data_lru.nbytes
+
+    def remove(self, path):
+        from os.path import abspath
+        key = abspath(path)
+        if key in self.entries:
+            stat, data, hdr = self.entries.pop(key)
+            self.nbytes -= data.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def prune(self):
+        """
+        Remove the images whose file changed or no longer exists (e.g., temporary folders removed by the pipeline).
+        """
+        for key in [key for key, (stat, data, hdr) in self.entries.items() if stat != self.file_stat(key)]:
+            self.remove(key)
+
+    @staticmethod
+    def file_stat(path):
+        from os import stat
+        try:
+            st = stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+
+image_cache = ImageCache()
+
+
+def copy_data(data, memo=None):
+    """
+    Copy the data of an image. Read-only arrays (e.g., images loaded with mmap=True) cannot be modified in place, so
+    they are shared between the copies instead of being duplicated (copy-on-write: to modify the data of a copy, assign
+    a new array to Image.data, e.g. im.data = np.array(im.data)).
+    """
+    from copy import deepcopy
+    if isinstance(data, np.ndarray) and not data.flags.writeable:
+        return data
+    return deepcopy(data, memo)
+
+
 class Image(object):
     """
 
     """
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1, mmap=False):
+        """
+        :param mmap: if True and param is a file name, the data of uncompressed nifti files are memory-mapped read-only
+        instead of being loaded in memory: voxels are read from disk when they are accessed. The data cannot be modified
+        in place (see copy_data).
+        """
         from sct_utils import extract_fname
         from nibabel import Nifti1Header
 
@@ -221,7 +323,7 @@ class Image(object):
 
         # load an image from file
         if type(param) is str:
-            self.loadFromPath(param, verbose)
+            self.loadFromPath(param, verbose, mmap=mmap)
             self.compute_transform_matrix()
         # copy constructor
         elif isinstance(param, type(self)):
@@ -247,14 +349,14 @@ class Image(object):
 
     def __deepcopy__(self, memo):
         from copy import deepcopy
-        return type(self)(deepcopy(self.data, memo), deepcopy(self.hdr, memo), deepcopy(self.orientation, memo), deepcopy(self.absolutepath, memo), deepcopy(self.dim, memo))
+        return type(self)(copy_data(self.data, memo), deepcopy(self.hdr, memo), deepcopy(self.orientation, memo), deepcopy(self.absolutepath, memo), deepcopy(self.dim, memo))
 
     def copy(self, image=None):
         from copy import deepcopy
         from sct_utils import extract_fname
         if image is not None:
             self.im_file = deepcopy(image.im_file)
-            self.data = deepcopy(image.data)
+            self.data = copy_data(image.data)
             self.dim = deepcopy(image.dim)
             self.hdr = deepcopy(image.hdr)
             self.orientation = deepcopy(image.orientation)
@@ -263,23 +365,35 @@ class Image(object):
         else:
             return deepcopy(self)
 
-    def loadFromPath(self, path, verbose):
+    def loadFromPath(self, path, verbose, mmap=False):
         """
         This function load an image from an absolute path using nibabel library
         :param path: path of the file from which the image will be loaded
+        :param mmap: memory-map the data read-only. Compressed or scaled images are loaded in memory.
         :return:
         """
-        from nibabel import load, spatialimages
+        from nibabel import load, spatialimages, Nifti1Image
         from sct_utils import check_file_exist, printv, extract_fname, run
         from sct_image import get_orientation
 
         # check_file_exist(path, verbose=verbose)
-        try:
-            self.im_file = load(path)
-        except spatialimages.ImageFileError:
-            printv('Error: make sure ' + path + ' is an image.', 1, 'error')
+        # memory-mapped images are not cached, as caching would load them in memory
+        cached = None if mmap else image_cache.get(path)
+        if cached is not None:
+            data, hdr = cached
+            self.im_file = Nifti1Image(data, hdr.get_best_affine(), hdr)
+        else:
+            try:
+                if mmap:
+                    self.im_file = load(path, mmap='r')
+                else:
+                    self.im_file = load(path)
+            except spatialimages.ImageFileError:
+                printv('Error: make sure ' + path + ' is an image.', 1, 'error')
         self.data = self.im_file.get_data()
         self.hdr = self.im_file.get_header()
+        if cached is None and not mmap:
+            image_cache.put(path, self.data, self.hdr)
         self.orientation = get_orientation(self)
         self.absolutepath = path
         self.path, self.file_name, self.ext = extract_fname(path)
@@ -412,6 +526,11 @@ class Image(object):
             remove(fname_out)
         # save file
         save(img, fname_out)
+        # keep the image in memory only if the data written on disk are exactly the data in memory
+        if self.data.dtype == img.get_data_dtype():
+            image_cache.put(fname_out, self.data, img.header)
+        else:
+            image_cache.remove(fname_out)
 
     # flatten the array in a single dimension vector, its shape will be (d, 1) compared to the flatten built in method
     # which would have returned (d,)
@@ -908,12 +1027,12 @@ class Image(object):
         coord_im = np.array(self.transfo_phys2continuouspix(physical_coordinates_ref))
         interpolated_values = self.get_values(np.array([coord_im[:, 0], coord_im[:, 1], coord_im[:, 2]]), interpolation_mode=interpolation_mode, border=border)
 
-        im_output = Image(im_ref)
+        # do not copy the data of the reference image, as they are replaced by the interpolated values
+        im_output = Image(np.reshape(interpolated_values, (nx, ny, nz)), hdr=im_ref.hdr.copy(), orientation=im_ref.orientation, absolutepath=im_ref.absolutepath, dim=im_ref.dim)
         if interpolation_mode == 0:
-            im_output.changeType('int32')
+            im_output.hdr.set_data_dtype('int32')
         else:
-            im_output.changeType('float32')
-        im_output.data = np.reshape(interpolated_values, (nx, ny, nz))
+            im_output.hdr.set_data_dtype('float32')
         if fname_output is not None:
             im_output.setFileName(fname_output)
             im_output.save()
@@ -927,7 +1046,8 @@ class Image(object):
         :param seg: segmentation to add in transparency to the image to save. Type Image.
         :return slice, slice_seg: ndarrays of the selected slices
         """
-        copy_rpi = Image(self)
+        # the data are only read here, so the copy shares them with self (change_orientation only creates views)
+        copy_rpi = Image(self.data, hdr=self.hdr, orientation=self.orientation, absolutepath=self.absolutepath, dim=self.dim)
         copy_rpi.change_orientation('RPI')
         if seg is not None:
             seg.change_orientation('RPI')
@@ -81,30 +81,47 @@ def moco(param):
 
     # Motion correction: initialization
     index = np.arange(nt)
-    file_data_splitT_num = []
-    file_data_splitT_moco_num = []
+    file_data_splitT_num = [file_data_splitT + str(it).zfill(4) for it in index]
+    file_data_splitT_moco_num = [file_data + suffix + '_T' + str(it).zfill(4) for it in index]
     failed_transfo = [0 for i in range(nt)]
-    file_mat = [[] for i in range(nt)]
+    file_mat = [folder_mat + 'mat.T' + str(it) for it in index]
 
     # Motion correction: Loop across T
-    for indice_index in range(nt):
-
-        # create indices and display stuff
+    # With iterative averaging, the target is updated after each of the first volumes, hence these volumes are
+    # registered one after the other. The remaining volumes are all registered to the same target, in parallel.
+    if param.iterative_averaging:
+        nb_sequential = min(param.nb_iterative_averaging, nt)
+    else:
+        nb_sequential = 0
+    for indice_index in range(nb_sequential):
         it = index[indice_index]
-        file_data_splitT_num.append(file_data_splitT + str(it).zfill(4))
-        file_data_splitT_moco_num.append(file_data + suffix + '_T' + str(it).zfill(4))
         sct.printv(('\nVolume '+str((it))+'/'+str(nt-1)+':'), verbose)
-        file_mat[it] = folder_mat + 'mat.T' + str(it)
 
         # run 3D registration
         failed_transfo[it] = register(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it])
 
         # average registered volume with target image
         # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
-        if param.iterative_averaging and indice_index < 10 and failed_transfo[it] == 0:
-            sct.run('sct_maths -i '+file_target+ext+' -mul '+str(indice_index+1)+' -o '+file_target+ext)
-            sct.run('sct_maths -i '+file_target+ext+' -add '+file_data_splitT_moco_num[it]+ext+' -o '+file_target+ext)
-            sct.run('sct_maths -i '+file_target+ext+' -div '+str(indice_index+2)+' -o '+file_target+ext)
+        if failed_transfo[it] == 0:
+            average_target(file_target+ext, file_data_splitT_moco_num[it]+ext, indice_index+1)
+
+    index_parallel = index[nb_sequential:]
+    if param.cpu_number > 1 and len(index_parallel) > 1:
+        # registrations are run by external programs, hence threads are enough to run them in parallel
+        from multiprocessing.pool import ThreadPool
+        sct.printv('\nVolumes '+str(index_parallel[0])+' to '+str(nt-1)+': registration using '+str(param.cpu_number)+' parallel processes...', verbose)
+        pool = ThreadPool(processes=param.cpu_number)
+        try:
+            list_failed_transfo = pool.map(register_star, [(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it]) for it in index_parallel])
+        finally:
+            pool.close()
+            pool.join()
+        for it, failed in zip(index_parallel, list_failed_transfo):
+            failed_transfo[it] = failed
+    else:
+        for it in index_parallel:
+            sct.printv(('\nVolume '+str((it))+'/'+str(nt-1)+':'), verbose)
+            failed_transfo[it] = register(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it])
 
     # Replace failed transformation with the closest good one
     sct.printv(('\nReplace failed transformations...'), verbose)
@@ -144,6 +161,19 @@ def moco(param):
     sct.run('rm target.nii')
 
 
+#=======================================================================================================================
+# average_target:  weighted average of the target with a registered volume
+#=======================================================================================================================
+def average_target(fname_target, fname_moco, nb_averaged):
+    """
+    Replace the target by (target * nb_averaged + moco) / (nb_averaged + 1)
+    :param nb_averaged: number of volumes already averaged in the target
+    """
+    im_target = Image(fname_target)
+    im_target.data = (im_target.data * nb_averaged + Image(fname_moco).data) / float(nb_averaged + 1)
+    im_target.save()
+
+
 #=======================================================================================================================
 # register:  registration of two volumes (or two images)
 #=======================================================================================================================
@@ -173,7 +203,9 @@ def register(param, file_src, file_dest, file_mat, file_out):
             cmd += ' -x '+param.fname_mask
     if param.todo == 'apply':
         cmd = 'sct_apply_transfo -i '+file_src+'.nii -d '+file_dest+'.nii -w '+file_mat+'Warp.nii.gz'+' -o '+file_out+'.nii'+' -x '+param.interp
-    status, output = sct.run(cmd, param.verbose)
+    # N.B. do not exit on error (this function also runs in threads, where sys.exit would block the pool): a failed
+    # registration is detected below by its missing output file
+    sct.run(cmd, param.verbose, error_exit='warning')
 
     # check if output file exists
     if not os.path.isfile(file_out+'.nii'):
@@ -185,6 +217,10 @@ def register(param, file_src, file_dest, file_mat, file_out):
     return failed_transfo
 
 
+def register_star(args):
+    return register(*args)
+
+
 # #=======================================================================================================================
 # # check_transformation_absurdity:  find outliers
 # #=======================================================================================================================
@@ -204,43 +240,83 @@ def register(param, file_src, file_dest, file_mat, file_out):
 #     return failed_transfo
 
 
+#=======================================================================================================================
+# Transformation matrices store
+#=======================================================================================================================
+# The slice-wise transformation matrices of a folder are stored in a single (nt, nz, 4, 4) array file. The per-file
+# layout (one text file mat.T<t>_Z<z>.txt per volume and slice) can be exported from it, for compatibility with the
+# other tools. When both exist, the array file is used only if it is at least as recent as all per-file matrices, which
+# can be rewritten or copied by other tools.
+file_mat_store = 'mat.npy'
+
+
+def get_file_mat(folder_mat, it, iz):
+    return folder_mat + 'mat.T' + str(it) + '_Z' + str(iz) + '.txt'
+
+
+def is_store_up_to_date(folder_mat):
+    """
+    :return: True if the array file of a folder exists and is at least as recent as all its per-file matrices
+    """
+    import glob
+    fname_store = folder_mat + file_mat_store
+    if not os.path.isfile(fname_store):
+        return False
+    mtime_store = os.path.getmtime(fname_store)
+    return all(os.path.getmtime(fname) <= mtime_store for fname in glob.glob(folder_mat + 'mat.T*_Z*.txt'))
+
+
+def load_matrices(folder_mat, nt, nz):
+    """
+    Load the transformation matrices of a folder
+    :return: (nt, nz, 4, 4) array
+    """
+    if is_store_up_to_date(folder_mat):
+        matrices = np.load(folder_mat + file_mat_store)
+        if matrices.shape == (nt, nz, 4, 4):
+            return matrices
+    matrices = np.zeros((nt, nz, 4, 4))
+    for it in range(nt):
+        for iz in range(nz):
+            matrices[it, iz] = np.loadtxt(get_file_mat(folder_mat, it, iz))
+    return matrices
+
+
+def save_matrices(folder_mat, matrices):
+    """
+    Save the transformation matrices of a folder, in the per-file layout and in the store
+    :param matrices: (nt, nz, 4, 4) array
+    """
+    nt, nz = matrices.shape[:2]
+    for it in range(nt):
+        for iz in range(nz):
+            np.savetxt(get_file_mat(folder_mat, it, iz), matrices[it, iz], fmt="%s", delimiter='  ', newline='\n')
+    # written after the per-file layout, so that it is up to date (see is_store_up_to_date)
+    np.save(folder_mat + file_mat_store, matrices)
+
+
 #=======================================================================================================================
 # spline
 #=======================================================================================================================
 def spline(folder_mat,nt,nz,verbose,index_b0 = [],graph=0):
-    # get path of the toolbox
-    status, path_sct = commands.getstatusoutput('echo $SCT_DIR')
-    # append path that contains scripts, to be able to load modules
-    sys.path.append(path_sct + '/scripts')
-    import sct_utils as sct
+    from scipy.interpolate import UnivariateSpline
 
     sct.printv('\n\n\n------------------------------------------------------------------------------',verbose)
     sct.printv('Spline Regularization along T: Smoothing Patient Motion...',verbose)
 
-    file_mat = [[[] for i in range(nz)] for i in range(nt)]
-    for it in range(nt):
-        for iz in range(nz):
-            file_mat[it][iz] = folder_mat + 'mat.T' + str(it) + '_Z' + str(iz) + '.txt'
+    sct.printv('\nloading matrices...',verbose)
+    matrices = load_matrices(folder_mat, nt, nz)
 
     #Copying the existing Matrices to another folder
     old_mat = folder_mat + 'old/'
     if not os.path.exists(old_mat): os.makedirs(old_mat)
-    cmd = 'cp ' + folder_mat + '*.txt ' + old_mat
-    status, output = sct.run(cmd, verbose)
-
-    sct.printv('\nloading matrices...',verbose)
-    X = [[[] for i in range(nt)] for i in range(nz)]
-    Y = [[[] for i in range(nt)] for i in range(nz)]
-    X_smooth = [[[] for i in range(nt)] for i in range(nz)]
-    Y_smooth = [[[] for i in range(nt)] for i in range(nz)]
-    for iz in range(nz):
-        for it in range(nt):
-            file =  open(file_mat[it][iz])
-            Matrix = np.loadtxt(file)
-            file.close()
+    save_matrices(old_mat, matrices)
 
-            X[iz][it] = Matrix[0,3]
-            Y[iz][it] = Matrix[1,3]
+    # translations along X and Y: [nz x nt]
+    X = matrices[:, :, 0, 3].T
+    Y = matrices[:, :, 1, 3].T
+    X_smooth = np.zeros((nz, nt))
+    Y_smooth = np.zeros((nz, nt))
 
     # Generate motion splines
     sct.printv('\nGenerate motion splines...',verbose)
@@ -250,45 +326,27 @@ def spline(folder_mat,nt,nz,verbose,index_b0 = [],graph=0):
 
     for iz in range(nz):
 
-#        frequency = scipy.fftpack.fftfreq(len(X[iz][:]), d=1)
-#        spectrum = np.abs(scipy.fftpack.fft(X[iz][:], n=None, axis=-1, overwrite_x=False))
-#        Wn = np.amax(frequency)/10
-#        N = 5              #Order of the filter
-#        b, a = scipy.signal.iirfilter(N, Wn, rp=None, rs=None, btype='low', analog=False, ftype='butter', output='ba')
-#        X_smooth[iz][:] = scipy.signal.filtfilt(b, a, X[iz][:], axis=-1, padtype=None)
-
-        spline = scipy.interpolate.UnivariateSpline(T, X[iz][:], w=None, bbox=[None, None], k=3, s=None)
-        X_smooth[iz][:] = spline(T)
+        spline = UnivariateSpline(T, X[iz], w=None, bbox=[None, None], k=3, s=None)
+        X_smooth[iz] = spline(T)
 
         if graph:
-            pl.plot(T,X_smooth[iz][:],label='spline_smoothing')
-            pl.plot(T,X[iz][:],marker='*',linestyle='None',label='original_val')
+            pl.plot(T,X_smooth[iz],label='spline_smoothing')
+            pl.plot(T,X[iz],marker='*',linestyle='None',label='original_val')
             if len(index_b0)!=0:
-                T_b0 = [T[i_b0] for i_b0 in index_b0]
-                X_b0 = [X[iz][i_b0] for i_b0 in index_b0]
-                pl.plot(T_b0,X_b0,marker='D',linestyle='None',color='k',label='b=0')
+                pl.plot(T[index_b0],X[iz][index_b0],marker='D',linestyle='None',color='k',label='b=0')
             pl.title('X')
             pl.grid()
             pl.legend()
             pl.show()
 
-#        frequency = scipy.fftpack.fftfreq(len(Y[iz][:]), d=1)
-#        spectrum = np.abs(scipy.fftpack.fft(Y[iz][:], n=None, axis=-1, overwrite_x=False))
-#        Wn = np.amax(frequency)/10
-#        N = 5              #Order of the filter
-#        b, a = scipy.signal.iirfilter(N, Wn, rp=None, rs=None, btype='low', analog=False, ftype='butter', output='ba')
-#        Y_smooth[iz][:] = scipy.signal.filtfilt(b, a, Y[iz][:], axis=-1, padtype=None)
-
-        spline = scipy.interpolate.UnivariateSpline(T, Y[iz][:], w=None, bbox=[None, None], k=3, s=None)
-        Y_smooth[iz][:] = spline(T)
+        spline = UnivariateSpline(T, Y[iz], w=None, bbox=[None, None], k=3, s=None)
+        Y_smooth[iz] = spline(T)
 
         if graph:
-            pl.plot(T,Y_smooth[iz][:],label='spline_smoothing')
-            pl.plot(T,Y[iz][:],marker='*', linestyle='None',label='original_val')
+            pl.plot(T,Y_smooth[iz],label='spline_smoothing')
+            pl.plot(T,Y[iz],marker='*', linestyle='None',label='original_val')
             if len(index_b0)!=0:
-                T_b0 = [T[i_b0] for i_b0 in index_b0]
-                Y_b0 = [Y[iz][i_b0] for i_b0 in index_b0]
-                pl.plot(T_b0,Y_b0,marker='D',linestyle='None',color='k',label='b=0')
+                pl.plot(T[index_b0],Y[iz][index_b0],marker='D',linestyle='None',color='k',label='b=0')
             pl.title('Y')
             pl.grid()
             pl.legend()
@@ -296,18 +354,9 @@ def spline(folder_mat,nt,nz,verbose,index_b0 = [],graph=0):
 
     #Storing the final Matrices
     sct.printv('\nStoring the final Matrices...',verbose)
-    for iz in range(nz):
-        for it in range(nt):
-            file =  open(file_mat[it][iz])
-            Matrix = np.loadtxt(file)
-            file.close()
-
-            Matrix[0,3] = X_smooth[iz][it]
-            Matrix[1,3] = Y_smooth[iz][it]
-
-            file =  open(file_mat[it][iz],'w')
-            np.savetxt(file_mat[it][iz], Matrix, fmt="%s", delimiter='  ', newline='\n')
-            file.close()
+    matrices[:, :, 0, 3] = X_smooth.T
+    matrices[:, :, 1, 3] = Y_smooth.T
+    save_matrices(folder_mat, matrices)
 
     sct.printv('\n...Done. Patient motion has been smoothed', verbose)
     sct.printv('------------------------------------------------------------------------------\n',verbose)
@@ -324,31 +373,45 @@ def combine_matrix(param):
     # param.verbose
 
     sct.printv('\nCombine matrices...', param.verbose)
-    # list all mat files in source mat folder
-    m2c_fnames = [ fname for fname in os.listdir(param.mat_2_combine) if os.path.isfile(os.path.join(param.mat_2_combine, fname)) ]
-    # loop across files
-    for fname in m2c_fnames:
-        if os.path.isfile(os.path.join(param.mat_final, fname)):
-            # read source matrix
-            file = open(os.path.join(param.mat_2_combine, fname))
-            Matrix_m2c = np.loadtxt(file)
-            file.close()
-            # read destination matrix
-            file = open(os.path.join(param.mat_final, fname))
-            Matrix_f = np.loadtxt(file)
-            file.close()
-            # initialize final matrix
-            Matrix_final = np.identity(4)
-            # multiplies rotation matrix (3x3)
-            Matrix_final[0:3, 0:3] = Matrix_f[0:3, 0:3] * Matrix_m2c[0:3, 0:3]
-            # add translations matrix (3x1)
-            Matrix_final[0, 3] = Matrix_f[0, 3] + Matrix_m2c[0, 3]
-            Matrix_final[1, 3] = Matrix_f[1, 3] + Matrix_m2c[1, 3]
-            Matrix_final[2, 3] = Matrix_f[2, 3] + Matrix_m2c[2, 3]
-            # write final matrix (overwrite destination)
-            file = open(os.path.join(param.mat_final, fname), 'w')
-            np.savetxt(os.path.join(param.mat_final, fname), Matrix_final, fmt="%s", delimiter='  ', newline='\n')
-            file.close()
+    folder_m2c = sct.slash_at_the_end(param.mat_2_combine, 1)
+    folder_final = sct.slash_at_the_end(param.mat_final, 1)
+    Matrix_m2c, Matrix_f = None, None
+    if is_store_up_to_date(folder_m2c) and is_store_up_to_date(folder_final):
+        Matrix_m2c = np.load(folder_m2c + file_mat_store)
+        Matrix_f = np.load(folder_final + file_mat_store)
+    if Matrix_m2c is not None and Matrix_m2c.shape == Matrix_f.shape:
+        # combine the whole stores
+        save_matrices(folder_final, compose_matrices(Matrix_f, Matrix_m2c))
+    else:
+        # list all mat files in source mat folder that also exist in destination mat folder
+        fnames = [fname for fname in os.listdir(folder_m2c) if os.path.isfile(folder_m2c + fname) and fname != file_mat_store and os.path.isfile(folder_final + fname)]
+        if not fnames:
+            return
+        # read source and destination matrices
+        Matrix_m2c = np.array([np.loadtxt(folder_m2c + fname) for fname in fnames])
+        Matrix_f = np.array([np.loadtxt(folder_final + fname) for fname in fnames])
+        # write final matrices (overwrite destination)
+        for fname, Matrix_final in zip(fnames, compose_matrices(Matrix_f, Matrix_m2c)):
+            np.savetxt(folder_final + fname, Matrix_final, fmt="%s", delimiter='  ', newline='\n')
+        # the store of the destination folder is not valid anymore
+        if os.path.isfile(folder_final + file_mat_store):
+            os.remove(folder_final + file_mat_store)
+
+
+def compose_matrices(Matrix_f, Matrix_m2c):
+    """
+    Combine stacks of matrices: rotation parts are multiplied element-wise and translations are added.
+    :param Matrix_f, Matrix_m2c: (..., 4, 4) arrays
+    :return: (..., 4, 4) array
+    """
+    # initialize final matrices
+    Matrix_final = np.zeros(Matrix_f.shape)
+    Matrix_final[..., :, :] = np.identity(4)
+    # multiplies rotation matrix (3x3)
+    Matrix_final[..., 0:3, 0:3] = Matrix_f[..., 0:3, 0:3] * Matrix_m2c[..., 0:3, 0:3]
+    # add translations matrix (3x1)
+    Matrix_final[..., 0:3, 3] = Matrix_f[..., 0:3, 3] + Matrix_m2c[..., 0:3, 3]
+    return Matrix_final
 
 #
 # #=======================================================================================================================
@@ -18,9 +18,10 @@ import time
 import numpy as np
 import pandas as pd
 import pickle, gzip
+import json
 from sklearn import manifold, decomposition
 from sct_utils import printv, slash_at_the_end, check_file_exist
-from msct_gmseg_utils import pre_processing, register_data, apply_transfo, average_gm_wm, normalize_slice
+from msct_gmseg_utils import pre_processing, register_data, apply_transfo, average_gm_wm, normalize_slice, Slice
 from msct_image import Image
 from msct_parser import *
 
@@ -173,10 +174,42 @@ class Param:
         self.verbose = 1
         self.rm_tmp = True
 
+########################################################################################################################
+#                                           CLASS REDUCED SPACE
+########################################################################################################################
+class ReducedSpace:
+    '''
+    Linear projection into the model reduced space, stored as arrays in the model folder (used for PCA models)
+    '''
+    def __init__(self, components, mean, scale=None):
+        self.components_ = components
+        self.mean_ = mean
+        self.scale = scale
+        self.n_components_ = components.shape[0]
+
+    @staticmethod
+    def from_pca(pca):
+        scale = np.sqrt(pca.explained_variance_) if pca.whiten else None
+        return ReducedSpace(np.asarray(pca.components_), np.asarray(pca.mean_), scale)
+
+    def transform(self, data):
+        # same projection as sklearn.decomposition.PCA.transform
+        data_projected = np.dot(np.asarray(data) - self.mean_, self.components_.T)
+        if self.scale is not None:
+            data_projected /= self.scale
+        return data_projected
+
+
 ########################################################################################################################
 #                                           CLASS MODEL
 ########################################################################################################################
 class Model:
+    # array store of the model: one .npy file per array in this sub-folder, memory-mapped at loading
+    arrays_dir = 'model_arrays'
+    arrays_version = 1
+    slice_attributes = ['im', 'im_M']
+    seg_attributes = ['gm_seg', 'wm_seg', 'gm_seg_M', 'wm_seg_M']
+
     def __init__(self, param_model=None, param_data=None, param=None):
         self.param_model = param_model if param_model is not None else ParamModel()
         self.param_data = param_data if param_data is not None else ParamData()
@@ -410,23 +443,75 @@ class Model:
         os.chdir(self.param_model.new_model_dir)
         ## to save:
         ##   - self.slices = dictionary
-        slices = self.slices
-        pickle.dump(slices, gzip.open('slices.pklz', 'wb'), protocol=2)
-
         ##   - self.intensities = for normalization
-        intensities = self.intensities
-        pickle.dump(intensities, gzip.open('intensities.pklz', 'wb'), protocol=2)
-
         ##   - reduced space (pca or isomap)
-        model = self.fitted_model
-        pickle.dump(model, gzip.open('fitted_model.pklz', 'wb'), protocol=2)
-
         ##   - fitted data (=eigen vectors or embedding vectors )
-        data = self.fitted_data
-        pickle.dump(data, gzip.open('fitted_data.pklz', 'wb'), protocol=2)
+        self.save_model_arrays('.')
+
+        ##   - non linear reduced space (isomap) cannot be stored as arrays
+        if not isinstance(self.fitted_model, (ReducedSpace, decomposition.PCA)):
+            pickle.dump(self.fitted_model, gzip.open('fitted_model.pklz', 'wb'), protocol=2)
 
         os.chdir('..')
 
+    # ------------------------------------------------------------------------------------------------------------------
+    def save_model_arrays(self, path_model):
+        '''
+        Save the model as uncompressed numpy arrays in path_model/model_arrays/, so that they can be memory-mapped (and
+        shared between processes) at loading. The arrays are written in a temporary folder renamed at the end, so that a
+        partially written model is never loaded.
+        '''
+        path_model = slash_at_the_end(path_model, slash=1)
+        arrays = {}
+        ##   - self.slices = dictionary: images stacked along the first axis, segmentations of all slices concatenated
+        ##     with the index of the first segmentation of each slice
+        arrays['id'] = np.array([dic_slice.id for dic_slice in self.slices], dtype=int)
+        arrays['level'] = np.array([dic_slice.level for dic_slice in self.slices], dtype=np.float64)
+        for attr in self.slice_attributes:
+            arrays[attr] = np.array([getattr(dic_slice, attr) for dic_slice in self.slices])
+        for attr in self.seg_attributes:
+            list_seg = [np.asarray(getattr(dic_slice, attr)) for dic_slice in self.slices]
+            seg = np.concatenate(list_seg)
+            # manual segmentations are binary: store them on one byte
+            if np.array_equal(seg, seg.astype(np.uint8)):
+                seg = seg.astype(np.uint8)
+            arrays[attr] = seg
+            arrays[attr + '_index'] = np.cumsum([0] + [len(s) for s in list_seg])
+        arrays['mean_image'] = np.asarray(self.mean_image)
+        ##   - self.intensities = for normalization
+        arrays['intensities'] = np.asarray(self.intensities.values, dtype=np.float64)
+        arrays['intensities_index'] = np.asarray(self.intensities.index)
+        ##   - reduced space (pca only)
+        fitted_model = ReducedSpace.from_pca(self.fitted_model) if isinstance(self.fitted_model, decomposition.PCA) else self.fitted_model
+        if isinstance(fitted_model, ReducedSpace):
+            arrays['components'] = fitted_model.components_
+            arrays['components_mean'] = fitted_model.mean_
+            if fitted_model.scale is not None:
+                arrays['components_scale'] = fitted_model.scale
+        ##   - fitted data (=eigen vectors or embedding vectors )
+        arrays['fitted_data'] = np.asarray(self.fitted_data)
+
+        header = {'version': self.arrays_version,
+                  'method': self.param_model.method,
+                  'reduced_space': 'arrays' if isinstance(fitted_model, ReducedSpace) else 'fitted_model.pklz',
+                  'intensities_columns': [str(c) for c in self.intensities.columns],
+                  'arrays': sorted(arrays.keys())}
+
+        path_tmp = path_model + self.arrays_dir + '.' + str(os.getpid()) + '.tmp/'
+        if os.path.exists(path_tmp):
+            shutil.rmtree(path_tmp)
+        os.mkdir(path_tmp)
+        for name, data in arrays.items():
+            np.save(path_tmp + name + '.npy', data)
+        json.dump(header, open(path_tmp + 'header.json', 'w'), indent=4)
+        if os.path.exists(path_model + self.arrays_dir):
+            shutil.rmtree(path_model + self.arrays_dir)
+        try:
+            os.rename(path_tmp, path_model + self.arrays_dir)
+        except OSError:
+            # the same model was written by another process in the meantime
+            shutil.rmtree(path_tmp)
+
     # ----------------------------------- END OF FUNCTIONS USED TO COMPUTE THE MODEL -----------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
@@ -437,6 +522,63 @@ class Model:
         printv('\nLoading model...', self.param.verbose, 'normal')
         os.chdir(self.param_model.path_model_to_load)
 
+        if self.load_model_arrays('.'):
+            printv('  OK: ' + self.arrays_dir, self.param.verbose, 'normal')
+        else:
+            self.load_model_pklz()
+            # convert the model once, so that next loadings use the array store
+            try:
+                self.save_model_arrays('.')
+                printv('  Model converted to ' + self.arrays_dir, self.param.verbose, 'normal')
+            except (IOError, OSError) as e:
+                printv('  WARNING: could not convert the model to ' + self.arrays_dir + ': ' + str(e), self.param.verbose, 'warning')
+
+        printv('  '+str(len(self.slices))+' slices in the model dataset', self.param.verbose, 'normal')
+        printv('  model: '+self.param_model.method)
+        printv('  '+str(self.fitted_data.shape[1])+' components kept on '+str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
+        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
+        os.chdir(path)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def load_model_arrays(self, path_model):
+        '''
+        Load the model from the array store written by save_model_arrays. Images and segmentations are memory-mapped
+        (read-only): the dictionary slices are views on the mapped arrays.
+        :return: False if there is no array store (or an incompatible one) in path_model
+        '''
+        path_arrays = slash_at_the_end(path_model, slash=1) + self.arrays_dir + '/'
+        if not os.path.isfile(path_arrays + 'header.json'):
+            return False
+        header = json.load(open(path_arrays + 'header.json'))
+        if header['version'] != self.arrays_version:
+            printv('  WARNING: model array store version ' + str(header['version']) + ' is not supported', self.param.verbose, 'warning')
+            return False
+        arrays = dict((name, np.load(path_arrays + name + '.npy', mmap_mode='r')) for name in header['arrays'])
+
+        ##   - self.slices = dictionary
+        self.slices = []
+        for j, slice_id in enumerate(arrays['id']):
+            slice_data = dict((attr.lower(), arrays[attr][j]) for attr in self.slice_attributes)
+            for attr in self.seg_attributes:
+                slice_data[attr.lower()] = arrays[attr][arrays[attr + '_index'][j]:arrays[attr + '_index'][j + 1]]
+            self.slices.append(Slice(slice_id=int(slice_id), level=float(arrays['level'][j]), **slice_data))
+        self.mean_image = np.array(arrays['mean_image'])
+
+        ##   - self.intensities = for normalization
+        self.intensities = pd.DataFrame(np.array(arrays['intensities']), index=np.array(arrays['intensities_index']), columns=header['intensities_columns'])
+
+        ##   - reduced space (pca or isomap)
+        if header['reduced_space'] == 'arrays':
+            self.fitted_model = ReducedSpace(np.array(arrays['components']), np.array(arrays['components_mean']), np.array(arrays['components_scale']) if 'components_scale' in arrays else None)
+        else:
+            self.fitted_model = pickle.load(gzip.open(slash_at_the_end(path_model, slash=1) + header['reduced_space'], 'rb'))
+
+        ##   - fitted data (=eigen vectors or embedding vectors )
+        self.fitted_data = np.array(arrays['fitted_data'])
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def load_model_pklz(self):
         model_files = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
         correct_model = True
         for fname in model_files.values():
@@ -455,7 +597,6 @@ class Model:
 
         ##   - self.slices = dictionary
         self.slices = pickle.load(gzip.open(model_files['slices'],  'rb'))
-        printv('  '+str(len(self.slices))+' slices in the model dataset', self.param.verbose, 'normal')
         self.mean_image = np.mean([dic_slice.im for dic_slice in self.slices], axis=0)
 
         ##   - self.intensities = for normalization
@@ -467,11 +608,6 @@ class Model:
         ##   - fitted data (=eigen vectors or embedding vectors )
         self.fitted_data = pickle.load(gzip.open(model_files['data'], 'rb'))
 
-        printv('  model: '+self.param_model.method)
-        printv('  '+str(self.fitted_data.shape[1])+' components kept on '+str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
-        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
-        os.chdir(path)
-
     # ------------------------------------------------------------------------------------------------------------------
     #                                                   UTILS FUNCTIONS
     # ------------------------------------------------------------------------------------------------------------------
@@ -164,24 +164,10 @@ class NURBS():
                             self.courbe2D, self.courbe2D_deriv = self.construct2D(self.pointsControle, self.degre, self.precision/3)
 
                         # compute error between the input data and the nurbs
-                        error_curve = 0.0
                         if not twodim:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe3D[0])):
-                                    dist = (self.courbe3D[0][k]-P_x[i])**2 + (self.courbe3D[1][k]-P_y[i])**2 + (self.courbe3D[2][k]-P_z[i])**2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
+                            error_curve = self.compute_error_curve([P_x, P_y, P_z], self.courbe3D)
                         else:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe2D[0])):
-                                    dist = (self.courbe2D[0][k]-P_x[i])**2 + (self.courbe2D[1][k]-P_y[i])**2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
-                        error_curve /= float(len(P_x))
+                            error_curve = self.compute_error_curve([P_x, P_y], self.courbe2D)
 
                         if verbose >= 1:
                             print 'Error on approximation = ' + str(round(error_curve, 2)) + ' mm'
@@ -246,63 +232,47 @@ class NURBS():
     def getCourbe2D_deriv(self):
         return self.courbe2D_deriv
 
-    # Multiplie deux polynomes
-    def multipolynome(self,polyA,polyB):
-        result = []
-        for r in polyB:
-            temp = polyA*r[0]
-            result.append([temp, r[-1]])
-        return result
-
-    def N(self,i,k,x):
-        global Nik_temp
-        if k==1:
-            tab = [[poly1d(1),i+1]]
-        else:
-            tab = []
-            den_g = x[i+k-1]-x[i]
-            den_d = x[i+k]-x[i+1]
-            if den_g != 0:
-                if Nik_temp[i][k-1] == -1:
-                    Nik_temp[i][k-1] = self.N(i,k-1,x)
-                tab_b = self.multipolynome(poly1d([1/den_g,-x[i]/den_g]),Nik_temp[i][k-1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp[i+1][k-1] == -1:
-                    Nik_temp[i+1][k-1] = self.N(i+1,k-1,x)
-                tab_d = self.multipolynome(poly1d([-1/den_d,x[i+k]/den_d]),Nik_temp[i+1][k-1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def Np(self,i,k,x):
-        global Nik_temp_deriv, Nik_temp
-        if k==1:
-            tab = [[poly1d(0),i+1]]
-        else:
-            tab = []
-            den_g = x[i+k-1]-x[i]
-            den_d = x[i+k]-x[i+1]
-            if den_g != 0:
-                if Nik_temp_deriv[i][-1] == -1:
-                    Nik_temp_deriv[i][-1] = self.N(i,k-1,x)
-                tab_b = self.multipolynome(poly1d([k/den_g]),Nik_temp_deriv[i][-1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp_deriv[i+1][-1] == -1 :
-                    Nik_temp_deriv[i+1][-1] = self.N(i+1,k-1,x)
-                tab_d = self.multipolynome(poly1d([-k/den_d]),Nik_temp_deriv[i+1][-1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def evaluateN(self,Ni,t,x):
-        result = 0
-        for Ni_temp in Ni:
-            if x[Ni_temp[-1]-1] <= t <= x[Ni_temp[-1]]:
-                result += Ni_temp[0](t)
-        return result
-
+    def basis_functions(self, k, x, t):
+        """
+        Evaluate all the B-spline basis functions of order k defined on the knot vector x, and their derivatives, at all
+        parameters t at once (Cox-de Boor recursion on arrays).
+        As in the former piecewise polynomial evaluation, each piece is defined on a closed knot span: at an interior
+        knot, both adjacent spans contribute.
+        :param k: order of the B-spline (degree + 1)
+        :param x: knot vector
+        :param t: parameters
+        :return: N, Np: arrays (len(t), len(x)-k) of the basis functions and of their derivatives
+        """
+        x = asarray(x, dtype=float)
+        t = atleast_1d(asarray(t, dtype=float))
+        nb_points, nb_spans = len(t), len(x) - 1
+
+        # order 1: indicator of the non-empty spans [x_j, x_j+1] containing t
+        N = zeros((nb_points, nb_spans))
+        span_right = searchsorted(x, t, side='right') - 1  # x_j <= t < x_j+1
+        span_left = searchsorted(x, t, side='left') - 1  # x_j < t <= x_j+1
+        valid = (span_right >= 0) & (span_right < nb_spans)
+        N[valid, span_right[valid]] += 1.0
+        valid = (span_left >= 0) & (span_left < nb_spans) & (span_left != span_right)
+        N[valid, span_left[valid]] += 1.0
+
+        Np = zeros((nb_points, nb_spans))
+        t = t[:, newaxis]
+        for r in range(2, k + 1):
+            nb = len(x) - r
+            N_previous = N
+            N = zeros((nb_points, nb))
+            den_g = x[r - 1:r - 1 + nb] - x[:nb]
+            den_d = x[r:r + nb] - x[1:1 + nb]
+            left, right = den_g != 0, den_d != 0
+            N[:, left] += (t - x[:nb][left]) / den_g[left] * N_previous[:, :nb][:, left]
+            N[:, right] += (x[r:r + nb][right] - t) / den_d[right] * N_previous[:, 1:][:, right]
+            if r == k:
+                Np = zeros((nb_points, nb))
+                Np[:, left] += k / den_g[left] * N_previous[:, :nb][:, left]
+                Np[:, right] -= k / den_d[right] * N_previous[:, 1:][:, right]
+
+        return N, Np
 
     def calculX3D(self,P,k):
         n = len(P)-1
@@ -343,81 +313,12 @@ class NURBS():
         return x
 
     def construct3D(self,P,k,prec): # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P) # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX3D(P,k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in xrange(k)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i,k,x)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-
-        #Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp_deriv[i][-1]=self.Np(i,k,x)
-        Nikp=[]
-        for i in xrange(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
-
         # Calcul de la courbe
         param = linspace(x[0],x[-1],prec)
-        P_x,P_y,P_z = [],[],[] # coord fitees
-        P_x_d,P_y_d,P_z_d=[],[],[] #derivees
-        for i in xrange(len(param)):
-            sum_num_x,sum_num_y,sum_num_z,sum_den = 0,0,0,0
-            sum_num_x_der,sum_num_y_der,sum_num_z_der,sum_den_der = 0,0,0,0
-
-            for l in xrange(n-k+1): # utilisation que des points non nuls
-                if x[l+k-1]<=param[i]<x[l+k]:
-                    debut = l
-            fin = debut+k-1
-
-            for j,point in enumerate(P[debut:fin+1]):
-                j = j+debut
-                N_temp = self.evaluateN(Nik[j],param[i],x)
-                N_temp_deriv = self.evaluateN(Nikp[j],param[i],x)
-                sum_num_x += N_temp*point[0]
-                sum_num_y += N_temp*point[1]
-                sum_num_z += N_temp*point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv*point[0]
-                sum_num_y_der += N_temp_deriv*point[1]
-                sum_num_z_der += N_temp_deriv*point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x/sum_den) # sum_den = 1 !
-            P_y.append(sum_num_y/sum_den)
-            P_z.append(sum_num_z/sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise Exception('WARNING: NURBS instability -> wrong reconstruction')
-
-
-
-        P_x = [P_x[i] for i in argsort(P_z)]
-        P_y = [P_y[i] for i in argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in argsort(P_z)]
-        P_z = sort(P_z)
-
-        #on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x=array(P_x)
-        P_y=array(P_y)
-        P_x_d=array(P_x_d)
-        P_y_d=array(P_y_d)
-        P_z_d=array(P_z_d)
+        P_x,P_y,P_z,P_x_d,P_y_d,P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         if self.all_slices:
             P_z=array([int(round(P_z[i])) for i in range(0, len(P_z))])
@@ -451,72 +352,16 @@ class NURBS():
         return [P_x,P_y,P_z], [P_x_d,P_y_d,P_z_d]
 
     def construct2D(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P) # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX2D(P,k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in xrange(k)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-
-        #Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in xrange(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
-
         # Calcul de la courbe
         param = linspace(x[0], x[-1], prec)
-        P_x, P_y = [], []  # coord fitees
-        P_x_d, P_y_d = [], [] #derivees
-        for i in xrange(len(param)):
-            sum_num_x, sum_num_y,sum_den = 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_den_der = 0, 0, 0
-
-            for l in xrange(n-k+1):  # utilisation que des points non nuls
-                if x[l+k-1] <= param[i] < x[l+k]:
-                    debut = l
-            fin = debut+k-1
-
-            for j, point in enumerate(P[debut:fin+1]):
-                j = j+debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp*point[0]
-                sum_num_y += N_temp*point[1]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv*point[0]
-                sum_num_y_der += N_temp_deriv*point[1]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x/sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y/sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-
-            if sum_den <= 0.05:
-                raise Exception('WARNING: NURBS instability -> wrong reconstruction')
-
-        P_x = [P_x[i] for i in argsort(P_y)]
-        P_x_d = [P_x_d[i] for i in argsort(P_y)]
-        P_y_d = [P_y_d[i] for i in argsort(P_y)]
-        P_y = sort(P_y)
-
-        #on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x=array(P_x)
-        P_y=array(P_y)
-        P_x_d=array(P_x_d)
-        P_y_d=array(P_y_d)
+        courbe, courbe_deriv = self.evaluate_curve(P, k, x, param)
+
+        order = argsort(courbe[:, 1])
+        P_x, P_x_d, P_y_d = courbe[order, 0], courbe_deriv[order, 0], courbe_deriv[order, 1]
+        P_y = sort(courbe[:, 1])
 
         if self.all_slices:
             P_y=array([int(round(P_y[i])) for i in range(0, len(P_y))])
@@ -543,27 +388,33 @@ class NURBS():
 
         return [P_x, P_y], [P_x_d, P_y_d]
 
-    def Tk(self, k, Q, Nik, ubar, u):
-        return Q[k] - self.evaluateN(Nik[-1], ubar, u) * Q[-1] - self.evaluateN(Nik[0], ubar, u) * Q[0]
+    def Tk(self, Q, N):
+        # Q[k] - N_n-1(ubar_k) * Q[-1] - N_0(ubar_k) * Q[0], for all ubar_k but the last one
+        Q = asarray(Q, dtype=float)
+        return Q[:len(N)] - N[:, -1] * Q[-1] - N[:, 0] * Q[0]
 
     def isXinY(self, y, x):
-        result = True
-        for i in range(0, len(y)-1):
-            if y[i] - y[i+1] != 0.0:
-                result_temp = False
-                for j in range(0, len(x)):
-                    if y[i] - y[i+1] != 0.0 and y[i] <= x[j] <= y[i+1]:
-                        result_temp = True
-                        break
-                result = result and result_temp
-        return result
+        # True if every non-empty knot span [y_i, y_i+1] contains at least one value of x
+        y, x = asarray(y, dtype=float), sort(asarray(x, dtype=float))
+        spans = (y[:-1] - y[1:]) != 0.0
+        nb_in_span = searchsorted(x, y[1:][spans], side='right') - searchsorted(x, y[:-1][spans], side='left')
+        return bool(all(nb_in_span > 0))
+
+    def compute_error_curve(self, data, courbe):
+        # mean of the squared distance between each data point and the closest point of the curve (bounded by 10000)
+        dist = zeros((len(data[0]), len(courbe[0])))
+        for data_dim, courbe_dim in zip(data, courbe):
+            dist += (asarray(courbe_dim)[newaxis, :] - asarray(data_dim)[:, newaxis])**2
+        error_curve = 0.0
+        for min_dist in minimum(dist.min(axis=1), 10000.0):
+            error_curve += min_dist
+        return error_curve / float(len(data[0]))
 
 
     def reconstructGlobalApproximation(self,P_x,P_y,P_z,p,n,w):
         # p = degre de la NURBS
         # n = nombre de points de controle desires
         # w is the weigth on each point P
-        global Nik_temp
         m = len(P_x)
 
         # Calcul des chords
@@ -610,61 +461,21 @@ class NURBS():
             n_iter += 1
 
 
-        Nik_temp = [[-1 for j in xrange(p)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i,p,u)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
+        # basis functions at each data parameter (but the last one)
+        N = self.basis_functions(p, u, ubar[0:m-1])[0]
+        denU = N.sum(axis=1)
+        R = N[:, 0:n-1] / denU[:, newaxis]
 
-        R = []
-        for k in xrange(m-1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni,ubar[k],u)
-            for i in xrange(n-1):
-                Rtemp.append(self.evaluateN(Nik[i],ubar[k],u)/den)
-            R.append(Rtemp)
-        R = matrix(R)
-
-        # create W diagonal matrix
-        W = diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in xrange(m-1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni,ubar[k],u)
-            denU.append(temp)
-        Tx = []
-        for i in xrange(n-1):
-            somme = 0
-            for k in xrange(m-1):
-                somme += w[k]*self.evaluateN(Nik[i],ubar[k],u)*self.Tk(k,P_x,Nik,ubar[k],u)/denU[k]
-            Tx.append(somme)
-        Tx = matrix(Tx)
-
-        Ty = []
-        for i in xrange(n-1):
-            somme = 0
-            for k in xrange(m-1):
-                somme += w[k]*self.evaluateN(Nik[i],ubar[k],u)*self.Tk(k,P_y,Nik,ubar[k],u)/denU[k]
-            Ty.append(somme)
-        Ty = matrix(Ty)
-
-        Tz = []
-        for i in xrange(n-1):
-            somme = 0
-            for k in xrange(m-1):
-                somme += w[k]*self.evaluateN(Nik[i],ubar[k],u)*self.Tk(k,P_z,Nik,ubar[k],u)/denU[k]
-            Tz.append(somme)
-        Tz = matrix(Tz)
-
-        P_xb = (R.T*W*R).I*Tx.T
-        P_yb = (R.T*W*R).I*Ty.T
-        P_zb = (R.T*W*R).I*Tz.T
+        # weights are applied elementwise instead of building the diagonal matrix W
+        weights = asarray(w[0:m-1], dtype=float)
+        RtWR_inv = matrix(dot(R.T, weights[:, newaxis] * R)).I
+        Tx = matrix(dot(weights * self.Tk(P_x, N) / denU, N[:, 0:n-1]))
+        Ty = matrix(dot(weights * self.Tk(P_y, N) / denU, N[:, 0:n-1]))
+        Tz = matrix(dot(weights * self.Tk(P_z, N) / denU, N[:, 0:n-1]))
+
+        P_xb = RtWR_inv*Tx.T
+        P_yb = RtWR_inv*Ty.T
+        P_zb = RtWR_inv*Tz.T
 
         # Modification of first and last control points
         P_xb[0],P_yb[0],P_zb[0] = P_x[0],P_y[0],P_z[0]
@@ -686,7 +497,6 @@ class NURBS():
         # p = degre de la NURBS
         # n = nombre de points de controle desires
         # w is the weigth on each point P
-        global Nik_temp
         m = len(P_x)
 
         # Calcul des chords
@@ -732,52 +542,19 @@ class NURBS():
             u += gamma * (u_nonuniform - u_uniform)
             n_iter += 1
 
-        Nik_temp = [[-1 for j in xrange(p)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
+        # basis functions at each data parameter (but the last one)
+        N = self.basis_functions(p, u, ubar[0:m-1])[0]
+        denU = N.sum(axis=1)
+        R = N[:, 0:n-1] / denU[:, newaxis]
 
-        R = []
-        for k in xrange(m-1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni, ubar[k], u)
-            for i in xrange(n-1):
-                Rtemp.append(self.evaluateN(Nik[i], ubar[k], u)/den)
-            R.append(Rtemp)
-        R = matrix(R)
-
-        # create W diagonal matrix
-        W = diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in xrange(m-1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni, ubar[k], u)
-            denU.append(temp)
-        Tx = []
-        for i in xrange(n-1):
-            somme = 0
-            for k in xrange(m-1):
-                somme += w[k]*self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_x, Nik, ubar[k], u) / denU[k]
-            Tx.append(somme)
-        Tx = matrix(Tx)
-
-        Ty = []
-        for i in xrange(n-1):
-            somme = 0
-            for k in xrange(m-1):
-                somme += w[k]*self.evaluateN(Nik[i], ubar[k], u)*self.Tk(k, P_y, Nik, ubar[k], u) / denU[k]
-            Ty.append(somme)
-        Ty = matrix(Ty)
-
-        P_xb = (R.T*W*R).I*Tx.T
-        P_yb = (R.T*W*R).I*Ty.T
+        # weights are applied elementwise instead of building the diagonal matrix W
+        weights = asarray(w[0:m-1], dtype=float)
+        RtWR_inv = matrix(dot(R.T, weights[:, newaxis] * R)).I
+        Tx = matrix(dot(weights * self.Tk(P_x, N) / denU, N[:, 0:n-1]))
+        Ty = matrix(dot(weights * self.Tk(P_y, N) / denU, N[:, 0:n-1]))
+
+        P_xb = RtWR_inv*Tx.T
+        P_yb = RtWR_inv*Ty.T
 
         # Modification of first and last control points
         P_xb[0], P_yb[0] = P_x[0], P_y[0]
@@ -796,7 +573,6 @@ class NURBS():
         return P
 
     def reconstructGlobalInterpolation(self,P_x,P_y,P_z,p):  ### now in 3D
-        global Nik_temp
         n = 13
         l = len(P_x)
         newPx = P_x[::int(round(l/(n-1)))]
@@ -822,22 +598,8 @@ class NURBS():
             u.append(sumU/p)
         u.extend([1]*p)
 
-        # Construction des fonctions basiques
-        Nik_temp = [[-1 for j in xrange(p)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i,p,u)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
         # Construction des matrices
-        M = []
-        for i in xrange(n):
-            ligneM = []
-            for j in xrange(n):
-                ligneM.append(self.evaluateN(Nik[j],ubar[i],u))
-            M.append(ligneM)
-        M = matrix(M)
+        M = matrix(self.basis_functions(p, u, ubar)[0])
 
         # Matrice des points interpoles
         Qx = matrix(newPx).T
@@ -851,85 +613,54 @@ class NURBS():
 
         return [[P_xb[i,0],P_yb[i,0],P_zb[i,0]] for i in range(len(P_xb))]
 
-    def compute_curve_from_parametrization(self, P, k, x, Nik, Nikp, param):
-        n = len(P)  # Nombre de points de controle - 1
-        P_x, P_y, P_z = [], [], []  # coord fitees
-        P_x_d, P_y_d, P_z_d = [], [], []  # derivees
-        for i in xrange(len(param)):
-            sum_num_x, sum_num_y, sum_num_z, sum_den = 0, 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_num_z_der, sum_den_der = 0, 0, 0, 0
-
-            for l in xrange(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_num_z += N_temp * point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_num_z_der += N_temp_deriv * point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_z.append(sum_num_z / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise Exception('WARNING: NURBS instability -> wrong reconstruction')
-
-        P_x = [P_x[i] for i in argsort(P_z)]
-        P_y = [P_y[i] for i in argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in argsort(P_z)]
-        P_z = sort(P_z)
+    def evaluate_curve(self, P, k, x, param):
+        """
+        Evaluate the B-spline curve defined by control points P and knot vector x, and its derivative, at all
+        parameters param.
+        :return: courbe, courbe_deriv: arrays (len(param), dimension)
+        """
+        P = asarray(P, dtype=float)
+        n = len(P)  # Nombre de points de controle
+        N, Np = self.basis_functions(k, x, param)
+
+        # only the k control points acting on the span [x_l+k-1, x_l+k[ of each parameter are used (utilisation que des
+        # points non nuls). A parameter outside all spans (upper bound) keeps the span of the previous parameter.
+        debut = searchsorted(asarray(x, dtype=float), param, side='right') - k
+        found = (debut >= 0) & (debut <= n - k)
+        index_found = maximum.accumulate(where(found, arange(len(param)), -1))
+        if any(index_found < 0):
+            raise Exception('WARNING: NURBS instability -> wrong reconstruction')
+        debut = debut[index_found][:, newaxis]
+        index_points = arange(n)[newaxis, :]
+        mask_points = (index_points >= debut) & (index_points < debut + k)
+        N, Np = N * mask_points, Np * mask_points
+
+        sum_den = N.sum(axis=1)  # sum_den = 1 !
+        if any(sum_den <= 0.05):
+            raise Exception('WARNING: NURBS instability -> wrong reconstruction')
+
+        return dot(N, P) / sum_den[:, newaxis], dot(Np, P)
+
+    def compute_curve_from_parametrization(self, P, k, x, param):
+        courbe, courbe_deriv = self.evaluate_curve(P, k, x, param)
+
+        order = argsort(courbe[:, 2])
+        P_x, P_y = courbe[order, 0], courbe[order, 1]
+        P_x_d, P_y_d, P_z_d = courbe_deriv[order, 0], courbe_deriv[order, 1], courbe_deriv[order, 2]
+        P_z = sort(courbe[:, 2])
 
         # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = array(P_x)
-        P_y = array(P_y)
-        P_x_d = array(P_x_d)
-        P_y_d = array(P_y_d)
-        P_z_d = array(P_z_d)
         return P_x, P_y, P_z, P_x_d, P_y_d, P_z_d
 
     def construct3D_uniform(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX3D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in xrange(k)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in xrange(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
         # reparametrization of the curve
         import numpy as np
         param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
         from msct_types import Centerline
         centerline = Centerline(P_x, P_y, P_z, P_x_d, P_y_d, P_z_d)
         distances_between_points = centerline.progressive_length
@@ -938,7 +669,7 @@ class NURBS():
         for i in range(1, prec):
             dist_curved[i] = dist_curved[i - 1] + distances_between_points[i - 1] / centerline.length
         param = x[0] + (x[-1] - x[0]) * np.interp(range_points, dist_curved, range_points)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         if self.all_slices:
             P_z = array([int(round(P_z[i])) for i in range(0, len(P_z))])
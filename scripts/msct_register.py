@@ -16,6 +16,7 @@
 # TODO: add flag for setting threshold on PCA
 # TODO: clean code for generate_warping_field (unify with centermass_rot)
 
+import os
 import sys
 from math import asin, cos, sin, acos
 from os import chdir
@@ -37,6 +38,7 @@ def register_slicewise(fname_src,
                         paramreg=None,
                         ants_registration_params=None,
                         path_qc='./',
+                        cpu_number=1,
                         verbose=0):
 
     # create temporary folder
@@ -67,7 +69,7 @@ def register_slicewise(fname_src,
         algo_dic = {'translation': 'Translation', 'rigid': 'Rigid', 'affine': 'Affine', 'syn': 'SyN', 'bsplinesyn': 'BSplineSyN', 'centermass': 'centermass'}
         paramreg.algo = algo_dic[paramreg.algo]
         # run slicewise registration
-        register2d('src.nii', 'dest.nii', fname_mask=fname_mask, fname_warp=warp_forward_out, fname_warp_inv=warp_inverse_out, paramreg=paramreg, ants_registration_params=ants_registration_params, verbose=verbose)
+        register2d('src.nii', 'dest.nii', fname_mask=fname_mask, fname_warp=warp_forward_out, fname_warp_inv=warp_inverse_out, paramreg=paramreg, ants_registration_params=ants_registration_params, cpu_number=cpu_number, verbose=verbose)
 
     sct.printv('\nMove warping fields to parent folder...', verbose)
     sct.run('mv '+warp_forward_out+' ../')
@@ -81,7 +83,7 @@ def register2d_centermassrot(fname_src, fname_dest, fname_warp='warp_forward.nii
     """
     Rotate the source image to match the orientation of the destination image, using the first and second eigenvector
     of the PCA. This function should be used on segmentations (not images).
-    This works for 2D and 3D images.  If 3D, it splits the image and performs the rotation slice-by-slice.
+    This works for 2D and 3D images.  If 3D, it performs the rotation slice-by-slice (all slices are processed at once).
     input:
         fname_source: name of moving image (type: string)
         fname_dest: name of fixed image (type: string)
@@ -105,22 +107,9 @@ def register2d_centermassrot(fname_src, fname_dest, fname_warp='warp_forward.nii
     sct.printv('  matrix size: '+str(nx)+' x '+str(ny)+' x '+str(nz), verbose)
     sct.printv('  voxel size:  '+str(px)+'mm x '+str(py)+'mm x '+str(pz)+'mm', verbose)
 
-    # Split source volume along z
-    sct.printv('\nSplit input volume...', verbose)
-    from sct_image import split_data
-    im_src = Image('src.nii')
-    split_source_list = split_data(im_src, 2)
-    for im in split_source_list:
-        im.save()
-
-    # Split destination volume along z
-    sct.printv('\nSplit destination volume...', verbose)
-    im_dest = Image('dest.nii')
-    split_dest_list = split_data(im_dest, 2)
-    for im in split_dest_list:
-        im.save()
-
-    # display image
+    # open images
+    im_src = Image(fname_src)
+    im_dest = Image(fname_dest)
     data_src = im_src.data
     data_dest = im_dest.data
 
@@ -132,38 +121,20 @@ def register2d_centermassrot(fname_src, fname_dest, fname_warp='warp_forward.nii
         data_src = data_src.reshape(new_shape)
         data_dest = data_dest.reshape(new_shape)
 
-    # initialize displacement and rotation
-    coord_src = [None] * nz
-    pca_src = [None] * nz
-    coord_dest = [None] * nz
-    pca_dest = [None] * nz
-    centermass_src = np.zeros([nz, 2])
-    centermass_dest = np.zeros([nz, 2])
-    # displacement_forward = np.zeros([nz, 2])
-    # displacement_inverse = np.zeros([nz, 2])
+    # compute PCA and get center of mass of all slices
+    centermass_src, eigenv_src, eigenratio_src, valid_src = compute_pca_slicewise(data_src)
+    centermass_dest, eigenv_dest, eigenratio_dest, valid_dest = compute_pca_slicewise(data_dest)
+    # if one of the slice is empty, ignore it
+    z_nonzero = list(np.flatnonzero(valid_src & valid_dest))
+    for iz in np.flatnonzero(~(valid_src & valid_dest)):
+        sct.printv('WARNING: Slice #' + str(iz) + ' is empty. It will be ignored.', verbose, 'warning')
+    # compute (src,dest) angle for first eigenvector
     angle_src_dest = np.zeros(nz)
-    z_nonzero = []
-    # Loop across slices
-    for iz in range(0, nz):
-        try:
-            # compute PCA and get center or mass
-            coord_src[iz], pca_src[iz], centermass_src[iz, :] = compute_pca(data_src[:, :, iz])
-            coord_dest[iz], pca_dest[iz], centermass_dest[iz, :] = compute_pca(data_dest[:, :, iz])
-            # compute (src,dest) angle for first eigenvector
-            if rot == 1:
-                eigenv_src = pca_src[iz].components_.T[0][0], pca_src[iz].components_.T[1][0]  # pca_src.components_.T[0]
-                eigenv_dest = pca_dest[iz].components_.T[0][0], pca_dest[iz].components_.T[1][0]  # pca_dest.components_.T[0]
-                angle_src_dest[iz] = angle_between(eigenv_src, eigenv_dest)
-                # check if ratio between the two eigenvectors is high enough to prevent poor robustness
-                if pca_src[iz].explained_variance_ratio_[0] / pca_src[iz].explained_variance_ratio_[1] < pca_eigenratio_th:
-                    angle_src_dest[iz] = 0
-                if pca_dest[iz].explained_variance_ratio_[0] / pca_dest[iz].explained_variance_ratio_[1] < pca_eigenratio_th:
-                    angle_src_dest[iz] = 0
-            # append to list of z_nonzero
-            z_nonzero.append(iz)
-        # if one of the slice is empty, ignore it
-        except ValueError:
-            sct.printv('WARNING: Slice #' + str(iz) + ' is empty. It will be ignored.', verbose, 'warning')
+    if rot == 1:
+        angle_src_dest = angle_between_slicewise(eigenv_src, eigenv_dest)
+        # check if ratio between the two eigenvectors is high enough to prevent poor robustness
+        angle_src_dest[(eigenratio_src < pca_eigenratio_th) | (eigenratio_dest < pca_eigenratio_th)] = 0
+        angle_src_dest[~(valid_src & valid_dest)] = 0
 
     # regularize rotation
     if not poly == 0 and rot == 1:
@@ -181,101 +152,126 @@ def register2d_centermassrot(fname_src, fname_dest, fname_warp='warp_forward.nii
         # update variable
         angle_src_dest[z_nonzero] = angle_src_dest_regularized
 
-    # initialize warping fields
+    # construct 3D warping fields
     # N.B. forward transfo is defined in destination space and inverse transfo is defined in the source space
-    warp_x = np.zeros(data_dest.shape)
-    warp_y = np.zeros(data_dest.shape)
-    warp_inv_x = np.zeros(data_src.shape)
-    warp_inv_y = np.zeros(data_src.shape)
-
-    # construct 3D warping matrix
-    for iz in z_nonzero:
-        print str(iz)+'/'+str(nz)+'..',
-        # get indices of x and y coordinates
-        row, col = np.indices((nx, ny))
-        # build 2xn array of coordinates in pixel space
-        coord_init_pix = np.array([row.ravel(), col.ravel(), np.array(np.ones(len(row.ravel())) * iz)]).T
-        # convert coordinates to physical space
-        coord_init_phy = np.array(im_src.transfo_pix2phys(coord_init_pix))
-        # get centermass coordinates in physical space
-        centermass_src_phy = im_src.transfo_pix2phys([[centermass_src[iz, :].T[0], centermass_src[iz, :].T[1], iz]])[0]
-        centermass_dest_phy = im_src.transfo_pix2phys([[centermass_dest[iz, :].T[0], centermass_dest[iz, :].T[1], iz]])[0]
-        # build rotation matrix
-        R = np.matrix(((cos(angle_src_dest[iz]), sin(angle_src_dest[iz])), (-sin(angle_src_dest[iz]), cos(angle_src_dest[iz]))))
-        # build 3D rotation matrix
-        R3d = np.eye(3)
-        R3d[0:2, 0:2] = R
-        # apply forward transformation (in physical space)
-        coord_forward_phy = np.array(np.dot((coord_init_phy - np.transpose(centermass_dest_phy)), R3d) + np.transpose(centermass_src_phy))
-        # apply inverse transformation (in physical space)
-        coord_inverse_phy = np.array(np.dot((coord_init_phy - np.transpose(centermass_src_phy)), R3d.T) + np.transpose(centermass_dest_phy))
-        # display rotations
-        if verbose == 2 and not angle_src_dest[iz] == 0:
-            # compute new coordinates
-            coord_src_rot = coord_src[iz] * R
-            coord_dest_rot = coord_dest[iz] * R.T
-            # generate figure
-            plt.figure('iz=' + str(iz) + ', angle_src_dest=' + str(angle_src_dest[iz]), figsize=(9, 9))
-            # plt.ion()  # enables interactive mode (allows keyboard interruption)
-            # plt.title('iz='+str(iz))
-            for isub in [221, 222, 223, 224]:
-                # plt.figure
-                plt.subplot(isub)
-                # ax = matplotlib.pyplot.axis()
-                if isub == 221:
-                    plt.scatter(coord_src[iz][:, 0], coord_src[iz][:, 1], s=5, marker='o', zorder=10, color='steelblue',
-                                alpha=0.5)
-                    pcaaxis = pca_src[iz].components_.T
-                    pca_eigenratio = pca_src[iz].explained_variance_ratio_
-                    plt.title('src')
-                elif isub == 222:
-                    plt.scatter(coord_src_rot[:, 0], coord_src_rot[:, 1], s=5, marker='o', zorder=10,
-                                color='steelblue',
-                                alpha=0.5)
-                    pcaaxis = pca_dest[iz].components_.T
-                    pca_eigenratio = pca_dest[iz].explained_variance_ratio_
-                    plt.title('src_rot')
-                elif isub == 223:
-                    plt.scatter(coord_dest[iz][:, 0], coord_dest[iz][:, 1], s=5, marker='o', zorder=10, color='red',
-                                alpha=0.5)
-                    pcaaxis = pca_dest[iz].components_.T
-                    pca_eigenratio = pca_dest[iz].explained_variance_ratio_
-                    plt.title('dest')
-                elif isub == 224:
-                    plt.scatter(coord_dest_rot[:, 0], coord_dest_rot[:, 1], s=5, marker='o', zorder=10, color='red',
-                                alpha=0.5)
-                    pcaaxis = pca_src[iz].components_.T
-                    pca_eigenratio = pca_src[iz].explained_variance_ratio_
-                    plt.title('dest_rot')
-                plt.text(-2.5, -2, 'eigenvectors:', horizontalalignment='left', verticalalignment='bottom')
-                plt.text(-2.5, -2.8, str(pcaaxis), horizontalalignment='left', verticalalignment='bottom')
-                plt.text(-2.5, 2.5, 'eigenval_ratio:', horizontalalignment='left', verticalalignment='bottom')
-                plt.text(-2.5, 2, str(pca_eigenratio), horizontalalignment='left', verticalalignment='bottom')
-                plt.plot([0, pcaaxis[0, 0]], [0, pcaaxis[1, 0]], linewidth=2, color='red')
-                plt.plot([0, pcaaxis[0, 1]], [0, pcaaxis[1, 1]], linewidth=2, color='orange')
-                plt.axis([-3, 3, -3, 3])
-                plt.gca().set_aspect('equal', adjustable='box')
-                # plt.axis('equal')
-            plt.savefig(path_qc + 'register2d_centermassrot_pca_z' + str(iz) + '.png')
-            plt.close()
-
-        # construct 3D warping matrix
-        warp_x[:, :, iz] = np.array([coord_forward_phy[i, 0] - coord_init_phy[i, 0] for i in xrange(nx * ny)]).reshape((nx, ny))
-        warp_y[:, :, iz] = np.array([coord_forward_phy[i, 1] - coord_init_phy[i, 1] for i in xrange(nx * ny)]).reshape((nx, ny))
-        warp_inv_x[:, :, iz] = np.array([coord_inverse_phy[i, 0] - coord_init_phy[i, 0] for i in xrange(nx * ny)]).reshape((nx, ny))
-        warp_inv_y[:, :, iz] = np.array([coord_inverse_phy[i, 1] - coord_init_phy[i, 1] for i in xrange(nx * ny)]).reshape((nx, ny))
+    # the forward transformation maps p to (p - centermass_dest) * R + centermass_src, and the inverse transformation maps p
+    # to (p - centermass_src) * R.T + centermass_dest (in physical space, with coordinates of the image source), hence the
+    # displacements below. Displacements are zero in ignored slices.
+    m_p2f = im_src.hdr.get_sform()
+    is_nonzero = np.zeros(nz, dtype=bool)
+    is_nonzero[z_nonzero] = True
+    iz = np.arange(nz)
+    centermass_src_phy = np.zeros((nz, 2))
+    centermass_dest_phy = np.zeros((nz, 2))
+    for i in range(2):
+        centermass_src_phy[:, i] = np.where(is_nonzero, m_p2f[i, 0] * centermass_src[:, 0] + m_p2f[i, 1] * centermass_src[:, 1] + m_p2f[i, 2] * iz + m_p2f[i, 3], 0)
+        centermass_dest_phy[:, i] = np.where(is_nonzero, m_p2f[i, 0] * centermass_dest[:, 0] + m_p2f[i, 1] * centermass_dest[:, 1] + m_p2f[i, 2] * iz + m_p2f[i, 3], 0)
+    cos_angle = np.cos(angle_src_dest).astype(np.float32)
+    sin_angle = np.sin(angle_src_dest).astype(np.float32)
+    warp_x, warp_y = rotation_displacement(m_p2f, data_dest.shape, centermass_dest_phy, centermass_src_phy, cos_angle, sin_angle)
+    warp_inv_x, warp_inv_y = rotation_displacement(m_p2f, data_src.shape, centermass_src_phy, centermass_dest_phy, cos_angle, -sin_angle)
+
+    # display rotations
+    if verbose == 2:
+        for iz in z_nonzero:
+            if not angle_src_dest[iz] == 0:
+                display_centermassrot(data_src[:, :, iz], data_dest[:, :, iz], angle_src_dest[iz], iz, path_qc)
 
     # Generate forward warping field (defined in destination space)
     generate_warping_field(fname_dest, warp_x, warp_y, fname_warp, verbose)
     generate_warping_field(fname_src, warp_inv_x, warp_inv_y, fname_warp_inv, verbose)
 
 
+def rotation_displacement(m_p2f, shape, centermass_from, centermass_to, cos_angle, sin_angle):
+    """
+    Displacement field (in physical space) of the slicewise rotations p -> (p - centermass_from) * R + centermass_to, with
+    R = [[cos, sin], [-sin, cos]], on all voxels of a 3d grid.
+    :param m_p2f: 4x4 matrix from pixel to physical coordinates
+    :param shape: shape of the grid (nx, ny, nz)
+    :param centermass_from: nz x 2 array: center of rotation of each slice (physical coordinates)
+    :param centermass_to: nz x 2 array: new position of the center of rotation of each slice (physical coordinates)
+    :param cos_angle, sin_angle: nz arrays: cosine and sine of the angle of rotation of each slice
+    :return: warp_x, warp_y: displacement along x and y, float32 arrays of shape (nx, ny, nz)
+    """
+    nx, ny, nz = shape[:3]
+    x = np.arange(nx, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    y = np.arange(ny, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    z = np.arange(nz)
+    # coordinates relative to the center of rotation
+    dx = m_p2f[0, 0] * x + m_p2f[0, 1] * y + (m_p2f[0, 2] * z + m_p2f[0, 3] - centermass_from[:, 0]).astype(np.float32)
+    dy = m_p2f[1, 0] * x + m_p2f[1, 1] * y + (m_p2f[1, 2] * z + m_p2f[1, 3] - centermass_from[:, 1]).astype(np.float32)
+    translation = (centermass_to - centermass_from).astype(np.float32)
+    warp_x = dx * (cos_angle - 1) - dy * sin_angle + translation[:, 0]
+    warp_y = dx * sin_angle + dy * (cos_angle - 1) + translation[:, 1]
+    return warp_x, warp_y
+
+
+def display_centermassrot(data2d_src, data2d_dest, angle_src_dest, iz, path_qc):
+    """
+    Display the PCA of source and destination slices, before and after rotation.
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # prevent display figure
+    import matplotlib.pyplot as plt
+    coord_src, pca_src, centermass_src = compute_pca(data2d_src)
+    coord_dest, pca_dest, centermass_dest = compute_pca(data2d_dest)
+    # build rotation matrix
+    R = np.matrix(((cos(angle_src_dest), sin(angle_src_dest)), (-sin(angle_src_dest), cos(angle_src_dest))))
+    # compute new coordinates
+    coord_src_rot = coord_src * R
+    coord_dest_rot = coord_dest * R.T
+    # generate figure
+    plt.figure('iz=' + str(iz) + ', angle_src_dest=' + str(angle_src_dest), figsize=(9, 9))
+    # plt.ion()  # enables interactive mode (allows keyboard interruption)
+    # plt.title('iz='+str(iz))
+    for isub in [221, 222, 223, 224]:
+        # plt.figure
+        plt.subplot(isub)
+        # ax = matplotlib.pyplot.axis()
+        if isub == 221:
+            plt.scatter(coord_src[:, 0], coord_src[:, 1], s=5, marker='o', zorder=10, color='steelblue',
+                        alpha=0.5)
+            pcaaxis = pca_src.components_.T
+            pca_eigenratio = pca_src.explained_variance_ratio_
+            plt.title('src')
+        elif isub == 222:
+            plt.scatter(coord_src_rot[:, 0], coord_src_rot[:, 1], s=5, marker='o', zorder=10,
+                        color='steelblue',
+                        alpha=0.5)
+            pcaaxis = pca_dest.components_.T
+            pca_eigenratio = pca_dest.explained_variance_ratio_
+            plt.title('src_rot')
+        elif isub == 223:
+            plt.scatter(coord_dest[:, 0], coord_dest[:, 1], s=5, marker='o', zorder=10, color='red',
+                        alpha=0.5)
+            pcaaxis = pca_dest.components_.T
+            pca_eigenratio = pca_dest.explained_variance_ratio_
+            plt.title('dest')
+        elif isub == 224:
+            plt.scatter(coord_dest_rot[:, 0], coord_dest_rot[:, 1], s=5, marker='o', zorder=10, color='red',
+                        alpha=0.5)
+            pcaaxis = pca_src.components_.T
+            pca_eigenratio = pca_src.explained_variance_ratio_
+            plt.title('dest_rot')
+        plt.text(-2.5, -2, 'eigenvectors:', horizontalalignment='left', verticalalignment='bottom')
+        plt.text(-2.5, -2.8, str(pcaaxis), horizontalalignment='left', verticalalignment='bottom')
+        plt.text(-2.5, 2.5, 'eigenval_ratio:', horizontalalignment='left', verticalalignment='bottom')
+        plt.text(-2.5, 2, str(pca_eigenratio), horizontalalignment='left', verticalalignment='bottom')
+        plt.plot([0, pcaaxis[0, 0]], [0, pcaaxis[1, 0]], linewidth=2, color='red')
+        plt.plot([0, pcaaxis[0, 1]], [0, pcaaxis[1, 1]], linewidth=2, color='orange')
+        plt.axis([-3, 3, -3, 3])
+        plt.gca().set_aspect('equal', adjustable='box')
+        # plt.axis('equal')
+    plt.savefig(path_qc + 'register2d_centermassrot_pca_z' + str(iz) + '.png')
+    plt.close()
+
+
 def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz', fname_warp_inv='warp_inverse.nii.gz', verbose=0, path_qc='./', smoothWarpXY=1):
     """
     Column-wise non-linear registration of segmentations. Based on an idea from Allan Martin.
     - Assumes src/dest are segmentations (not necessarily binary), and already registered by center of mass
     - Assumes src/dest are in RPI orientation.
-    - Split along Z, then for each slice:
+    - For each slice:
     - scale in R-L direction to match src/dest
     - loop across R-L columns and register by (i) matching center of mass and (ii) scaling.
     :param fname_src:
@@ -301,24 +297,11 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
     sct.printv('  matrix size: '+str(nx)+' x '+str(ny)+' x '+str(nz), verbose)
     sct.printv('  voxel size:  '+str(px)+'mm x '+str(py)+'mm x '+str(pz)+'mm', verbose)
 
-    # Split source volume along z
-    sct.printv('\nSplit input volume...', verbose)
-    from sct_image import split_data
-    im_src = Image('src.nii')
-    split_source_list = split_data(im_src, 2)
-    for im in split_source_list:
-        im.save()
-
-    # Split destination volume along z
-    sct.printv('\nSplit destination volume...', verbose)
-    im_dest = Image('dest.nii')
-    split_dest_list = split_data(im_dest, 2)
-    for im in split_dest_list:
-        im.save()
-
     # open image
-    data_src = im_src.data
-    data_dest = im_dest.data
+    im_src = Image(fname_src)
+    im_dest = Image(fname_dest)
+    data_src = np.copy(im_src.data)
+    data_dest = np.copy(im_dest.data)
 
     if len(data_src.shape) == 2:
         # reshape 2D data into pseudo 3D (only one slice)
@@ -329,29 +312,26 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
         data_dest = data_dest.reshape(new_shape)
 
     # initialize forward warping field (defined in destination space)
-    warp_x = np.zeros(data_dest.shape)
-    warp_y = np.zeros(data_dest.shape)
+    warp_x = np.zeros(data_dest.shape, dtype=np.float32)
+    warp_y = np.zeros(data_dest.shape, dtype=np.float32)
 
     # initialize inverse warping field (defined in source space)
-    warp_inv_x = np.zeros(data_src.shape)
-    warp_inv_y = np.zeros(data_src.shape)
+    warp_inv_x = np.zeros(data_src.shape, dtype=np.float32)
+    warp_inv_y = np.zeros(data_src.shape, dtype=np.float32)
+
+    # matrices from pixel to physical coordinates
+    m_p2f_src = im_src.hdr.get_sform()
+    m_p2f_dest = im_dest.hdr.get_sform()
+    # get indices of x and y coordinates
+    row, col = np.indices((nx, ny))
+    row = row.astype(float)
+    col = col.astype(float)
 
     # Loop across slices
     sct.printv('\nEstimate columnwise transformation...', verbose)
     for iz in range(0, nz):
         print str(iz)+'/'+str(nz)+'..',
 
-        # PREPARE COORDINATES
-        # ============================================================
-        # get indices of x and y coordinates
-        row, col = np.indices((nx, ny))
-        # build 2xn array of coordinates in pixel space
-        # ordering of indices is as follows:
-        # coord_init_pix[:, 0] = 0, 0, 0, ..., 1, 1, 1..., nx, nx, nx
-        # coord_init_pix[:, 1] = 0, 1, 2, ..., 0, 1, 2..., 0, 1, 2
-        coord_init_pix = np.array([row.ravel(), col.ravel(), np.array(np.ones(len(row.ravel())) * iz)]).T
-        # convert coordinates to physical space
-        coord_init_phy = np.array(im_src.transfo_pix2phys(coord_init_pix))
         # get 2d data from the selected slice
         src2d = data_src[:, :, iz]
         dest2d = data_dest[:, :, iz]
@@ -360,9 +340,6 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
         # threshold at 0.5
         src2d[src2d < th_nonzero] = 0
         dest2d[dest2d < th_nonzero] = 0
-        # get non-zero coordinates, and transpose to obtain nx2 dimensions
-        coord_src2d = np.array(np.where(src2d > 0)).T
-        coord_dest2d = np.array(np.where(dest2d > 0)).T
         # here we use 0.5 as threshold for non-zero value
         # coord_src2d = np.array(np.where(src2d > th_nonzero)).T
         # coord_dest2d = np.array(np.where(dest2d > th_nonzero)).T
@@ -394,71 +371,44 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
             # compute x-scaling factor
             Sx = (dest1d_max - dest1d_min + 1) / float(src1d_max - src1d_min + 1)
             # apply transformation to coordinates
-            coord_src2d_scaleX = np.copy(coord_src2d)  # need to use np.copy to avoid copying pointer
-            coord_src2d_scaleX[:, 0] = (coord_src2d[:, 0] - mean_src_x) * Sx + mean_dest_x
-            coord_init_pix_scaleX = np.copy(coord_init_pix)
-            coord_init_pix_scaleX[:, 0] = (coord_init_pix[:, 0] - mean_src_x) * Sx + mean_dest_x
-            coord_init_pix_scaleXinv = np.copy(coord_init_pix)
-            coord_init_pix_scaleXinv[:, 0] = (coord_init_pix[:, 0] - mean_dest_x) / float(Sx) + mean_src_x
+            row_scaleX = (row - mean_src_x) * Sx + mean_dest_x
+            row_scaleXinv = (row - mean_dest_x) / float(Sx) + mean_src_x
             # apply transformation to image
             from skimage.transform import warp
-            row_scaleXinv = np.reshape(coord_init_pix_scaleXinv[:, 0], [nx, ny])
             src2d_scaleX = warp(src2d, np.array([row_scaleXinv, col]), order=1)
 
             # ============================================================
             # COLUMN-WISE REGISTRATION (Y dimension for each Xi)
             # ============================================================
-            coord_init_pix_scaleY = np.copy(coord_init_pix)  # need to use np.copy to avoid copying pointer
-            coord_init_pix_scaleYinv = np.copy(coord_init_pix)  # need to use np.copy to avoid copying pointer
-            # coord_src2d_scaleXY = np.copy(coord_src2d_scaleX)  # need to use np.copy to avoid copying pointer
-            # loop across columns (X dimension)
-            for ix in xrange(nx):
-                # retrieve 1D signal along Y
-                src1d = src2d_scaleX[ix, :]
-                dest1d = dest2d[ix, :]
-                # make sure there are non-zero data in src or dest
-                if np.any(src1d>th_nonzero) and np.any(dest1d>th_nonzero):
-                    # retrieve min/max of non-zeros elements (edge of the segmentation)
-                    # src1d_min, src1d_max = min(np.nonzero(src1d)[0]), max(np.nonzero(src1d)[0])
-                    # dest1d_min, dest1d_max = min(np.nonzero(dest1d)[0]), max(np.nonzero(dest1d)[0])
-                    # 1D matching between src_y and dest_y
-                    # Ty = (dest1d_max + dest1d_min)/2 - (src1d_max + src1d_min)/2
-                    # Sy = (dest1d_max - dest1d_min) / float(src1d_max - src1d_min)
-                    # apply translation and scaling to coordinates in column
-                    # get indices (in continuous space) at half-maximum of upward and downward slope
-                    # src1d_min, src1d_max = find_index_halfmax(src1d)
-                    # dest1d_min, dest1d_max = find_index_halfmax(dest1d)
-                    src1d_min, src1d_max = np.min(np.where(src1d > th_nonzero)), np.max(np.where(src1d > th_nonzero))
-                    dest1d_min, dest1d_max = np.min(np.where(dest1d > th_nonzero)), np.max(np.where(dest1d > th_nonzero))
-                    # 1D matching between src_y and dest_y
-                    mean_dest_y = (dest1d_max + dest1d_min) / 2
-                    mean_src_y = (src1d_max + src1d_min) / 2
-                    # Tx = (dest1d_max + dest1d_min)/2 - (src1d_max + src1d_min)/2
-                    Sy = (dest1d_max - dest1d_min + 1) / float(src1d_max - src1d_min + 1)
-                    # apply forward transformation (in pixel space)
-                    # below: only for debugging purpose
-                    # coord_src2d_scaleX = np.copy(coord_src2d)  # need to use np.copy to avoid copying pointer
-                    # coord_src2d_scaleX[:, 0] = (coord_src2d[:, 0] - mean_src) * Sx + mean_dest
-                    # coord_init_pix_scaleY = np.copy(coord_init_pix)  # need to use np.copy to avoid copying pointer
-                    # coord_init_pix_scaleY[:, 0] = (coord_init_pix[:, 0] - mean_src ) * Sx + mean_dest
-                    range_x = range(ix * ny, ix * ny + nx)
-                    coord_init_pix_scaleY[range_x, 1] = (coord_init_pix[range_x, 1] - mean_src_y) * Sy + mean_dest_y
-                    coord_init_pix_scaleYinv[range_x, 1] = (coord_init_pix[range_x, 1] - mean_dest_y) / float(Sy) + mean_src_y
-            # apply transformation to image
-            col_scaleYinv = np.reshape(coord_init_pix_scaleYinv[:, 1], [nx, ny])
-            src2d_scaleXY = warp(src2d, np.array([row_scaleXinv, col_scaleYinv]), order=1)
+            # all columns (X dimension) at once
+            # retrieve 1D signal along Y
+            src1d = src2d_scaleX > th_nonzero
+            dest1d = dest2d > th_nonzero
+            # make sure there are non-zero data in src or dest
+            ind_x = np.flatnonzero(np.any(src1d, 1) & np.any(dest1d, 1))
+            # retrieve min/max of non-zeros elements (edge of the segmentation)
+            src1d_min, src1d_max = np.argmax(src1d[ind_x], 1), ny - 1 - np.argmax(src1d[ind_x, ::-1], 1)
+            dest1d_min, dest1d_max = np.argmax(dest1d[ind_x], 1), ny - 1 - np.argmax(dest1d[ind_x, ::-1], 1)
+            # 1D matching between src_y and dest_y
+            mean_dest_y = (dest1d_max + dest1d_min) // 2
+            mean_src_y = (src1d_max + src1d_min) // 2
+            Sy = (dest1d_max - dest1d_min + 1) / (src1d_max - src1d_min + 1).astype(float)
+            # apply forward transformation (in pixel space)
+            col_scaleY = np.copy(col)
+            col_scaleYinv = np.copy(col)
+            col_scaleY[ind_x] = (col[ind_x] - mean_src_y[:, np.newaxis]) * Sy[:, np.newaxis] + mean_dest_y[:, np.newaxis]
+            col_scaleYinv[ind_x] = (col[ind_x] - mean_dest_y[:, np.newaxis]) / Sy[:, np.newaxis] + mean_src_y[:, np.newaxis]
+            # center of the display along Y: last non-empty column (center of the image if there is none)
+            mean_dest_y_display = mean_dest_y[-1] if len(ind_x) else ny // 2
             # regularize Y warping fields
             from skimage.filters import gaussian
-            col_scaleY = np.reshape(coord_init_pix_scaleY[:, 1], [nx, ny])
             col_scaleYsmooth = gaussian(col_scaleY, smoothWarpXY)
             col_scaleYinvsmooth = gaussian(col_scaleYinv, smoothWarpXY)
-            # apply smoothed transformation to image
-            src2d_scaleXYsmooth = warp(src2d, np.array([row_scaleXinv, col_scaleYinvsmooth]), order=1)
-            # reshape warping field as 1d
-            coord_init_pix_scaleY[:, 1] = col_scaleYsmooth.ravel()
-            coord_init_pix_scaleYinv[:, 1] = col_scaleYinvsmooth.ravel()
             # display
             if verbose == 2:
+                # apply transformation and smoothed transformation to image
+                src2d_scaleXY = warp(src2d, np.array([row_scaleXinv, col_scaleYinv]), order=1)
+                src2d_scaleXYsmooth = warp(src2d, np.array([row_scaleXinv, col_scaleYinvsmooth]), order=1)
                 # FIG 1
                 plt.figure(figsize=(15, 3))
                 # plot #1
@@ -470,7 +420,7 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
                 plt.xlabel('x')
                 plt.ylabel('y')
                 plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+                plt.ylim(mean_dest_y_display - 15, mean_dest_y_display + 15)
                 ax.grid(True, color='w')
                 # plot #2
                 ax = plt.subplot(142)
@@ -481,7 +431,7 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
                 plt.xlabel('x')
                 plt.ylabel('y')
                 plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+                plt.ylim(mean_dest_y_display - 15, mean_dest_y_display + 15)
                 ax.grid(True, color='w')
                 # plot #3
                 ax = plt.subplot(143)
@@ -492,7 +442,7 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
                 plt.xlabel('x')
                 plt.ylabel('y')
                 plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+                plt.ylim(mean_dest_y_display - 15, mean_dest_y_display + 15)
                 ax.grid(True, color='w')
                 # plot #4
                 ax = plt.subplot(144)
@@ -503,7 +453,7 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
                 plt.xlabel('x')
                 plt.ylabel('y')
                 plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+                plt.ylim(mean_dest_y_display - 15, mean_dest_y_display + 15)
                 ax.grid(True, color='w')
                 # save figure
                 plt.savefig(path_qc + 'register2d_columnwise_image_z' + str(iz) + '.png')
@@ -512,18 +462,15 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
             # ============================================================
             # CALCULATE TRANSFORMATIONS
             # ============================================================
-            # calculate forward transformation (in physical space)
-            coord_init_phy_scaleX = np.array(im_dest.transfo_pix2phys(coord_init_pix_scaleX))
-            coord_init_phy_scaleY = np.array(im_dest.transfo_pix2phys(coord_init_pix_scaleY))
-            # calculate inverse transformation (in physical space)
-            coord_init_phy_scaleXinv = np.array(im_src.transfo_pix2phys(coord_init_pix_scaleXinv))
-            coord_init_phy_scaleYinv = np.array(im_src.transfo_pix2phys(coord_init_pix_scaleYinv))
+            # physical coordinates of the transformed pixels minus physical coordinates of the pixels (in source space)
+            coord_init_phy_x = m_p2f_src[0, 0] * row + m_p2f_src[0, 1] * col + m_p2f_src[0, 2] * iz + m_p2f_src[0, 3]
+            coord_init_phy_y = m_p2f_src[1, 0] * row + m_p2f_src[1, 1] * col + m_p2f_src[1, 2] * iz + m_p2f_src[1, 3]
             # compute displacement per pixel in destination space (for forward warping field)
-            warp_x[:, :, iz] = np.array([coord_init_phy_scaleXinv[i, 0] - coord_init_phy[i, 0] for i in xrange(nx*ny)]).reshape((nx, ny))
-            warp_y[:, :, iz] = np.array([coord_init_phy_scaleYinv[i, 1] - coord_init_phy[i, 1] for i in xrange(nx*ny)]).reshape((nx, ny))
+            warp_x[:, :, iz] = m_p2f_src[0, 0] * row_scaleXinv + m_p2f_src[0, 1] * col + m_p2f_src[0, 2] * iz + m_p2f_src[0, 3] - coord_init_phy_x
+            warp_y[:, :, iz] = m_p2f_src[1, 0] * row + m_p2f_src[1, 1] * col_scaleYinvsmooth + m_p2f_src[1, 2] * iz + m_p2f_src[1, 3] - coord_init_phy_y
             # compute displacement per pixel in source space (for inverse warping field)
-            warp_inv_x[:, :, iz] = np.array([coord_init_phy_scaleX[i, 0] - coord_init_phy[i, 0] for i in xrange(nx*ny)]).reshape((nx, ny))
-            warp_inv_y[:, :, iz] = np.array([coord_init_phy_scaleY[i, 1] - coord_init_phy[i, 1] for i in xrange(nx*ny)]).reshape((nx, ny))
+            warp_inv_x[:, :, iz] = m_p2f_dest[0, 0] * row_scaleX + m_p2f_dest[0, 1] * col + m_p2f_dest[0, 2] * iz + m_p2f_dest[0, 3] - coord_init_phy_x
+            warp_inv_y[:, :, iz] = m_p2f_dest[1, 0] * row + m_p2f_dest[1, 1] * col_scaleYsmooth + m_p2f_dest[1, 2] * iz + m_p2f_dest[1, 3] - coord_init_phy_y
 
     # Generate forward warping field (defined in destination space)
     generate_warping_field(fname_dest, warp_x, warp_y, fname_warp, verbose)
@@ -533,13 +480,14 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
 
 def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.nii.gz', fname_warp_inv='warp_inverse.nii.gz', paramreg=Paramreg(step='0', type='im', algo='Translation', metric='MI', iter='5', shrink='1', smooth='0', gradStep='0.5'),
                     ants_registration_params={'rigid': '', 'affine': '', 'compositeaffine': '', 'similarity': '', 'translation': '','bspline': ',10', 'gaussiandisplacementfield': ',3,0',
-                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, verbose=0):
+                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, cpu_number=1, verbose=0):
     """Slice-by-slice registration of two images.
 
-    We first split the 3D images into 2D images (and the mask if inputted). Then we register slices of the two images
-    that physically correspond to one another looking at the physical origin of each image. The images can be of
-    different sizes but the destination image must be smaller thant the input image. We do that using antsRegistration
-    in 2D. Once this has been done for each slices, we gather the results and return them.
+    We first split the 3D images into 2D images (and the mask if inputted), each slice in its own folder. Then we register
+    slices of the two images that physically correspond to one another looking at the physical origin of each image. The
+    images can be of different sizes but the destination image must be smaller thant the input image. We do that using
+    antsRegistration in 2D, running several slices in parallel if cpu_number > 1. Once this has been done for each slices,
+    we gather the results and return them.
     Algorithms implemented: translation, rigid, affine, syn and BsplineSyn.
     N.B.: If the mask is inputted, it must also be 3D and it must be in the same space as the destination image.
 
@@ -551,6 +499,7 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
         fname_warp_inv: name of output 3d inverse warping field
         paramreg[optional]: parameters of antsRegistration (type: Paramreg class from sct_register_multimodal)
         ants_registration_params[optional]: specific algorithm's parameters for antsRegistration (type: dictionary)
+        cpu_number[optional]: number of slices registered in parallel (type: int)
 
     output:
         if algo==translation:
@@ -577,27 +526,21 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
     sct.printv('.. matrix size: '+str(nx)+' x '+str(ny)+' x '+str(nz), verbose)
     sct.printv('.. voxel size:  '+str(px)+'mm x '+str(py)+'mm x '+str(pz)+'mm', verbose)
 
-    # Split input volume along z
-    sct.printv('\nSplit input volume...', verbose)
+    # Split volumes along z, each slice in its own folder, so that slices can be registered concurrently
+    sct.printv('\nSplit input, destination and mask volumes...', verbose)
     from sct_image import split_data
     im_src = Image('src.nii')
-    split_source_list = split_data(im_src, 2)
-    for im in split_source_list:
-        im.save()
-
-    # Split destination volume along z
-    sct.printv('\nSplit destination volume...', verbose)
     im_dest = Image('dest.nii')
-    split_dest_list = split_data(im_dest, 2)
-    for im in split_dest_list:
-        im.save()
-
-    # Split mask volume along z
+    list_path_slice = ['slice_'+numerotation(i)+'/' for i in range(nz)]
+    for path_slice in list_path_slice:
+        if not os.path.isdir(path_slice):
+            os.mkdir(path_slice)
+    list_split = [(split_data(im_src, 2), 'src.nii'), (split_data(im_dest, 2), 'dest.nii')]
     if fname_mask != '':
-        sct.printv('\nSplit mask volume...', verbose)
-        im_mask = Image('mask.nii.gz')
-        split_mask_list = split_data(im_mask, 2)
-        for im in split_mask_list:
+        list_split.append((split_data(Image('mask.nii.gz'), 2), 'mask.nii.gz'))
+    for split_list, fname_slice in list_split:
+        for path_slice, im in zip(list_path_slice, split_list):
+            im.setFileName(path_slice+fname_slice)
             im.save()
 
     # coord_origin_dest = im_dest.transfo_pix2phys([[0,0,0]])
@@ -605,24 +548,12 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
     # coord_diff_origin = (np.asarray(coord_origin_dest[0]) - np.asarray(coord_origin_input[0])).tolist()
     # [x_o, y_o, z_o] = [coord_diff_origin[0] * 1.0/px, coord_diff_origin[1] * 1.0/py, coord_diff_origin[2] * 1.0/pz]
 
-    # initialization
-    if paramreg.algo in ['Translation']:
-        x_displacement = [0 for i in range(nz)]
-        y_displacement = [0 for i in range(nz)]
-        theta_rotation = [0 for i in range(nz)]
-    if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-        list_warp = []
-        list_warp_inv = []
-
-    # loop across slices
-    for i in range(nz):
-        # set masking
-        sct.printv('Registering slice '+str(i)+'/'+str(nz-1)+'...', verbose)
-        num = numerotation(i)
-        prefix_warp2d = 'warp2d_'+num
+    # build registration commands
+    list_cmd = []
+    for path_slice in list_path_slice:
         # if mask is used, prepare command for ANTs
         if fname_mask != '':
-            masking = '-x mask_Z' +num+ '.nii.gz'
+            masking = '-x '+path_slice+'mask.nii.gz'
         else:
             masking = ''
         # main command for registration
@@ -630,55 +561,52 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
                '--dimensionality 2 '
                '--transform '+paramreg.algo+'['+str(paramreg.gradStep) +
                ants_registration_params[paramreg.algo.lower()]+'] '
-               '--metric '+paramreg.metric+'[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii' +',1,'+metricSize+'] '  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
+               '--metric '+paramreg.metric+'['+path_slice+'dest.nii,'+path_slice+'src.nii,1,'+metricSize+'] '  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
                '--convergence '+str(paramreg.iter)+' '
                '--shrink-factors '+str(paramreg.shrink)+' '
                '--smoothing-sigmas '+str(paramreg.smooth)+'mm '
-               '--output ['+prefix_warp2d+',src_Z'+ num +'_reg.nii] '    #--> file.mat (contains Tx,Ty, theta)
+               '--output ['+path_slice+'warp2d,'+path_slice+'src_reg.nii] '    #--> file.mat (contains Tx,Ty, theta)
                '--interpolation BSpline[3] '
                + masking)
         # add init translation
         if not paramreg.init == '':
             init_dict = {'geometric': '0', 'centermass': '1', 'origin': '2'}
-            cmd += ' -r [dest_Z'+num+'.nii'+',src_Z'+num+'.nii,'+init_dict[paramreg.init]+']'
-
-        try:
-            # run registration
-            sct.run(cmd)
-
-            if paramreg.algo in ['Translation']:
-                file_mat = prefix_warp2d+'0GenericAffine.mat'
-                matfile = loadmat(file_mat, struct_as_record=True)
-                array_transfo = matfile['AffineTransform_double_2_2']
-                x_displacement[i] = array_transfo[4][0]  # Tx in ITK'S coordinate system
-                y_displacement[i] = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
-                theta_rotation[i] = asin(array_transfo[2]) # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
-
-            if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-                # List names of 2d warping fields for subsequent merge along Z
-                file_warp2d = prefix_warp2d+'0Warp.nii.gz'
-                file_warp2d_inv = prefix_warp2d+'0InverseWarp.nii.gz'
-                list_warp.append(file_warp2d)
-                list_warp_inv.append(file_warp2d_inv)
-
-            if paramreg.algo in ['Rigid', 'Affine']:
-                # Generating null 2d warping field (for subsequent concatenation with affine transformation)
-                sct.run('isct_antsRegistration -d 2 -t SyN[1, 1, 1] -c 0 -m MI[dest_Z'+num+'.nii, src_Z'+num+'.nii, 1, 32] -o warp2d_null -f 1 -s 0')
-                # --> outputs: warp2d_null0Warp.nii.gz, warp2d_null0InverseWarp.nii.gz
-                file_mat = prefix_warp2d + '0GenericAffine.mat'
-                # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
-                sct.run('isct_ComposeMultiTransform 2 ' + file_warp2d + ' -R dest_Z'+num+'.nii warp2d_null0Warp.nii.gz ' + file_mat)
-                sct.run('isct_ComposeMultiTransform 2 ' + file_warp2d_inv + ' -R src_Z'+num+'.nii warp2d_null0InverseWarp.nii.gz -i ' + file_mat)
-
-        # if an exception occurs with ants, take the last value for the transformation
-        # TODO: DO WE NEED TO DO THAT??? (julien 2016-03-01)
-        except Exception, e:
-            sct.printv('ERROR: Exception occurred.\n'+str(e), 1, 'error')
+            cmd += ' -r ['+path_slice+'dest.nii,'+path_slice+'src.nii,'+init_dict[paramreg.init]+']'
+        list_cmd.append(cmd)
+
+    # run registrations
+    # TODO: DO WE NEED TO EXIT IF ONE SLICE FAILS??? (julien 2016-03-01)
+    try:
+        if cpu_number > 1 and nz > 1:
+            # registrations are run by external programs, hence threads are enough to run them in parallel
+            from multiprocessing.pool import ThreadPool
+            sct.printv('Registering '+str(nz)+' slices using '+str(cpu_number)+' parallel processes...', verbose)
+            pool = ThreadPool(processes=cpu_number)
+            try:
+                pool.map(run_registration2d, list_cmd)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for i, cmd in enumerate(list_cmd):
+                sct.printv('Registering slice '+str(i)+'/'+str(nz-1)+'...', verbose)
+                run_registration2d(cmd)
+    except Exception, e:
+        sct.printv('ERROR: Exception occurred.\n'+str(e), 1, 'error')
 
     # Merge warping field along z
     sct.printv('\nMerge warping fields along z...', verbose)
 
     if paramreg.algo in ['Translation']:
+        x_displacement = [0 for i in range(nz)]
+        y_displacement = [0 for i in range(nz)]
+        theta_rotation = [0 for i in range(nz)]
+        for i, path_slice in enumerate(list_path_slice):
+            matfile = loadmat(path_slice+'warp2d0GenericAffine.mat', struct_as_record=True)
+            array_transfo = matfile['AffineTransform_double_2_2']
+            x_displacement[i] = array_transfo[4][0]  # Tx in ITK'S coordinate system
+            y_displacement[i] = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
+            theta_rotation[i] = asin(array_transfo[2]) # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
         # convert to array
         x_disp_a = np.asarray(x_displacement)
         y_disp_a = np.asarray(y_displacement)
@@ -690,11 +618,58 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
 
     if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
         from sct_image import concat_warp2d
+        if paramreg.algo in ['Rigid', 'Affine']:
+            # 2d warping fields of the affine transformations, sampled on the destination (forward) and source (inverse) grids
+            list_warp = [affine_to_warp2d(path_slice+'warp2d0GenericAffine.mat', im_dest) for path_slice in list_path_slice]
+            list_warp_inv = [affine_to_warp2d(path_slice+'warp2d0GenericAffine.mat', im_src, inverse=True) for path_slice in list_path_slice]
+        else:
+            # List names of 2d warping fields for subsequent merge along Z
+            list_warp = [path_slice+'warp2d0Warp.nii.gz' for path_slice in list_path_slice]
+            list_warp_inv = [path_slice+'warp2d0InverseWarp.nii.gz' for path_slice in list_path_slice]
         # concatenate 2d warping fields along z
         concat_warp2d(list_warp, fname_warp, 'dest.nii')
         concat_warp2d(list_warp_inv, fname_warp_inv, 'src.nii')
 
 
+def run_registration2d(cmd):
+    """
+    Run one slice registration. Raise an exception if it fails, so that errors in parallel processes are caught by the
+    caller.
+    """
+    sct.run(cmd, error_exit='warning', raise_exception=True)
+
+
+def affine_to_warp2d(file_mat, im, inverse=False):
+    """
+    Generate the 2d warping field of an affine transformation estimated by antsRegistration in 2d, on the grid of the
+    slices of an image. This gives the same field as composing the affine transformation with a null warping field using
+    isct_ComposeMultiTransform.
+    :param file_mat: affine transformation (file *GenericAffine.mat)
+    :param im: Image used as reference grid (destination image for the forward field, source image for the inverse field)
+    :param inverse: if True, generate the field of the inverse transformation
+    :return: 2d warping field (ITK convention: displacements in LPS coordinates), shape (nx, ny, 1, 1, 2)
+    """
+    matfile = loadmat(file_mat, struct_as_record=True)
+    name_transfo = [key for key in matfile if key.startswith('AffineTransform') or key.startswith('MatrixOffsetTransformBase')][0]
+    params_transfo = matfile[name_transfo].flatten()
+    matrix = params_transfo[:4].reshape(2, 2)
+    translation = params_transfo[4:6]
+    center = matfile['fixed'].flatten()[:2]
+    # physical coordinates of the voxels of one slice (2d slices keep the in-plane geometry of the 3d image), in LPS
+    nx, ny = im.data.shape[:2]
+    affine = im.hdr.get_best_affine()
+    coord_pix = np.mgrid[0:nx, 0:ny].astype(np.float64)
+    coord_phys = -(np.tensordot(affine[:2, :2], coord_pix, axes=1) + affine[:2, 3, np.newaxis, np.newaxis])
+    # ITK affine transformation: T(p) = matrix * (p - center) + center + translation
+    coord_centered = coord_phys - center[:, np.newaxis, np.newaxis]
+    if inverse:
+        coord_transfo = np.tensordot(np.linalg.inv(matrix), coord_centered - translation[:, np.newaxis, np.newaxis], axes=1)
+    else:
+        coord_transfo = np.tensordot(matrix, coord_centered, axes=1) + translation[:, np.newaxis, np.newaxis]
+    warp2d = np.zeros((nx, ny, 1, 1, 2))
+    warp2d[:, :, 0, 0, :] = np.rollaxis(coord_transfo - coord_centered, 0, 3)
+    return warp2d
+
 
 def numerotation(nb):
     """Indexation of number for matching fslsplit's index.
@@ -863,6 +838,65 @@ def compute_pca(data2d):
     return coordsrc, pca, centermass
 
 
+def compute_pca_slicewise(data3d):
+    """
+    Compute the center of mass and the PCA of the non-zero values of each slice of a 3d array, for all slices at once.
+    Gives the same results as compute_pca applied to each slice.
+    :param data3d: 3d array. PCA will be computed slice-by-slice (along z) on non-zeros values.
+    :return:
+        centermass: nz x 2 array: 2d coordinates of the center of mass of each slice
+        eigenvector: nz x 2 array: first eigenvector of each slice (same sign as the first component of sklearn's PCA)
+        eigenratio: nz array: ratio between the first and the second eigenvalues of each slice
+        valid: nz array: False for slices with less than two non-zero pixels (PCA cannot be computed)
+    """
+    nz = data3d.shape[2]
+    # round it and make it int (otherwise end up with values like 10-7)
+    # get non-zero coordinates of all slices, ordered by slice as with compute_pca
+    x, y, z = np.nonzero(data3d.round().astype(int))
+    order = np.argsort(z, kind='mergesort')
+    x, y, z = x[order], y[order], z[order]
+    count = np.bincount(z, minlength=nz).astype(float)
+    valid = count >= 2
+    count[count == 0] = 1
+    # get center of mass
+    centermass = np.array([np.bincount(z, x, minlength=nz), np.bincount(z, y, minlength=nz)]).T / count[:, np.newaxis]
+    # center data
+    x_centered = x - centermass[z, 0]
+    y_centered = y - centermass[z, 1]
+    # 2x2 covariance matrices and their eigen-decomposition (eigenvalues in ascending order)
+    cov = np.zeros((nz, 2, 2))
+    cov[:, 0, 0] = np.bincount(z, x_centered * x_centered, minlength=nz)
+    cov[:, 0, 1] = cov[:, 1, 0] = np.bincount(z, x_centered * y_centered, minlength=nz)
+    cov[:, 1, 1] = np.bincount(z, y_centered * y_centered, minlength=nz)
+    eigenval, eigenvec = np.linalg.eigh(cov)
+    eigenval = np.maximum(eigenval, 0)
+    eigenvector = eigenvec[:, :, 1]
+    # sign convention of sklearn's PCA (svd_flip): the projection with the largest absolute value is positive (if several
+    # projections have the same absolute value, e.g. for symmetric shapes, the first one is used)
+    if len(z):
+        proj = x_centered * eigenvector[z, 0] + y_centered * eigenvector[z, 1]
+        order = np.lexsort((-np.round(np.abs(proj), 9), z))
+        ind_first = order[np.minimum(np.searchsorted(z[order], np.arange(nz)), len(z) - 1)]
+        eigenvector[proj[ind_first] < 0] *= -1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eigenratio = eigenval[:, 1] / eigenval[:, 0]
+    return centermass, eigenvector, eigenratio, valid
+
+
+def angle_between_slicewise(a, b):
+    """
+    compute angles in radian between rows of a and rows of b (see angle_between).
+    :param a: n x 2 array
+    :param b: n x 2 array
+    :return: n array
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arccosInput = np.sum(a * b, 1) / np.linalg.norm(a, axis=1) / np.linalg.norm(b, axis=1)
+    arccosInput = np.clip(np.nan_to_num(arccosInput), -1.0, 1.0)
+    sign_angle = np.sign(a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0])
+    return sign_angle * np.arccos(arccosInput)
+
+
 
 def find_index_halfmax(data1d):
     """
@@ -130,41 +130,31 @@ class Centerline:
     When initialized, the lenght of the centerline is computed as well as the coordinate reference system of each plane.
     """
     def __init__(self, points_x, points_y, points_z, deriv_x, deriv_y, deriv_z):
-        from math import sqrt
-        #self.points = []
-        self.derivatives = []
         self.length = 0.0
         self.progressive_length = [0.0]
         self.progressive_length_inverse = [0.0]
 
-        self.points = array(zip(points_x, points_y, points_z))
-        self.derivatives = array(zip(deriv_x, deriv_y, deriv_z))
+        self.points = np.column_stack((points_x, points_y, points_z)).astype(float)
+        self.derivatives = np.column_stack((deriv_x, deriv_y, deriv_z)).astype(float)
         self.number_of_points = len(self.points)
 
         self.compute_length(points_x, points_y, points_z)
 
-        self.coordinate_system = [self.compute_coordinate_system(index) for index in range(0, self.number_of_points)]
-        self.plans_parameters = [self.get_plan_parameters(index) for index in range(0, self.number_of_points)]
-
-        self.matrices = stack([item[4] for item in self.coordinate_system])
-        self.inverse_matrices = stack([item[5] for item in self.coordinate_system])
-        self.offset_plans = array([item[3] for item in self.plans_parameters])
+        # all frames are computed at once and only kept as stacked arrays (see compute_coordinate_systems)
+        self.matrices, self.inverse_matrices = self.compute_coordinate_systems()
+        self.plans_parameters = self.compute_plans_parameters()
+        self.offset_plans = self.plans_parameters[:, 3]
 
         from scipy.spatial import cKDTree
-        self.tree_points = cKDTree(dstack([points_x, points_y, points_z])[0])
+        self.tree_points = cKDTree(self.points)
 
     def compute_length(self, points_x, points_y, points_z):
-        for i in range(0, self.number_of_points - 1):
-            distance = sqrt((points_x[i] - points_x[i + 1]) ** 2 +
-                            (points_y[i] - points_y[i + 1]) ** 2 +
-                            (points_z[i] - points_z[i + 1]) ** 2)
-            self.length += distance
-            self.progressive_length.append(distance)
-        for i in range(self.number_of_points-1, 0, -1):
-            distance = sqrt((points_x[i] - points_x[i - 1]) ** 2 +
-                            (points_y[i] - points_y[i - 1]) ** 2 +
-                            (points_z[i] - points_z[i - 1]) ** 2)
-            self.progressive_length_inverse.append(distance)
+        if self.number_of_points < 2:
+            return
+        distances = norm(np.diff(self.points, axis=0), axis=1)
+        self.length = float(np.sum(distances))
+        self.progressive_length = [0.0] + distances.tolist()
+        self.progressive_length_inverse = [0.0] + distances[::-1].tolist()
 
     def find_nearest_index(self, coord):
         """
@@ -211,6 +201,14 @@ class Centerline:
 
         return [a, b, c, d]
 
+    def compute_plans_parameters(self):
+        """
+        This function returns the parameters of the parametric equations of the planes at all points of the centerline.
+        :return: numpy array (number_of_points, 4), each row being [a, b, c, d] (see get_plan_parameters)
+        """
+        offsets = - einsum('ij,ij->i', self.derivatives, self.points)
+        return np.column_stack((self.derivatives, offsets))
+
     def get_distance_from_plane(self, coord, index, plane_params=None):
         """
         This function returns the distance between a coordinate and the plan at index position.
@@ -221,7 +219,7 @@ class Centerline:
         from index.
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -244,7 +242,7 @@ class Centerline:
         """
         if index is None:
             index = self.find_nearest_index(coord)
-        plane_params = self.plans_parameters[index]
+        plane_params = self.plans_parameters[index].tolist()
         distance = self.get_distance_from_plane(coord, index, plane_params=plane_params)
 
         return index, plane_params, distance
@@ -257,25 +255,34 @@ class Centerline:
         """
         if 0 <= index < self.number_of_points:
             origin = self.points[index]
-            z_prime_axis = self.derivatives[index]
-            z_prime_axis /= norm(z_prime_axis)
-            y_axis = array([0, 1, 0])
-            y_prime_axis = (y_axis - dot(y_axis, z_prime_axis) * z_prime_axis)
-            y_prime_axis /= norm(y_prime_axis)
-            x_prime_axis = cross(y_prime_axis, z_prime_axis)
-            x_prime_axis /= norm(x_prime_axis)
-
-            matrix_base = array([[x_prime_axis[0], y_prime_axis[0], z_prime_axis[0]],
-                                 [x_prime_axis[1], y_prime_axis[1], z_prime_axis[1]],
-                                 [x_prime_axis[2], y_prime_axis[2], z_prime_axis[2]]])
-
-            inverse_matrix = inv(matrix_base)
+            matrix_base = self.matrices[index]
+            inverse_matrix = self.inverse_matrices[index]
+            x_prime_axis, y_prime_axis, z_prime_axis = matrix_base[:, 0], matrix_base[:, 1], matrix_base[:, 2]
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
 
         return origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix
 
+    def compute_coordinate_systems(self):
+        """
+        This function computes the coordinate reference systems (X, Y, and Z axes) of all points of the centerline.
+        Derivatives are normalized in place, as they are used afterwards as plane normals.
+        The frames are orthonormal, so their inverses are their transposes.
+        :return: matrices (number_of_points, 3, 3) whose columns are the X, Y and Z axes, and their inverses
+        """
+        z_prime_axis = self.derivatives
+        z_prime_axis /= norm(z_prime_axis, axis=1)[:, np.newaxis]
+        y_prime_axis = - z_prime_axis[:, 1:2] * z_prime_axis
+        y_prime_axis[:, 1] += 1.0
+        y_prime_axis /= norm(y_prime_axis, axis=1)[:, np.newaxis]
+        x_prime_axis = cross(y_prime_axis, z_prime_axis)
+        x_prime_axis /= norm(x_prime_axis, axis=1)[:, np.newaxis]
+
+        matrices = stack([x_prime_axis, y_prime_axis, z_prime_axis], axis=2)
+        inverse_matrices = np.ascontiguousarray(matrices.transpose((0, 2, 1)))
+        return matrices, inverse_matrices
+
     def get_projected_coordinates_on_plane(self, coord, index, plane_params=None):
         """
         This function returns the coordinates of
@@ -284,7 +291,7 @@ class Centerline:
         :param plane_params:
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -304,8 +311,7 @@ class Centerline:
         :return:
         """
         if 0 <= index < self.number_of_points:
-            origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix = self.coordinate_system[index]
-            return inverse_matrix.dot(coord - origin)
+            return self.inverse_matrices[index].dot(coord - self.points[index])
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
@@ -19,6 +19,9 @@ import os
 import getopt
 import commands
 import time
+import numpy as np
+from scipy.io import loadmat
+from scipy.ndimage import map_coordinates, spline_filter
 from msct_parser import Parser
 import sct_utils as sct
 from sct_crop_image import ImageCropper
@@ -35,7 +38,7 @@ class Param:
 def get_parser():
     # parser initialisation
     parser = Parser(__file__)
-    parser.usage.set_description('Apply transformations. This function is a wrapper for antsApplyTransforms (ANTs).')
+    parser.usage.set_description('Apply transformations. Displacement fields and affine transformations written by ANTs are applied with the same conventions as antsApplyTransforms (ANTs), which is called for other transformations.')
     parser.add_option(name="-i",
                       type_value="file",
                       description="input image",
@@ -90,6 +93,250 @@ def get_parser():
     return parser
 
 
+# order of the spline used by the resampling for each interpolation method
+interp_order = {'nn': 0, 'linear': 1, 'spline': 3}
+
+
+def read_affine_itk(fname_affine):
+    """
+    Read a 3d affine transformation written by ITK/ANTs
+    :param fname_affine: binary file (.mat, e.g. *GenericAffine.mat) or text file (.txt)
+    :return: matrix (3x3), translation and center of the transformation, following the ITK convention:
+    T(p) = matrix * (p - center) + center + translation, where p is a point in physical coordinates (LPS). Return None if
+    the file does not contain one single 3d affine transformation.
+    """
+    if fname_affine.endswith('.mat'):
+        matfile = loadmat(fname_affine, struct_as_record=True)
+        names_transfo = [key for key in matfile if key.startswith(('AffineTransform', 'MatrixOffsetTransformBase')) and key.endswith('_3_3')]
+        if len(names_transfo) != 1 or 'fixed' not in matfile:
+            return None
+        params_transfo = matfile[names_transfo[0]].flatten()
+        params_fixed = matfile['fixed'].flatten()
+    else:
+        names_transfo, params_transfo, params_fixed = [], [], []
+        for line in open(fname_affine):
+            name, sep, value = line.partition(':')
+            if name == 'Transform':
+                names_transfo.append(value.strip())
+            elif name == 'Parameters':
+                params_transfo = [float(x) for x in value.split()]
+            elif name == 'FixedParameters':
+                params_fixed = [float(x) for x in value.split()]
+        if len(names_transfo) != 1 or not names_transfo[0].startswith(('AffineTransform', 'MatrixOffsetTransformBase')):
+            return None
+    if len(params_transfo) != 12 or len(params_fixed) != 3:
+        return None
+    params_transfo = np.asarray(params_transfo, dtype=np.float64)
+    return params_transfo[:9].reshape(3, 3), params_transfo[9:], np.asarray(params_fixed, dtype=np.float64)
+
+
+def lps_affine(im):
+    """
+    :return: affine transformation from the voxel coordinates of an image to the physical coordinates used by ITK (LPS)
+    """
+    return np.dot(np.diag([-1, -1, 1, 1]), im.hdr.get_best_affine())
+
+
+def apply_affine(affine, coord):
+    """
+    :param affine: 4x4 affine transformation
+    :param coord: coordinates, shape (3, n)
+    :return: transformed coordinates, shape (3, n)
+    """
+    return np.dot(affine[:3, :3], coord) + affine[:3, 3, np.newaxis]
+
+
+def inside_grid(coord_pix, shape):
+    """
+    Points inside an image grid, using the same half-voxel tolerance as ITK interpolators
+    :param coord_pix: voxel coordinates, shape (3, n)
+    :param shape: shape of the image grid
+    :return: boolean array of shape (n,)
+    """
+    shape = np.asarray(shape[:3])[:, np.newaxis]
+    return np.all((coord_pix >= -0.5) & (coord_pix < shape - 0.5), axis=0)
+
+
+class DisplacementFieldITK:
+    """
+    Displacement field written by ITK/ANTs (e.g. warp_*.nii.gz): the image has shape (nx, ny, nz, 1, 3) and the
+    displacements are in physical coordinates (LPS). Points outside of the field are not moved, as in ITK.
+    """
+    def __init__(self, warp):
+        """
+        :param warp: file name, or Image (e.g., a field concatenated in memory by sct_concat_transfo)
+        """
+        from msct_image import Image
+        im_warp = warp if isinstance(warp, Image) else Image(warp, mmap=True)
+        data_warp = im_warp.data.reshape(im_warp.data.shape[:3] + (-1,))
+        # contiguous copy of each component, as the interpolation works on one component at a time
+        self.components = [np.ascontiguousarray(data_warp[..., i], dtype=np.float32) for i in range(3)]
+        self.shape = data_warp.shape[:3]
+        self.affine_phys2pix = np.linalg.inv(lps_affine(im_warp))
+
+    def transform_points(self, coord):
+        coord_pix = apply_affine(self.affine_phys2pix, coord)
+        inside = inside_grid(coord_pix, self.shape)
+        coord_pix = coord_pix[:, inside]
+        for i in range(3):
+            coord[i, inside] += map_coordinates(self.components[i], coord_pix, order=1, mode='nearest')
+        return coord
+
+
+class AffineITK:
+    """
+    Affine transformation written by ITK/ANTs (see read_affine_itk)
+    """
+    def __init__(self, matrix, translation, center, inverse=False):
+        # T(p) = matrix * p + offset
+        affine = np.eye(4)
+        affine[:3, :3] = matrix
+        affine[:3, 3] = center + translation - np.dot(matrix, center)
+        self.affine = np.linalg.inv(affine) if inverse else affine
+
+    def transform_points(self, coord):
+        return apply_affine(self.affine, coord)
+
+
+def read_transfo_list(fname_warp_list, use_inverse):
+    """
+    Read a list of transformations to be applied to the points of the destination image
+    :param fname_warp_list: warping fields and affine transformations, in the order of the -w flag. Warping fields can
+    also be given as Image objects.
+    :param use_inverse: for each transformation, '-i ' to use its inverse, '' otherwise
+    :return: list of transformations in the order in which they are applied to the points of the destination image,
+    i.e., the reverse order of the -w flag (the -w flag lists the transformations in the order in which they are applied
+    to the image, e.g. A->B,B->C: a point of C goes through B->C first). None if one of them cannot be applied without
+    isct_antsApplyTransforms.
+    """
+    list_transfo = []
+    for fname_warp, inverse in zip(fname_warp_list, use_inverse):
+        if not isinstance(fname_warp, str):
+            ext_warp = '.nii'
+        else:
+            ext_warp = sct.extract_fname(fname_warp)[2]
+        if ext_warp in ['.txt', '.mat']:
+            params_affine = read_affine_itk(fname_warp)
+            if params_affine is None:
+                return None
+            list_transfo.append(AffineITK(*params_affine, inverse=bool(inverse)))
+        elif ext_warp in ['.nii', '.nii.gz'] and not inverse:
+            list_transfo.append(DisplacementFieldITK(fname_warp))
+        else:
+            return None
+    # same order as the list given to isct_antsApplyTransforms
+    return list_transfo[::-1]
+
+
+def transform_grid(affine_pix2phys, nx, ny, z_start, z_end, list_transfo):
+    """
+    Apply a list of transformations to the voxels of slices z_start to z_end-1 of an image grid
+    :param affine_pix2phys: affine transformation from voxel to physical coordinates of the grid (see lps_affine)
+    :param list_transfo: transformations, in the order in which they are applied to the points (see read_transfo_list)
+    :return: physical coordinates (LPS) of the voxels and of the transformed voxels, shape (3, n)
+    """
+    coord = np.mgrid[0:nx, 0:ny, z_start:z_end].reshape(3, -1).astype(np.float64)
+    coord = apply_affine(affine_pix2phys, coord)
+    coord_transfo = coord.copy()
+    for transfo in list_transfo:
+        coord_transfo = transfo.transform_points(coord_transfo)
+    return coord, coord_transfo
+
+
+def sampling_grid(im_dest, list_transfo, chunk_size=2**21, verbose=1):
+    """
+    Generate the sampling grid of a list of transformations, by chunks of slices of the destination image to limit
+    memory usage
+    :param im_dest: destination image, which defines the output grid
+    :param list_transfo: transformations, in the order in which they are applied to the points (see read_transfo_list)
+    :param chunk_size: maximum number of voxels of the destination image processed at once
+    :return: generator of (z_start, z_end, coord), where coord are the physical coordinates (LPS) of the transformed
+    voxels of slices z_start to z_end-1, shape (3, n)
+    """
+    nx, ny, nz = im_dest.data.shape[:3]
+    affine_dest_pix2phys = lps_affine(im_dest)
+    nz_chunk = max(1, chunk_size // (nx * ny))
+    for z_start in range(0, nz, nz_chunk):
+        z_end = min(nz, z_start + nz_chunk)
+        sct.printv('  Slices '+str(z_start)+' to '+str(z_end-1)+'/'+str(nz-1)+'...', verbose)
+        yield z_start, z_end, transform_grid(affine_dest_pix2phys, nx, ny, z_start, z_end, list_transfo)[1]
+
+
+def resample_image(fname_src, im_dest, fname_out, grid, interp='spline', verbose=1):
+    """
+    Interpolate all volumes of a 3d or 4d image on a sampling grid
+    :param fname_src: source image (3d or 4d)
+    :param im_dest: destination image, which defines the output grid
+    :param fname_out: output image (float32)
+    :param grid: chunks of the sampling grid (see sampling_grid)
+    :param interp: 'nn', 'linear' or 'spline'
+    """
+    from msct_image import Image
+    im_src = Image(fname_src, mmap=True)
+    order = interp_order[interp]
+    data_src = im_src.data
+    shape_src = data_src.shape[:3]
+    data_src = data_src.reshape(shape_src + (-1,))
+    nt = data_src.shape[3]
+    # the spline coefficients of each volume are computed once, and not for each chunk
+    if order > 1:
+        data_src = np.stack([spline_filter(data_src[..., it], order, output=np.float32) for it in range(nt)], axis=3)
+    nx, ny, nz = im_dest.data.shape[:3]
+    data_out = np.zeros((nx, ny, nz, nt), dtype=np.float32)
+
+    affine_src_phys2pix = np.linalg.inv(lps_affine(im_src))
+    for z_start, z_end, coord in grid:
+        coord = apply_affine(affine_src_phys2pix, coord)
+        inside = inside_grid(coord, shape_src)
+        coord = coord[:, inside]
+        values = np.zeros(inside.shape, dtype=np.float32)
+        for it in range(nt):
+            values[inside] = map_coordinates(data_src[..., it], coord, order=order, mode='nearest', prefilter=False, output=np.float32)
+            data_out[:, :, z_start:z_end, it] = values.reshape(nx, ny, z_end - z_start)
+
+    hdr_out = im_dest.hdr.copy()
+    hdr_out.set_data_dtype(np.float32)
+    im_out = Image(data_out, hdr=hdr_out, orientation=im_dest.orientation, absolutepath=fname_out)
+    im_out.save(verbose=verbose)
+
+
+def resample_transfo(fname_src, fname_dest, fname_out, list_transfo, interp='spline', chunk_size=2**21, verbose=1):
+    """
+    Apply a list of transformations to a 3d or 4d image, as isct_antsApplyTransforms: the sampling grid (position of
+    each voxel of the destination image in the source image) is computed once, by chunks of slices of the destination
+    image to limit memory usage, and all volumes of the source image are interpolated on it.
+    :param fname_src: source image (3d or 4d)
+    :param fname_dest: destination image, which defines the output grid
+    :param fname_out: output image (float32)
+    :param list_transfo: transformations, in the order in which they are applied to the points (see read_transfo_list)
+    :param interp: 'nn', 'linear' or 'spline'
+    :param chunk_size: maximum number of voxels of the destination image processed at once
+    """
+    from msct_image import Image
+    im_dest = Image(fname_dest, mmap=True)
+    resample_image(fname_src, im_dest, fname_out, sampling_grid(im_dest, list_transfo, chunk_size, verbose), interp=interp, verbose=verbose)
+
+
+def resample_transfo_batch(list_fname_src, fname_dest, list_fname_out, list_transfo, list_interp, chunk_size=2**21, verbose=1):
+    """
+    Apply the same list of transformations to several images (e.g., all the files of a template): the sampling grid is
+    computed once and kept in memory, and the images are loaded and resampled one at a time.
+    :param list_fname_src: source images (3d or 4d), which can be defined on different grids
+    :param fname_dest: destination image, which defines the output grid
+    :param list_fname_out: output images (float32)
+    :param list_transfo: transformations, in the order in which they are applied to the points (see read_transfo_list)
+    :param list_interp: interpolation of each source image: 'nn', 'linear' or 'spline'
+    :param chunk_size: maximum number of voxels of the destination image processed at once
+    """
+    from msct_image import Image
+    im_dest = Image(fname_dest, mmap=True)
+    sct.printv('Compute sampling grid...', verbose)
+    grid = list(sampling_grid(im_dest, list_transfo, chunk_size, verbose))
+    for fname_src, fname_out, interp in zip(list_fname_src, list_fname_out, list_interp):
+        sct.printv('  '+fname_src+' -> '+fname_out+' ('+interp+')', verbose)
+        resample_image(fname_src, im_dest, fname_out, grid, interp=interp, verbose=verbose)
+
+
 class Transform:
     def __init__(self, input_filename, warp, fname_dest, output_filename='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0):
         self.input_filename = input_filename
@@ -160,12 +407,21 @@ class Transform:
         # Get dimensions of data
         sct.printv('\nGet dimensions of data...', verbose)
         from msct_image import Image
-        nx, ny, nz, nt, px, py, pz, pt = Image(fname_src).dim
+        nx, ny, nz, nt, px, py, pz, pt = Image(fname_src, mmap=True).dim
         # nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_src)
         sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz)+ ' x ' + str(nt), verbose)
 
+        # apply the transformations in python when all of them can be read (displacement fields and affine
+        # transformations): the sampling grid is computed once for all volumes
+        list_transfo = None
+        if self.interp in interp_order:
+            list_transfo = read_transfo_list(fname_warp_list, use_inverse)
+        if list_transfo is not None:
+            sct.printv('\nApply transformation...', verbose)
+            resample_transfo(fname_src, fname_dest, fname_out, list_transfo, interp=self.interp, verbose=verbose)
+
         # if 3d
-        if nt == 1:
+        elif nt == 1:
             # Apply transformation
             sct.printv('\nApply transformation...', verbose)
             # print 'HOLA1'
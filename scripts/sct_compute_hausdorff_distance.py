@@ -29,6 +29,7 @@ class Param:
     def __init__(self):
         self.debug = 0
         self.thinning = True
+        self.save_thinned = True  # save the thinned images in the current folder
         self.verbose = 1
 
 
@@ -47,90 +48,65 @@ class Thinning:
         elif self.dim_im == 3:
             assert self.image.orientation == 'IRP'
 
-            thinned_data = np.asarray([self.zhang_suen(im_slice) for im_slice in self.image.data])
+            # all axial slices are thinned at once
+            thinned_data = self.zhang_suen(self.image.data)
 
             self.thinned_image = Image(param=thinned_data, absolutepath=self.image.path + self.image.file_name + '_thinned' + self.image.ext, hdr=self.image.hdr)
 
     # ------------------------------------------------------------------------------------------------------------------
-    def get_neighbours(self, x, y, image):
+    @staticmethod
+    def get_lookup_tables():
         """
-        Return 8-neighbours of image point P1(x,y), in a clockwise order
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param x:
-        :param y:
-        :param image:
-        :return:
-        """
-        # now = time.time()
-        x_1, y_1, x1, y1 = x-1, y-1, x+1, y+1
-        neighbours = [image[x_1][y], image[x_1][y1], image[x][y1], image[x1][y1],     # P2,P3,P4,P5
-                      image[x1][y], image[x1][y_1], image[x][y_1], image[x_1][y_1]]    # P6,P7,P8,P9
-        # t = time.time() - now
-        # print 't neighbours: ', t
-        return neighbours
-
-    # ------------------------------------------------------------------------------------------------------------------
-    def transitions(self, neighbours):
-        """
-        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param neighbours:
-        :return:
+        Conditions of the two sub-iterations of the Zhang-Suen algorithm, for each of the 256 possible configurations of
+        the 8-neighbours P2, P3, ..., P9 (neighbour Pi is bit i-2 of the configuration)
+        code adapted from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
+        :return: lookup_step1, lookup_step2: boolean arrays of size 256
         """
-        # now = time.time()
-        n = neighbours + neighbours[0:1]      # P2, P3, ... , P8, P9, P2
-        s = np.sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:]))  # (P2,P3), (P3,P4), ... , (P8,P9), (P9,P2)
-        # t = time.time() - now
-        # print 't transitions sum: ', t
-        return s
+        configurations = np.arange(256)
+        P2, P3, P4, P5, P6, P7, P8, P9 = n = [(configurations >> i) & 1 for i in range(8)]
+        nb_neighbours = np.sum(n, axis=0)
+        # No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence P2, P3, ... , P8, P9, P2
+        transitions = np.sum([(n1 == 0) & (n2 == 1) for n1, n2 in zip(n, n[1:] + n[0:1])], axis=0)
+        conditions = (2 <= nb_neighbours) & (nb_neighbours <= 6) & (transitions == 1)  # Conditions 1 and 2
+        lookup_step1 = conditions & (P2 * P4 * P6 == 0) & (P4 * P6 * P8 == 0)  # Conditions 3 and 4
+        lookup_step2 = conditions & (P2 * P4 * P8 == 0) & (P2 * P6 * P8 == 0)
+        return lookup_step1, lookup_step2
 
     # ------------------------------------------------------------------------------------------------------------------
     def zhang_suen(self, image):
         """
         the Zhang-Suen Thinning Algorithm
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param image:
+        code adapted from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
+        Each sub-iteration is applied to all pixels at once: the configuration of the 8-neighbours of each pixel is
+        encoded in one byte and the conditions are read in a lookup table.
+        :param image: 2D image, or 3D image thinned slice by slice (slices along the first axis)
         :return:
         """
         # now = time.time()
         image_thinned = image.copy()  # deepcopy to protect the original image
-        changing1 = changing2 = 1  # the points to be removed (set as 0)
-        while changing1 or changing2:  # iterates until no further changes occur in the image
-            # Step 1
-            changing1 = []
-            max = len(image_thinned) - 1
-            pass_list = [1, max]
-            # rows, columns = image_thinned.shape  # x for rows, y for columns
-
-            # for x in range(1, rows - 1):         # No. of  rows
-            # for y in range(1, columns - 1):  # No. of columns
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0: Point P1 in the object regions
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and    # Condition 1: 2<= N(P1) <= 6
-                        P2 * P4 * P6 == 0 and    # Condition 3
-                        P4 * P6 * P8 == 0 and   # Condition 4
-                        self.transitions(n) == 1):    # Condition 2: S(P1)=1
-                        changing1.append((x, y))
-            for x, y in changing1:
-                image_thinned[x][y] = 0
-            # Step 2
-            changing2 = []
-
-            # for x in range(1, rows - 1):
-            # for y in range(1, columns - 1):
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and       # Condition 1
-                        P2 * P4 * P8 == 0 and       # Condition 3
-                        P2 * P6 * P8 == 0 and  # Condition 4
-                        self.transitions(n) == 1):    # Condition 2
-                        changing2.append((x, y))
-            for x, y in changing2:
-                image_thinned[x][y] = 0
+        lookup_step1, lookup_step2 = self.get_lookup_tables()
+
+        # pixels of rows or columns 1 and max (max being the number of rows - 1) are never removed
+        max = image_thinned.shape[-2] - 1
+        rows = np.arange(image_thinned.shape[-2])[:, np.newaxis]
+        columns = np.arange(image_thinned.shape[-1])[np.newaxis, :]
+        pass_mask = (rows == 1) | (rows == max) | (columns == 1) | (columns == max)
+
+        # shifts (rows, columns) giving P2, P3, ..., P9 = image[x-1][y], image[x-1][y+1], ..., image[x-1][y-1]
+        shifts = [(1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1)]
+
+        changing = True
+        while changing:  # iterates until no further changes occur in the image
+            changing = False
+            for lookup in [lookup_step1, lookup_step2]:
+                binary = (image_thinned > 0).astype(np.uint8)
+                configurations = np.zeros(image_thinned.shape, dtype=np.uint8)
+                for i, shift in enumerate(shifts):
+                    configurations |= np.roll(binary, shift, axis=(-2, -1)) << i
+                to_remove = lookup[configurations] & (binary == 1) & ~pass_mask
+                if to_remove.any():
+                    image_thinned[to_remove] = 0
+                    changing = True
         # t = time.time() - now
         # print 't thinning: ', t
         return image_thinned
@@ -139,48 +115,75 @@ class Thinning:
 # ----------------------------------------------------------------------------------------------------------------------
 # HAUSDORFF'S DISTANCE -------------------------------------------------------------------------------------------------
 class HausdorffDistance:
-    def __init__(self, data1, data2, v=1):
+    def __init__(self, data1, data2, v=1, slice_axis=None, pixel_size=None):
         """
         the hausdorff distance between two sets is the maximum of the distances from a point in any of the sets to the nearest point in the other set
+        :param slice_axis: if not None, the distances are computed independently in each slice along this axis (all
+        slices at once), and h1, h2 and H are arrays with one value per slice
+        :param pixel_size: size of the pixels along each axis. If None, distances are in pixel
         :return:
         """
         # now = time.time()
-        sct.printv('Computing 2D Hausdorff\'s distance ... ', v, 'normal')
+        sct.printv('Computing ' + str(len(data1.shape) - (slice_axis is not None)) + 'D Hausdorff\'s distance ... ', v, 'normal')
         self.data1 = bin_data(data1)
         self.data2 = bin_data(data2)
+        self.slice_axis = slice_axis
+        self.pixel_size = pixel_size
+
+        if self.slice_axis is not None:
+            axes_in_slice = tuple(axis for axis in range(len(self.data1.shape)) if axis != self.slice_axis)
+            nb_empty = np.sum(np.logical_not(np.logical_and(np.any(self.data1, axis=axes_in_slice),
+                                                            np.any(self.data2, axis=axes_in_slice))))
+            if nb_empty:
+                sct.printv('Warning: an image is empty in ' + str(nb_empty) + ' slice(s)', v, 'warning')
 
         self.min_distances_1 = self.relative_hausdorff_dist(self.data1, self.data2, v)
         self.min_distances_2 = self.relative_hausdorff_dist(self.data2, self.data1, v)
 
         # relatives hausdorff's distances in pixel
-        self.h1 = np.max(self.min_distances_1)
-        self.h2 = np.max(self.min_distances_2)
+        if self.slice_axis is None:
+            self.h1 = np.max(self.min_distances_1)
+            self.h2 = np.max(self.min_distances_2)
 
-        # Hausdorff's distance in pixel
-        self.H = max(self.h1, self.h2)
+            # Hausdorff's distance in pixel
+            self.H = max(self.h1, self.h2)
+        else:
+            self.h1 = np.max(self.min_distances_1, axis=axes_in_slice)
+            self.h2 = np.max(self.min_distances_2, axis=axes_in_slice)
+            self.H = np.maximum(self.h1, self.h2)
         # t = time.time() - now
         # print 'Hausdorff dist time :', t
 
     # ------------------------------------------------------------------------------------------------------------------
     def relative_hausdorff_dist(self, dat1, dat2, v=1):
+        """
+        Distance from each point of dat1 to the nearest point of dat2, computed with a KD-tree.
+        If slice_axis is set, the slices are moved away from each other along this axis, so that the nearest point is
+        searched in the same slice only.
+        :return: array of the shape of dat1, with the distances at the points of dat1 and 0 elsewhere
+        """
+        from scipy.spatial import cKDTree
         h = np.zeros(dat1.shape)
-        nz_coord_1 = non_zero_coord(dat1)
-        nz_coord_2 = non_zero_coord(dat2)
-        if len(nz_coord_1) != 0 and len(nz_coord_2) != 0 :
-            for x1, y1 in nz_coord_1:
-                # for x1 in range(dat1.shape[0]):
-                # for y1 in range(dat1.shape[1]):
-                # if dat1[x1, y1] == 1:
-                d_p1_dat2 = []
-                p1 = np.asarray([x1, y1])
-                for x2, y2 in nz_coord_2:
-                    # for x2 in range(dat2.shape[0]):
-                    # for y2 in range(dat2.shape[1]):
-                    # if dat2[x2, y2] == 1:
-                    p2 = np.asarray([x2, y2])
-                    d_p1_dat2.append(np.linalg.norm(p1-p2))  # Euclidean distance between p1 and p2
-                h[x1, y1] = min(d_p1_dat2)
-        else:
+        nz_1 = np.nonzero(dat1)
+        nz_2 = np.nonzero(dat2)
+        nz_coord_1 = np.transpose(nz_1).astype(float)
+        nz_coord_2 = np.transpose(nz_2).astype(float)
+        if len(nz_coord_1) != 0 and len(nz_coord_2) != 0:
+            if self.pixel_size is not None:
+                nz_coord_1 *= self.pixel_size
+                nz_coord_2 *= self.pixel_size
+            if self.slice_axis is not None:
+                # larger than any distance within a slice
+                offset = 2.0 * np.sum(np.asarray(dat1.shape) * (self.pixel_size if self.pixel_size is not None else 1.0))
+                # slice index times offset, independently of the pixel size along the slice axis
+                nz_coord_1[:, self.slice_axis] = nz_1[self.slice_axis] * offset
+                nz_coord_2[:, self.slice_axis] = nz_2[self.slice_axis] * offset
+            min_dist = cKDTree(nz_coord_2).query(nz_coord_1)[0]
+            if self.slice_axis is not None:
+                # the nearest point is in another slice: this slice of dat2 is empty
+                min_dist[min_dist >= offset] = 0.0
+            h[nz_1] = min_dist
+        elif self.slice_axis is None:
             sct.printv('Warning: an image is empty', v, 'warning')
         return h
 
@@ -211,11 +214,13 @@ class ComputeDistances:
 
         if self.param.thinning:
             self.thinning1 = Thinning(self.im1, self.param.verbose)
-            self.thinning1.thinned_image.save()
+            if self.param.save_thinned:
+                self.thinning1.thinned_image.save()
 
             if self.im2 is not None:
                 self.thinning2 = Thinning(self.im2, self.param.verbose)
-                self.thinning2.thinned_image.save()
+                if self.param.save_thinned:
+                    self.thinning2.thinned_image.save()
 
         if self.dim_im == 2 and self.im2 is not None:
             self.compute_dist_2im_2d()
@@ -232,18 +237,18 @@ class ComputeDistances:
         if self.dim_im == 3:
             self.dist1_distribution = []
             self.dist2_distribution = []
-            for d in self.distances:
-                self.dist1_distribution.append(d.min_distances_1[np.nonzero(d.min_distances_1)])
-                self.dist2_distribution.append(d.min_distances_2[np.nonzero(d.min_distances_2)])
+            for min_distances_1, min_distances_2 in zip(self.distances.min_distances_1, self.distances.min_distances_2):
+                self.dist1_distribution.append(min_distances_1[np.nonzero(min_distances_1)])
+                self.dist2_distribution.append(min_distances_2[np.nonzero(min_distances_2)])
 
             self.res = 'Hausdorff\'s distance  -  First relative Hausdorff\'s distance median - Second relative Hausdorff\'s distance median(all in mm)\n'
-            for i, d in enumerate(self.distances):
+            for i, H in enumerate(self.distances.H):
                 med1 = np.median(self.dist1_distribution[i])
                 med2 = np.median(self.dist2_distribution[i])
                 if self.im2 is None:
-                    self.res += 'Slice ' + str(i) + ' - slice ' + str(i+1) + ': ' + str(d.H*self.dim_pix) + '  -  ' + str(med1*self.dim_pix) + '  -  ' + str(med2*self.dim_pix) + ' \n'
+                    self.res += 'Slice ' + str(i) + ' - slice ' + str(i+1) + ': ' + str(H*self.dim_pix) + '  -  ' + str(med1*self.dim_pix) + '  -  ' + str(med2*self.dim_pix) + ' \n'
                 else:
-                    self.res += 'Slice ' + str(i) + ': ' + str(d.H*self.dim_pix) + '  -  ' + str(med1*self.dim_pix) + '  -  ' + str(med2*self.dim_pix) + ' \n'
+                    self.res += 'Slice ' + str(i) + ': ' + str(H*self.dim_pix) + '  -  ' + str(med1*self.dim_pix) + '  -  ' + str(med2*self.dim_pix) + ' \n'
 
         sct.printv('-----------------------------------------------------------------------------\n' +
                    self.res, self.param.verbose, 'normal')
@@ -280,9 +285,8 @@ class ComputeDistances:
         else:
             dat1 = bin_data(self.im1.data)
 
-        self.distances = []
-        for i, dat_slice in enumerate(dat1[:-1]):
-            self.distances.append(HausdorffDistance(bin_data(dat_slice), bin_data(dat1[i+1]), self.param.verbose))
+        # each slice is compared to the next one
+        self.distances = HausdorffDistance(dat1[:-1], dat1[1:], self.param.verbose, slice_axis=0)
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_dist_2im_3d(self):
@@ -299,9 +303,34 @@ class ComputeDistances:
             dat1 = bin_data(self.im1.data)
             dat2 = bin_data(self.im2.data)
 
-        self.distances = []
-        for slice1, slice2 in zip(dat1, dat2):
-            self.distances.append(HausdorffDistance(slice1, slice2, self.param.verbose))
+        self.distances = HausdorffDistance(dat1, dat2, self.param.verbose, slice_axis=0)
+        self.pixel_size = (px1, py1, pz1)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def get_statistics(self, percentile=95):
+        """
+        Summary of the distances, in mm, per slice for 3D images.
+        For two 3D images, the Hausdorff's distance computed in 3D (not slice-wise) is also given.
+        :param percentile: percentile of the relative distances
+        :return: dict of arrays: hausdorff, median_1, median_2, percentile_1, percentile_2 (and hausdorff_3d)
+        """
+        if self.dim_im == 2:
+            list_distributions = [(self.dist1_distribution, self.dist2_distribution)]
+            list_H = [self.distances.H]
+        else:
+            list_distributions = zip(self.dist1_distribution, self.dist2_distribution)
+            list_H = self.distances.H
+
+        stats = {'hausdorff': np.asarray(list_H, dtype=float) * self.dim_pix}
+        for i in [1, 2]:
+            distributions = [dist[i - 1] * self.dim_pix for dist in list_distributions]
+            stats['median_' + str(i)] = np.asarray([np.median(dist) if len(dist) else np.nan for dist in distributions])
+            stats['percentile_' + str(i)] = np.asarray([np.percentile(dist, percentile) if len(dist) else np.nan for dist in distributions])
+
+        if self.dim_im == 3 and self.im2 is not None:
+            distances_3d = HausdorffDistance(self.distances.data1, self.distances.data2, 0, pixel_size=self.pixel_size)
+            stats['hausdorff_3d'] = distances_3d.H
+        return stats
 
     # ------------------------------------------------------------------------------------------------------------------
     def show_results(self):
@@ -324,7 +353,7 @@ class ComputeDistances:
             data_dist["slice"].append(len(self.dist2_distribution)*[0])
 
         if self.dim_im == 3:
-            for i in range(len(self.distances)):
+            for i in range(len(self.distances.H)):
                 data_dist["distances"].append([dist*self.dim_pix for dist in self.dist1_distribution[i]])
                 data_dist["image"].append(len(self.dist1_distribution[i])*[1])
                 data_dist["slice"].append(len(self.dist1_distribution[i])*[i])
@@ -394,6 +423,73 @@ def resample_image(fname, suffix='_resampled.nii.gz', binary=False, npx=0.3, npy
 
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def compute_distances_pair(fname1, fname2=None, thinning=True, resampling=0.1, percentile=95):
+    """
+    Compute the distances between two images, in a temporary folder (as done by the main function). The thinned
+    images are not saved.
+    :return: dict of statistics (see ComputeDistances.get_statistics)
+    """
+    import shutil
+    param = Param()
+    param.thinning = thinning
+    param.save_thinned = False
+    param.verbose = 0
+
+    path_tmp = os.path.abspath(sct.tmp_create(verbose=0))
+    shutil.copy(fname1, os.path.join(path_tmp, 'im1' + sct.extract_fname(fname1)[2]))
+    if fname2 is not None:
+        shutil.copy(fname2, os.path.join(path_tmp, 'im2' + sct.extract_fname(fname2)[2]))
+    curdir = os.getcwd()
+    os.chdir(path_tmp)
+    try:
+        im1 = Image(resample_image('im1' + sct.extract_fname(fname1)[2], binary=True, thr=0.5, npx=resampling, npy=resampling))
+        im2 = None
+        if fname2 is not None:
+            im2 = Image(resample_image('im2' + sct.extract_fname(fname2)[2], binary=True, thr=0.5, npx=resampling, npy=resampling))
+        stats = ComputeDistances(im1, im2=im2, param=param).get_statistics(percentile=percentile)
+    finally:
+        os.chdir(curdir)
+        shutil.rmtree(path_tmp, ignore_errors=True)
+    stats['fname1'], stats['fname2'] = fname1, fname2
+    return stats
+
+
+def compute_distances_pair_star(args):
+    # sys.exit (e.g., called by sct.run when sct_resample fails) would kill the worker process without returning the
+    # task, and the pool would wait for it forever: errors are raised as exceptions, which the pool returns
+    try:
+        return compute_distances_pair(*args)
+    except (SystemExit, Exception) as error:
+        import traceback
+        raise Exception('Error when computing the distances between '+str(args[0])+' and '+str(args[1])+': '+repr(error)+'\n'+traceback.format_exc())
+
+
+def compute_distances_batch(list_fname_pairs, thinning=True, resampling=0.1, percentile=95, cpu_number=1):
+    """
+    Compute the distances between many pairs of images (e.g., automatic and manual segmentations of a cohort), with a
+    pool of processes.
+    :param list_fname_pairs: list of (fname1, fname2)
+    :param cpu_number: number of processes. 0 or 1: no multiprocessing.
+    :return: list of dict of statistics (see compute_distances_pair), in the order of list_fname_pairs
+    """
+    list_args = [(fname1, fname2, thinning, resampling, percentile) for fname1, fname2 in list_fname_pairs]
+    if cpu_number > 1:
+        from multiprocessing import Pool
+        pool = Pool(processes=cpu_number)
+        try:
+            list_stats = pool.map(compute_distances_pair_star, list_args)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        list_stats = [compute_distances_pair(*args) for args in list_args]
+    return list_stats
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def non_zero_coord(data):
     dim = len(data.shape)
@@ -18,8 +18,11 @@ import sys
 import os
 import getopt
 from commands import getstatusoutput
+import numpy as np
 import sct_utils as sct
 from msct_parser import Parser
+from msct_image import Image
+from sct_apply_transfo import read_transfo_list, lps_affine, transform_grid
 
 # DEFAULT PARAMETERS
 class Param:
@@ -29,6 +32,40 @@ class Param:
         self.fname_warp_final = 'warp_final.nii.gz'
 
 
+# concat_transfo
+#=======================================================================================================================
+def concat_transfo(list_transfo, fname_dest, fname_warp_final='', chunk_size=2**21, verbose=1):
+    """
+    Concatenate transformations into one warping field defined on the grid of the destination image, as
+    isct_ComposeMultiTransform. Each warping field is sampled once per voxel of the output, by chunks of slices.
+    :param list_transfo: transformations, in the order in which they are applied to the points of the destination image,
+    i.e., the reverse order of the -w flag, as returned by sct_apply_transfo.read_transfo_list
+    :param fname_dest: destination image
+    :param fname_warp_final: output warping field. If empty, the warping field is only returned.
+    :param chunk_size: maximum number of voxels processed at once
+    :return: Image of the warping field (float32, shape (nx, ny, nz, 1, 3), displacements in LPS), which can be passed to
+    sct_apply_transfo.read_transfo_list to apply it without writing it
+    """
+    im_dest = Image(fname_dest, mmap=True)
+    nx, ny, nz = im_dest.data.shape[:3]
+    data_warp = np.zeros((nx, ny, nz, 1, 3), dtype=np.float32)
+    affine_pix2phys = lps_affine(im_dest)
+    nz_chunk = max(1, chunk_size // (nx * ny))
+    for z_start in range(0, nz, nz_chunk):
+        z_end = min(nz, z_start + nz_chunk)
+        coord, coord_transfo = transform_grid(affine_pix2phys, nx, ny, z_start, z_end, list_transfo)
+        data_warp[:, :, z_start:z_end, 0, :] = (coord_transfo - coord).T.reshape(nx, ny, z_end - z_start, 3)
+
+    hdr_warp = im_dest.hdr.copy()
+    hdr_warp.set_data_dtype(np.float32)
+    hdr_warp.set_intent('vector', (), '')
+    im_warp = Image(data_warp, hdr=hdr_warp, orientation=im_dest.orientation, absolutepath=fname_warp_final)
+    if fname_warp_final:
+        # keep the 4th (time) dimension of size 1, as expected by ITK
+        im_warp.save(squeeze_data=False, verbose=verbose)
+    return im_warp
+
+
 # main
 #=======================================================================================================================
 def main():
@@ -85,6 +122,17 @@ def main():
     else:
         path_out, file_out, ext_out = sct.extract_fname(fname_warp_final)
 
+    # Concatenate warping fields and affine transformations in python when all of them can be read. N.B. as for
+    # isct_ComposeMultiTransform below, the list is reversed: a point of the destination goes through the last
+    # transformation of the -w flag first
+    list_transfo = read_transfo_list(fname_warp_list, use_inverse)
+    if list_transfo is not None:
+        sct.printv('\nConcatenate warping fields...', verbose)
+        concat_transfo(list_transfo, fname_dest, path_out+file_out+ext_out, verbose=verbose)
+        sct.printv('  File created: '+path_out+file_out+ext_out, verbose)
+        print ''
+        return
+
     # Concatenate warping fields
     sct.printv('\nConcatenate warping fields...', verbose)
     # N.B. Here we take the inverse of the warp list
@@ -108,7 +156,7 @@ def main():
 def get_parser():
     # Initialize the parser
     parser = Parser(__file__)
-    parser.usage.set_description('Concatenate transformations. This function is a wrapper for isct_ComposeMultiTransform (ANTs). N.B. Order of input warping fields is important. For example, if you want to concatenate: A->B and B->C to yield A->C, then you have to input warping fields like that: A->B,B->C.')
+    parser.usage.set_description('Concatenate transformations. Warping fields and affine matrices are concatenated with the same conventions as isct_ComposeMultiTransform (ANTs), which is called for other transformations. N.B. Order of input warping fields is important. For example, if you want to concatenate: A->B and B->C to yield A->C, then you have to input warping fields like that: A->B,B->C.')
     parser.add_option(name="-d",
                       type_value="file",
                       description="Destination image.",
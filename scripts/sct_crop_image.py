@@ -392,10 +392,16 @@ def find_mask_boundaries(fname_mask):
     return ind_start, ind_end, range(dim)
 
 
-if __name__ == "__main__":
+# MAIN
+# ==========================================================================================
+def main(args=None):
+
+    if not args:
+        args = sys.argv[1:]
+
     parser = get_parser()
     # Fetching script arguments
-    arguments = parser.parse(sys.argv[1:])
+    arguments = parser.parse(args)
 
     # assigning variables to arguments
     input_filename = arguments["-i"]
@@ -441,4 +447,11 @@ if __name__ == "__main__":
         if "-mesh" in arguments:
             cropper.mesh = arguments["-mesh"]
 
-        cropper.crop()
\ No newline at end of file
+        cropper.crop()
+
+
+# START PROGRAM
+# ==========================================================================================
+if __name__ == "__main__":
+    # call main function
+    main()
@@ -36,6 +36,7 @@ import getopt
 import time
 import glob
 import math
+import shutil
 import numpy as np
 from sct_dmri_eddy_correct import eddy_correct
 import sct_utils as sct
@@ -44,7 +45,7 @@ from sct_dmri_separate_b0_and_dwi import identify_b0
 import importlib
 from sct_convert import convert
 from msct_image import Image
-from sct_image import copy_header, split_data, concat_data
+from sct_image import copy_header
 from msct_parser import Parser
 
 
@@ -76,6 +77,8 @@ class Param:
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold (where csf disapeared).
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.nb_iterative_averaging = 10  # number of first volumes averaged into the target (registered sequentially)
+        self.cpu_number = 1  # number of volumes registered in parallel
 
 
 #=======================================================================================================================
@@ -116,6 +119,8 @@ def main():
         param.interp = arguments['-x']
     if '-ofolder' in arguments:
         path_out = arguments['-ofolder']
+    if '-cpu-nb' in arguments:
+        param.cpu_number = arguments['-cpu-nb']
     if '-r' in arguments:
         param.remove_tmp_files = int(arguments['-r'])
     if '-v' in arguments:
@@ -190,6 +195,15 @@ def main():
     sct.printv('fslview -m ortho,ortho '+param.path_out+file_data+param.suffix+' '+file_data+' &\n', param.verbose, 'info')
 
 
+#=======================================================================================================================
+# save_volumes: save volumes of the dmri data with the header of the dmri data
+#=======================================================================================================================
+def save_volumes(im_data, data, fname):
+    # only the header is copied: the data are views of the dmri data
+    im_out = Image(data, hdr=im_data.hdr.copy(), orientation=im_data.orientation, absolutepath=fname)
+    im_out.save()
+
+
 #=======================================================================================================================
 # dmri_moco: motion correction specific to dmri data
 #=======================================================================================================================
@@ -220,34 +234,34 @@ def dmri_moco(param):
         sys.exit(2)
 
     # Prepare NIFTI (mean/groups...)
+    # All volumes are selected by index in the 4D data: only the files used by the next steps are written.
     #===================================================================================================================
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    im_data_split_list = split_data(im_data, 3)
-    for im in im_data_split_list:
-        im.save()
+    data = im_data.data
+    if len(data.shape) == 3:
+        data = data[..., np.newaxis]
+
+    # Save the b=0 image used as target for the registration of all b=0
+    if index_dwi[0] != 0:
+        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
+        # select it as the target image for registration of all b=0
+        index_b0_target = index_b0[index_dwi[0]-1]
+    else:
+        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
+        index_b0_target = index_b0[0]
+    file_b0_target = file_data + '_T' + str(index_b0_target).zfill(4)
+    save_volumes(im_data, data[..., index_b0_target:index_b0_target+1], file_b0_target+ext_data)
 
     # Merge b=0 images
     sct.printv('\nMerge b=0...', param.verbose)
-    # cmd = fsloutput + 'fslmerge -t ' + file_b0
-    # for it in range(nb_b0):
-    #     cmd = cmd + ' ' + file_data + '_T' + str(index_b0[it]).zfill(4)
-    im_b0_list = []
-    for it in range(nb_b0):
-        im_b0_list.append(im_data_split_list[index_b0[it]])
-    im_b0_out = concat_data(im_b0_list, 3)
-    im_b0_out.setFileName(file_b0 + ext_data)
-    im_b0_out.save()
+    data_b0 = data[..., index_b0]
+    save_volumes(im_data, data_b0, file_b0+ext_data)
     sct.printv(('  File created: ' + file_b0), param.verbose)
 
     # Average b=0 images
     sct.printv('\nAverage b=0...', param.verbose)
     file_b0_mean = file_b0+'_mean'
-    sct.run('sct_maths -i '+file_b0+ext_data+' -o '+file_b0_mean+ext_data+' -mean t', param.verbose)
-    # if not average_data_across_dimension(file_b0+'.nii', file_b0_mean+'.nii', 3):
-    #     sct.printv('ERROR in average_data_across_dimension', 1, 'error')
-    # cmd = fsloutput + 'fslmaths ' + file_b0 + ' -Tmean ' + file_b0_mean
-    # status, output = sct.run(cmd, param.verbose)
+    save_volumes(im_data, np.mean(data_b0, 3), file_b0_mean+ext_data)
+    del data_b0
 
     # Number of DWI groups
     nb_groups = int(math.floor(nb_dwi/param.group_size))
@@ -263,49 +277,24 @@ def dmri_moco(param):
         nb_groups += 1
         group_indexes.append(index_dwi[len(index_dwi)-nb_remaining:len(index_dwi)])
 
-    # DWI groups
-    file_dwi_mean = []
+    # Average DW images of each group
+    sct.printv('\nAverage DW images of '+str(nb_groups)+' groups...', param.verbose)
+    data_dwi_mean = np.zeros(data.shape[:3]+(nb_groups,), dtype=np.result_type(data.dtype, np.float32))
     for iGroup in range(nb_groups):
-        sct.printv('\nDWI group: ' +str((iGroup+1))+'/'+str(nb_groups), param.verbose)
-
-        # get index
-        index_dwi_i = group_indexes[iGroup]
-        nb_dwi_i = len(index_dwi_i)
-
-        # Merge DW Images
-        sct.printv('Merge DW images...', param.verbose)
-        file_dwi_merge_i = file_dwi + '_' + str(iGroup)
-
-        im_dwi_list = []
-        for it in range(nb_dwi_i):
-            im_dwi_list.append(im_data_split_list[index_dwi_i[it]])
-        im_dwi_out = concat_data(im_dwi_list, 3)
-        im_dwi_out.setFileName(file_dwi_merge_i + ext_data)
-        im_dwi_out.save()
-
-        # Average DW Images
-        sct.printv('Average DW images...', param.verbose)
-        file_dwi_mean.append(file_dwi + '_mean_' + str(iGroup))
-        sct.run('sct_maths -i '+file_dwi_merge_i+ext_data+' -o '+file_dwi_mean[iGroup]+ext_data+' -mean t', param.verbose)
+        data_dwi_mean[..., iGroup] = np.mean(data[..., group_indexes[iGroup]], 3)
+    # the average of the first group is the reference for reslicing into proper coordinate system
+    file_dwi_mean_0 = file_dwi + '_mean_' + str(0)
+    save_volumes(im_data, data_dwi_mean[..., 0], file_dwi_mean_0+ext_data)
 
     # Merge DWI groups means
     sct.printv('\nMerging DW files...', param.verbose)
-    # file_dwi_groups_means_merge = 'dwi_averaged_groups'
-    im_dw_list = []
-    for iGroup in range(nb_groups):
-        im_dw_list.append(file_dwi_mean[iGroup] + ext_data)
-    im_dw_out = concat_data(im_dw_list, 3)
-    im_dw_out.setFileName(file_dwi_group + ext_data)
-    im_dw_out.save()
-    # cmd = fsloutput + 'fslmerge -t ' + file_dwi_group
-    # for iGroup in range(nb_groups):
-    #     cmd = cmd + ' ' + file_dwi + '_mean_' + str(iGroup)
+    save_volumes(im_data, data_dwi_mean, file_dwi_group+ext_data)
 
     # Average DW Images
     # TODO: USEFULL ???
     sct.printv('\nAveraging all DW images...', param.verbose)
-    fname_dwi_mean = file_dwi+'_mean'
-    sct.run('sct_maths -i '+file_dwi_group+ext_data+' -o '+file_dwi_group+'_mean'+ext_data+' -mean t', param.verbose)
+    save_volumes(im_data, np.mean(data_dwi_mean, 3), file_dwi_group+'_mean'+ext_data)
+    del data_dwi_mean
 
     # segment dwi images using otsu algorithm
     if param.otsu:
@@ -339,13 +328,7 @@ def dmri_moco(param):
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
     param_moco = param
     param_moco.file_data = 'b0'
-    if index_dwi[0] != 0:
-        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
-        # select it as the target image for registration of all b=0
-        param_moco.file_target = file_data + '_T' + str(index_b0[index_dwi[0]-1]).zfill(4)
-    else:
-        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
-        param_moco.file_target = file_data + '_T' + str(index_b0[0]).zfill(4)
+    param_moco.file_target = file_b0_target
     param_moco.path_out = ''
     param_moco.todo = 'estimate'
     param_moco.mat_moco = 'mat_b0groups'
@@ -366,17 +349,12 @@ def dmri_moco(param):
     # create final mat folder
     sct.create_folder(mat_final)
 
-    # Copy b=0 registration matrices
-    sct.printv('\nCopy b=0 registration matrices...', param.verbose)
-
-    for it in range(nb_b0):
-        sct.run('cp '+'mat_b0groups/'+'mat.T'+str(it)+ext_mat+' '+mat_final+'mat.T'+str(index_b0[it])+ext_mat, param.verbose)
-
-    # Copy DWI registration matrices
-    sct.printv('\nCopy DWI registration matrices...', param.verbose)
-    for iGroup in range(nb_groups):
-        for dwi in range(len(group_indexes[iGroup])):
-            sct.run('cp '+'mat_dwigroups/'+'mat.T'+str(iGroup)+ext_mat+' '+mat_final+'mat.T'+str(group_indexes[iGroup][dwi])+ext_mat, param.verbose)
+    # Copy registration matrices: each b=0 volume gets its own matrix, each DW volume gets the matrix of its group
+    sct.printv('\nCopy b=0 and DWI registration matrices...', param.verbose)
+    list_mat = [('mat_b0groups/mat.T'+str(it)+ext_mat, index_b0[it]) for it in range(nb_b0)]
+    list_mat += [('mat_dwigroups/mat.T'+str(iGroup)+ext_mat, index) for iGroup in range(nb_groups) for index in group_indexes[iGroup]]
+    for fname_mat, it in list_mat:
+        shutil.copyfile(fname_mat, mat_final+'mat.T'+str(it)+ext_mat)
 
     # Spline Regularization along T
     if param.spline_fitting:
@@ -393,7 +371,7 @@ def dmri_moco(param):
     sct.printv('  Apply moco', param.verbose)
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
     param_moco.file_data = file_data
-    param_moco.file_target = file_dwi+'_mean_'+str(0)  # reference for reslicing into proper coordinate system
+    param_moco.file_target = file_dwi_mean_0  # reference for reslicing into proper coordinate system
     param_moco.path_out = ''
     param_moco.mat_moco = mat_final
     param_moco.todo = 'apply'
@@ -521,6 +499,12 @@ def get_parser():
                       mandatory=False,
                       deprecated_by='-o')
     parser.usage.addSection('MISC')
+    parser.add_option(name='-cpu-nb',
+                      type_value='int',
+                      description='Number of volumes registered in parallel.',
+                      mandatory=False,
+                      default_value=param_default.cpu_number,
+                      example=['4'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description='Remove temporary files.',
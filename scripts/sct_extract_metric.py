@@ -59,10 +59,10 @@ def get_parser():
     parser = Parser(__file__)
     parser.usage.set_description("""This program extracts metrics (e.g., DTI or MTR) within labels. The labels are generated with 'sct_warp_template'. The label folder contains a file (info_label.txt) that describes all labels. The labels should be in the same space coordinates as the input image.""")
     parser.add_option(name='-i',
-                      type_value='image_nifti',
-                      description='File to extract metrics from.',
+                      type_value=[[','], 'image_nifti'],
+                      description='File(s) to extract metrics from. Separate with ",". 4D files are processed volume by volume. The atlas is loaded once for all metrics and the results are saved in the same output file.',
                       mandatory=True,
-                      example='FA.nii.gz')
+                      example='FA.nii.gz,MD.nii.gz')
     parser.add_option(name='-f',
                       type_value='folder',
                       description='Folder including labels to extract the metric from.',
@@ -249,7 +249,7 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
 
     # print parameters
     print '\nChecked parameters:'
-    print '  data ...................... '+fname_data
+    print '  data ...................... '+', '.join(fname_data)
     print '  folder label .............. '+path_label
     print '  estimation method ......... '+method
     print '  slices of interest ........ '+slices_of_interest
@@ -268,14 +268,11 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     # Load data
     # Check if the orientation of the data is RPI
     sct.printv('\nLoad metric image...', verbose)
-    input_im = Image(fname_data)
-    orientation_data = input_im.orientation
+    list_input_im, orientation_data = load_metric_images(fname_data, verbose)
+    nb_metrics = len(list_input_im)
 
     if orientation_data != 'RPI':
         # If orientation is not RPI, change to RPI and load data
-        # metric
-        sct.printv('\nChange metric image orientation into RPI and load it...', verbose)
-        input_im.change_orientation(orientation='RPI')
         # labels
         sct.printv('\nChange labels orientation into RPI and load them...', verbose)
         labels = np.empty([nb_labels], dtype=object)
@@ -313,32 +310,23 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
             data_vertebral_labeling = Image(fname_vertebral_labeling).data
         if fname_mask_weight:
             im_weight = Image(fname_mask_weight)
-    data = input_im.data
     sct.printv('  OK!', verbose)
 
-    # Change metric data type into floats for future manipulations (normalization)
-    data = np.float64(data)
-    data[np.isneginf(data)] = 0.0
-    data[data < 0.0] = 0.0
-    data[np.isnan(data)] = 0.0
-    data[np.isposinf(data)] = np.nanmax(data)
-
-    # Get dimensions of data and labels
-    nx, ny, nz = data.shape
+    # Get dimensions of labels
     nx_atlas, ny_atlas, nz_atlas = labels[0].shape
 
     # Check dimensions consistency between atlas and data
-    if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
-        print '\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.'
-        sys.exit(2)
+    for input_im in list_input_im:
+        if input_im.data.shape != (nx_atlas, ny_atlas, nz_atlas):
+            print '\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.'
+            sys.exit(2)
 
     # Update the flag "slices_of_interest" according to the vertebral levels selected by user (if it's the case)
     if vertebral_levels:
-        slices_of_interest, actual_vert_levels, warning_vert_levels = get_slices_matching_with_vertebral_levels(data, vertebral_levels, data_vertebral_labeling, verbose)
+        slices_of_interest, actual_vert_levels, warning_vert_levels = get_slices_matching_with_vertebral_levels(list_input_im[0].data, vertebral_levels, data_vertebral_labeling, verbose)
 
-    # select slice of interest by cropping data and labels
+    # select slice of interest by cropping labels
     if slices_of_interest:
-        data, slices_list = remove_slices(data, slices_of_interest)
         for i_label in range(0, nb_labels):
             labels[i_label], slices_list = remove_slices(labels[i_label], slices_of_interest)
         if fname_normalizing_label:  # if the "normalization" option was selected,
@@ -350,58 +338,104 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     clusters_all_labels = parse_label_ID_groups(ml_clusters)
     combined_labels_groups_all_IDs = parse_label_ID_groups(combined_labels_id_groups)
 
-    # If specified, remove the label to fix its value
+    # If specified, remove the label to fix its value (the labels are the same for all metrics, hence the data are
+    # corrected below)
     if label_to_fix:
-        data, labels, indiv_labels_ids, indiv_labels_names, clusters_all_labels, combined_labels_groups_all_IDs, labels_id_user, label_to_fix_name, label_to_fix_fract_vol = fix_label_value(label_to_fix, data, labels, indiv_labels_ids, indiv_labels_names, clusters_all_labels, combined_labels_groups_all_IDs, labels_id_user)
-
-    # Extract metric in the labels specified by the file info_label.txt from the atlas folder given in input
-    # individual labels
-    indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight)
-    # combined labels
-    combined_labels_value = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
-    combined_labels_std = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
-    combined_labels_fract_vol = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
-    for i_combined_labels in range(0, len(combined_labels_groups_all_IDs)):
-        combined_labels_value[i_combined_labels], combined_labels_std[i_combined_labels], combined_labels_fract_vol[i_combined_labels] = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight, combined_labels_id_group=combined_labels_groups_all_IDs[i_combined_labels])
+        labels_all = labels
+        _, labels, indiv_labels_ids, indiv_labels_names, clusters_all_labels, combined_labels_groups_all_IDs, labels_id_user, label_to_fix_name, label_to_fix_fract_vol = fix_label_value(label_to_fix, 0, labels_all, indiv_labels_ids, indiv_labels_names, clusters_all_labels, combined_labels_groups_all_IDs, labels_id_user)
+        fixed_label = [label_to_fix[0], label_to_fix_name, label_to_fix[1]]
+
+    # Extract metric in the labels specified by the file info_label.txt from the atlas folder given in input, for each
+    # metric
+    list_metric_names = []
+    indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol = [], [], []
+    combined_labels_value, combined_labels_std, combined_labels_fract_vol = [], [], []
+    for i_metric, input_im in enumerate(list_input_im):
+        list_metric_names.append(input_im.absolutepath)
+        if nb_metrics > 1:
+            sct.printv('\nMetric: ' + input_im.absolutepath, verbose)
+
+        # Change metric data type into floats for future manipulations (normalization)
+        data = np.float64(input_im.data)
+        data[np.isneginf(data)] = 0.0
+        data[data < 0.0] = 0.0
+        data[np.isnan(data)] = 0.0
+        data[np.isposinf(data)] = np.nanmax(data)
+
+        # select slice of interest by cropping data
+        if slices_of_interest:
+            data, slices_list = remove_slices(data, slices_of_interest)
+
+        # remove the contribution of the label to fix
+        if label_to_fix:
+            data = data - label_to_fix_fract_vol*float(label_to_fix[1])
+
+        # individual labels
+        value, std, fract_vol = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight)
+        indiv_labels_value.append(value)
+        indiv_labels_std.append(std)
+        indiv_labels_fract_vol.append(fract_vol)
+        # combined labels
+        value = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
+        std = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
+        fract_vol = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
+        for i_combined_labels in range(0, len(combined_labels_groups_all_IDs)):
+            value[i_combined_labels], std[i_combined_labels], fract_vol[i_combined_labels] = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight, combined_labels_id_group=combined_labels_groups_all_IDs[i_combined_labels])
+        combined_labels_value.append(value)
+        combined_labels_std.append(std)
+        combined_labels_fract_vol.append(fract_vol)
 
     # display results
     sct.printv('\nResults:\nID, label name [total fractional volume of the label in number of voxels]:    metric value +/- metric STDEV within label', 1)
-    for i_label_user in labels_id_user:
-        if i_label_user <= max(indiv_labels_ids):
-            index = indiv_labels_ids.index(i_label_user)
-            sct.printv(str(indiv_labels_ids[index]) + ', ' + str(indiv_labels_names[index]) + ' ['+str(round(indiv_labels_fract_vol[index], 2))+']:    ' + str(indiv_labels_value[index]) + ' +/- ' + str(indiv_labels_std[index]), 1, 'info')
-        elif i_label_user > max(indiv_labels_ids):
-            index = combined_labels_ids.index(i_label_user)
-            sct.printv(str(combined_labels_ids[index]) + ', ' + str(combined_labels_names[index]) + ' ['+str(round(combined_labels_fract_vol[index], 2))+']:    ' + str(combined_labels_value[index]) + ' +/- ' + str(combined_labels_std[index]), 1, 'info')
+    for i_metric in range(nb_metrics):
+        if nb_metrics > 1:
+            sct.printv(list_metric_names[i_metric], 1)
+        for i_label_user in labels_id_user:
+            if i_label_user <= max(indiv_labels_ids):
+                index = indiv_labels_ids.index(i_label_user)
+                sct.printv(str(indiv_labels_ids[index]) + ', ' + str(indiv_labels_names[index]) + ' ['+str(round(indiv_labels_fract_vol[i_metric][index], 2))+']:    ' + str(indiv_labels_value[i_metric][index]) + ' +/- ' + str(indiv_labels_std[i_metric][index]), 1, 'info')
+            elif i_label_user > max(indiv_labels_ids):
+                index = combined_labels_ids.index(i_label_user)
+                sct.printv(str(combined_labels_ids[index]) + ', ' + str(combined_labels_names[index]) + ' ['+str(round(combined_labels_fract_vol[i_metric][index], 2))+']:    ' + str(combined_labels_value[i_metric][index]) + ' +/- ' + str(combined_labels_std[i_metric][index]), 1, 'info')
     if label_to_fix:
-        fixed_label = [label_to_fix[0], label_to_fix_name, label_to_fix[1]]
         sct.printv('\n*'+fixed_label[0] + ', ' + fixed_label[1] + ': ' + fixed_label[2] + ' (value fixed by user)', 1, 'info')
 
-    # section = ''
-    # if labels_id_user[0] <= max(indiv_labels_ids):
-    #     section = '\nWhite matter atlas:'
-    # elif labels_id_user[0] > max(indiv_labels_ids):
-    #     section = '\nCombined labels:'
-    # sct.printv(section, 1, 'info')
-    # for i_label_user in labels_id_user:
-    #     # change section if not individual label anymore
-    #     if i_label_user > max(indiv_labels_ids) and section == '\nWhite matter atlas:':
-    #         section = '\nCombined labels:'
-    #         sct.printv(section, 1, 'info')
-    #     # display result for this label
-    #     if section == '\nWhite matter atlas:':
-    #         index = indiv_labels_ids.index(i_label_user)
-    #         sct.printv(str(indiv_labels_ids[index]) + ', ' + str(indiv_labels_names[index]) + ':    ' + str(indiv_labels_value[index]) + ' +/- ' + str(indiv_labels_std[index]), 1, 'info')
-    #     elif section == '\nCombined labels:':
-    #         index = combined_labels_ids.index(i_label_user)
-    #         sct.printv(str(combined_labels_ids[index]) + ', ' + str(combined_labels_names[index]) + ':    ' + str(combined_labels_value[index]) + ' +/- ' + str(combined_labels_std[index]), 1, 'info')
-
     # save results in the selected output file type
-    save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, fname_data, method, overwrite, fname_normalizing_label, actual_vert_levels, warning_vert_levels, fixed_label)
+    save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, list_metric_names, method, overwrite, fname_normalizing_label, actual_vert_levels, warning_vert_levels, fixed_label)
 
     # output a metric value map
     if fname_output_metric_map:
-        data_metric_map = generate_metric_value_map(fname_output_metric_map, input_im, labels, indiv_labels_value, slices_list, label_to_fix, label_to_fix_fract_vol)
+        for i_metric, input_im in enumerate(list_input_im):
+            if nb_metrics > 1:
+                fname_metric_map = sct.add_suffix(fname_output_metric_map, '_' + str(i_metric).zfill(4))
+            else:
+                fname_metric_map = fname_output_metric_map
+            generate_metric_value_map(fname_metric_map, input_im, labels, indiv_labels_value[i_metric], slices_list, label_to_fix, label_to_fix_fract_vol)
+
+
+def load_metric_images(fname_data, verbose=1):
+    """Load the metric images, change their orientation to RPI and split 4D images into 3D volumes.
+    :param fname_data: list of file names
+    :return: list of 3D images, orientation of the first input image
+    """
+    list_input_im = []
+    orientation_data = None
+    for fname in fname_data:
+        input_im = Image(fname)
+        if orientation_data is None:
+            orientation_data = input_im.orientation
+        if input_im.orientation != 'RPI':
+            sct.printv('\nChange metric image orientation into RPI and load it...', verbose)
+            input_im.change_orientation(orientation='RPI')
+        if len(input_im.data.shape) == 4:
+            from sct_image import split_data
+            for im_vol in split_data(input_im, 3):
+                im_vol.data = im_vol.data[..., 0]
+                im_vol.setFileName(input_im.path + im_vol.file_name + im_vol.ext)
+                list_input_im.append(im_vol)
+        else:
+            list_input_im.append(input_im)
+    return list_input_im, orientation_data
 
 
 def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels='', adv_param='', normalizing_label=[], normalization_method='', im_weight='', combined_labels_id_group='', verbose=0):
@@ -439,14 +473,12 @@ def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels='', a
     if normalizing_label:  # if the "normalization" option is wanted
         sct.printv('\nExtract normalization values...', verbose)
         if normalization_method == 'sbs':  # case: the user wants to normalize slice-by-slice
-            for z in range(0, data.shape[-1]):
-                normalizing_label_slice = np.empty([1], dtype=object)  # in order to keep compatibility with the function
-                # 'extract_metric_within_tract', define a new array for the slice z of the normalizing labels
-                normalizing_label_slice[0] = normalizing_label[0][..., z]
-                metric_normalizing_label = estimate_metric_within_tract(data[..., z], normalizing_label_slice, method, 0)
-                # estimate the metric mean in the normalizing label for the slice z
-                if metric_normalizing_label[0][0] != 0:
-                    data[..., z] = data[..., z]/metric_normalizing_label[0][0]  # divide all the slice z by this value
+            # estimate the metric mean in the normalizing label for all slices at once
+            nz = data.shape[-1]
+            metric_normalizing_label = estimate_metric_within_tract_per_slices_groups(data, normalizing_label[:1], method, [[z] for z in range(nz)], 0)[0][:, 0]
+            for z in range(0, nz):
+                if metric_normalizing_label[z] != 0:
+                    data[..., z] = data[..., z]/metric_normalizing_label[z]  # divide all the slice z by this value
 
         elif normalization_method == 'whole':  # case: the user wants to normalize after estimations in the whole labels
             metric_norm_label, metric_std_norm_label = estimate_metric_within_tract(data, normalizing_label, method, param_default.verbose)  # mean and std are lists
@@ -671,10 +703,16 @@ def remove_slices(data_to_crop, slices_of_interest):
 
 
 def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, fname_data, method, overwrite, fname_normalizing_label, actual_vert=None, warning_vert_levels=None, fixed_label=None):
-    """Save results in the output type selected by user."""
+    """Save results in the output type selected by user.
+    fname_data is the list of metric files, and the values, stds and fractional volumes are lists with one element per
+    metric file. When several metric files are given, each result row starts with the metric file.
+    """
 
     sct.printv('\nSaving results in: '+fname_output+' ...')
 
+    nb_metrics = len(fname_data)
+    fname_data = [os.path.abspath(fname) for fname in fname_data]
+
     # define vertebral levels and slices fields
     if actual_vert:
         vertebral_levels_field = str(int(actual_vert[0])) + ' to ' + str(int(actual_vert[1]))
@@ -705,7 +743,7 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         # Write date and time
         fid_metric.write('# Date - Time: '+ time.strftime('%Y/%m/%d - %H:%M:%S'))
         # Write metric data file path
-        fid_metric.write('\n'+'# Metric file: '+ os.path.abspath(fname_data))
+        fid_metric.write('\n'+'# Metric file: '+ ', '.join(fname_data))
         # If it's the case, write the label used to normalize the metric estimation:
         if fname_normalizing_label:
             fid_metric.write('\n'+'# Label used to normalize the metric estimation slice-by-slice: '+fname_normalizing_label)
@@ -719,28 +757,36 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         fid_metric.write('\n'+'# Slices (z): '+slices_of_interest_field)
 
         # label headers
-        fid_metric.write('%s' % ('\n'+'# ID, label name, total fractional volume of the label (in number of voxels), metric value, metric stdev within label\n\n'))
+        if nb_metrics > 1:
+            fid_metric.write('%s' % ('\n'+'# Metric file, ID, label name, total fractional volume of the label (in number of voxels), metric value, metric stdev within label\n\n'))
+        else:
+            fid_metric.write('%s' % ('\n'+'# ID, label name, total fractional volume of the label (in number of voxels), metric value, metric stdev within label\n\n'))
 
         # WRITE RESULTS
         labels_id_user.sort()
-        section = ''
-        if labels_id_user[0] <= max(indiv_labels_ids):
-            section = '\n# White matter atlas\n'
-        elif labels_id_user[0] > max(indiv_labels_ids):
-            section = '\n# Combined labels\n'
-            fid_metric.write(section)
-        for i_label_user in labels_id_user:
-            # change section if not individual label anymore
-            if i_label_user > max(indiv_labels_ids) and section == '\n# White matter atlas\n':
+        for i_metric in range(nb_metrics):
+            if nb_metrics > 1:
+                row_prefix = fname_data[i_metric] + ', '
+            else:
+                row_prefix = ''
+            section = ''
+            if labels_id_user[0] <= max(indiv_labels_ids):
+                section = '\n# White matter atlas\n'
+            elif labels_id_user[0] > max(indiv_labels_ids):
                 section = '\n# Combined labels\n'
                 fid_metric.write(section)
-            # display result for this label
-            if section == '\n# White matter atlas\n':
-                index = indiv_labels_ids.index(i_label_user)
-                fid_metric.write('%i, %s, %f, %f, %f\n' % (indiv_labels_ids[index], indiv_labels_names[index], indiv_labels_fract_vol[index], indiv_labels_value[index], indiv_labels_std[index]))
-            elif section == '\n# Combined labels\n':
-                index = combined_labels_ids.index(i_label_user)
-                fid_metric.write('%i, %s, %f, %f, %f\n' % (combined_labels_ids[index], combined_labels_names[index], combined_labels_fract_vol[index], combined_labels_value[index], combined_labels_std[index]))
+            for i_label_user in labels_id_user:
+                # change section if not individual label anymore
+                if i_label_user > max(indiv_labels_ids) and section == '\n# White matter atlas\n':
+                    section = '\n# Combined labels\n'
+                    fid_metric.write(section)
+                # display result for this label
+                if section == '\n# White matter atlas\n':
+                    index = indiv_labels_ids.index(i_label_user)
+                    fid_metric.write(row_prefix + '%i, %s, %f, %f, %f\n' % (indiv_labels_ids[index], indiv_labels_names[index], indiv_labels_fract_vol[i_metric][index], indiv_labels_value[i_metric][index], indiv_labels_std[i_metric][index]))
+                elif section == '\n# Combined labels\n':
+                    index = combined_labels_ids.index(i_label_user)
+                    fid_metric.write(row_prefix + '%i, %s, %f, %f, %f\n' % (combined_labels_ids[index], combined_labels_names[index], combined_labels_fract_vol[i_metric][index], combined_labels_value[i_metric][index], combined_labels_std[i_metric][index]))
 
         if fixed_label:
             fid_metric.write('\n*'+fixed_label[0] + ', ' + fixed_label[1] + ': ' + fixed_label[2] + ' (value fixed by user)')
@@ -790,37 +836,38 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
 
             row_index = 1
 
-        # iterate on user's labels
-        for i_label_user in labels_id_user:
-            sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
-            sh.write(row_index, 1, os.path.abspath(fname_data))
-            sh.write(row_index, 2, method)
-            sh.write(row_index, 3, vertebral_levels_field)
-            sh.write(row_index, 4, slices_of_interest_field)
-            if fname_normalizing_label:
-                sh.write(row_index, 10, fname_normalizing_label)
-
-            # display result for this label
-            if i_label_user <= max(indiv_labels_ids):
-                index = indiv_labels_ids.index(i_label_user)
-                sh.write(row_index, 5, indiv_labels_ids[index])
-                sh.write(row_index, 6, indiv_labels_names[index])
-                sh.write(row_index, 7, indiv_labels_fract_vol[index])
-                sh.write(row_index, 8, indiv_labels_value[index])
-                sh.write(row_index, 9, indiv_labels_std[index])
-            elif i_label_user > max(indiv_labels_ids):
-                index = combined_labels_ids.index(i_label_user)
-                sh.write(row_index, 5, combined_labels_ids[index])
-                sh.write(row_index, 6, combined_labels_names[index])
-                sh.write(row_index, 7, combined_labels_fract_vol[index])
-                sh.write(row_index, 8, combined_labels_value[index])
-                sh.write(row_index, 9, combined_labels_std[index])
-
-            row_index += 1
+        # iterate on metrics and user's labels
+        for i_metric in range(nb_metrics):
+            for i_label_user in labels_id_user:
+                sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
+                sh.write(row_index, 1, fname_data[i_metric])
+                sh.write(row_index, 2, method)
+                sh.write(row_index, 3, vertebral_levels_field)
+                sh.write(row_index, 4, slices_of_interest_field)
+                if fname_normalizing_label:
+                    sh.write(row_index, 10, fname_normalizing_label)
+
+                # display result for this label
+                if i_label_user <= max(indiv_labels_ids):
+                    index = indiv_labels_ids.index(i_label_user)
+                    sh.write(row_index, 5, indiv_labels_ids[index])
+                    sh.write(row_index, 6, indiv_labels_names[index])
+                    sh.write(row_index, 7, indiv_labels_fract_vol[i_metric][index])
+                    sh.write(row_index, 8, indiv_labels_value[i_metric][index])
+                    sh.write(row_index, 9, indiv_labels_std[i_metric][index])
+                elif i_label_user > max(indiv_labels_ids):
+                    index = combined_labels_ids.index(i_label_user)
+                    sh.write(row_index, 5, combined_labels_ids[index])
+                    sh.write(row_index, 6, combined_labels_names[index])
+                    sh.write(row_index, 7, combined_labels_fract_vol[i_metric][index])
+                    sh.write(row_index, 8, combined_labels_value[i_metric][index])
+                    sh.write(row_index, 9, combined_labels_std[i_metric][index])
+
+                row_index += 1
 
         if fixed_label:
             sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
-            sh.write(row_index, 1, os.path.abspath(fname_data))
+            sh.write(row_index, 1, ', '.join(fname_data))
             sh.write(row_index, 2, method)
             sh.write(row_index, 3, vertebral_levels_field)
             sh.write(row_index, 4, slices_of_interest_field)
@@ -842,7 +889,10 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         metric_extraction_results = {}
 
         metric_extraction_results['Date - Time'] = time.strftime('%Y/%m/%d - %H:%M:%S')
-        metric_extraction_results['Metric file'] = os.path.abspath(fname_data)
+        if nb_metrics > 1:
+            metric_extraction_results['Metric file'] = np.repeat(fname_data, len(labels_id_user))
+        else:
+            metric_extraction_results['Metric file'] = fname_data[0]
         metric_extraction_results['Extraction method'] = method
         metric_extraction_results['Vertebral levels'] = vertebral_levels_field
         metric_extraction_results['Slices (z)'] = slices_of_interest_field
@@ -855,23 +905,24 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         Fract_vol_field = []
         Metric_value_field = []
         Metric_std_field = []
-        # iterate on user's labels
-        for i_label_user in labels_id_user:
-            # display result for this label
-            if i_label_user <= max(indiv_labels_ids):
-                index = indiv_labels_ids.index(i_label_user)
-                ID_field.append(indiv_labels_ids[index])
-                Label_names_field.append(indiv_labels_names[index])
-                Fract_vol_field.append(indiv_labels_fract_vol[index])
-                Metric_value_field.append(indiv_labels_value[index])
-                Metric_std_field.append(indiv_labels_std[index])
-            elif i_label_user > max(indiv_labels_ids):
-                index = combined_labels_ids.index(i_label_user)
-                ID_field.append(combined_labels_ids[index])
-                Label_names_field.append(combined_labels_names[index])
-                Fract_vol_field.append(combined_labels_fract_vol[index])
-                Metric_value_field.append(combined_labels_value[index])
-                Metric_std_field.append(combined_labels_std[index])
+        # iterate on metrics and user's labels
+        for i_metric in range(nb_metrics):
+            for i_label_user in labels_id_user:
+                # display result for this label
+                if i_label_user <= max(indiv_labels_ids):
+                    index = indiv_labels_ids.index(i_label_user)
+                    ID_field.append(indiv_labels_ids[index])
+                    Label_names_field.append(indiv_labels_names[index])
+                    Fract_vol_field.append(indiv_labels_fract_vol[i_metric][index])
+                    Metric_value_field.append(indiv_labels_value[i_metric][index])
+                    Metric_std_field.append(indiv_labels_std[i_metric][index])
+                elif i_label_user > max(indiv_labels_ids):
+                    index = combined_labels_ids.index(i_label_user)
+                    ID_field.append(combined_labels_ids[index])
+                    Label_names_field.append(combined_labels_names[index])
+                    Fract_vol_field.append(combined_labels_fract_vol[i_metric][index])
+                    Metric_value_field.append(combined_labels_value[i_metric][index])
+                    Metric_std_field.append(combined_labels_std[i_metric][index])
 
         metric_extraction_results['ID'] = np.array(ID_field)
         metric_extraction_results['Label name'] = np.array(Label_names_field)
@@ -974,12 +1025,12 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
     labels2d = np.empty([nb_labels, nb_vox], dtype=float)
     for i in range(0, nb_labels):
         labels2d[i] = labels[i][ind_positive]
-    # if specified (flag -mask-weighted), define a matrix to weight voxels. If not, this matrix is set to identity.
+    # if specified (flag -mask-weighted), define the weight of each voxel. If not, all weights are set to 1.
+    # N.B. weights are applied elementwise, which is equivalent to multiplying by a diagonal weight matrix W.
     if im_weight:
         data_weight_1d = im_weight.data[ind_positive]
     else:
         data_weight_1d = np.ones(nb_vox)
-    W = np.diag(data_weight_1d)  # weight matrix
 
     # Display number of non-zero values
     sct.printv('  Number of non-null voxels: '+str(nb_vox), verbose=verbose)
@@ -1006,46 +1057,31 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         y_apriori = data[ind_positive_clustered_labels]  # [nb_vox x 1]
 
         # create matrix X to use ML and estimate beta_0
-        x_apriori = np.zeros([len(y_apriori), nb_clusters])
+        x_apriori = np.zeros([nb_clusters, len(y_apriori)])
         for i_cluster in range(nb_clusters):
-            x_apriori[:, i_cluster] = clustered_labels[i_cluster][ind_positive_clustered_labels]
+            x_apriori[i_cluster] = clustered_labels[i_cluster][ind_positive_clustered_labels]
 
-        # remove unused voxels from the weighting matrix W
+        # weight of the voxels used for the a priori
         if im_weight:
             data_weight_1d_apriori = im_weight.data[ind_positive_clustered_labels]
         else:
             data_weight_1d_apriori = np.ones(np.sum(ind_positive_clustered_labels))
-        W_apriori = np.diag(data_weight_1d_apriori)  # weight matrix
-
-        # apply the weighting matrix
-        y_apriori = np.dot(W_apriori, y_apriori)
-        x_apriori = np.dot(W_apriori, x_apriori)
 
         # estimate values using ML for each cluster
-        beta = np.dot(np.linalg.pinv(np.dot(x_apriori.T, x_apriori)), np.dot(x_apriori.T, y_apriori))  # beta = (Xt . X)-1 . Xt . y
+        xtx_apriori, xty_apriori = get_weighted_normal_equations(x_apriori, y_apriori, data_weight_1d_apriori)
+        beta = estimate_ml(xtx_apriori, xty_apriori)
         # display results
         sct.printv('  Estimated beta0 per cluster: ' + str(beta), verbose=verbose)
 
         # MAP estimations within the selected labels
         # ------------------------------------------
 
-        # perc_var_label = int(adv_param[0])^2  # variance within label, in percentage of the mean (mean is estimated using cluster-based ML)
-        var_label = int(adv_param[0]) ^ 2  # variance within label
-        var_noise = int(adv_param[1]) ^ 2  # variance of the noise (assumed Gaussian)
-
-        # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
         # construct beta0
         beta0 = np.zeros(nb_labels)
         for i_cluster in range(nb_clusters):
             beta0[np.where(np.asarray(matching_cluster_labels) == i_cluster)[0]] = beta[i_cluster]
-        # construct covariance matrix (variance between tracts). For simplicity, we set it to be the identity.
-        Rlabel = np.diag(np.ones(nb_labels))
-        A = np.linalg.pinv(np.dot(x.T, x) + np.linalg.pinv(Rlabel) * var_noise / var_label)
-        B = x.T
-        C = y - np.dot(x, beta0)
-        beta = beta0 + np.dot(A, np.dot(B, C))
+        xtx, xty = get_weighted_normal_equations(labels2d, data1d, data_weight_1d)
+        beta = estimate_map(xtx, xty, beta0, adv_param)
         for i_label in range(0, nb_labels):
             metric_mean[i_label] = beta[i_label]
             metric_std[i_label] = 0  # need to assign a value for writing output file
@@ -1055,35 +1091,132 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
 
     # Estimation with maximum likelihood
     if method == 'ml':
-        # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
-        beta = np.dot( np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y) )  # beta = (Xt . X)-1 . Xt . y
-        #beta, residuals, rank, singular_value = np.linalg.lstsq(np.dot(x.T, x), np.dot(x.T, y), rcond=-1)
-        #beta, residuals, rank, singular_value = np.linalg.lstsq(x, y)
-        #print beta, residuals, rank, singular_value
+        xtx, xty = get_weighted_normal_equations(labels2d, data1d, data_weight_1d)
+        beta = estimate_ml(xtx, xty)
         for i_label in range(0, nb_labels):
             metric_mean[i_label] = beta[i_label]
             metric_std[i_label] = 0  # need to assign a value for writing output file
 
     # Estimation with weighted average (also works for binary)
     if method == 'wa' or method == 'bin' or method == 'wath' or method == 'max':
+        sum_labels = np.sum(labels2d, axis=1)
+        for i_label in np.where(sum_labels == 0)[0]:
+            print 'WARNING: labels #' + str(i_label) + ' contains only null voxels. Mean and std are set to 0.'
+        sum_labels_nonzero = np.where(sum_labels == 0, 1, sum_labels)
+        # estimate the weighted average
+        mean = np.dot(labels2d, data1d) / sum_labels_nonzero
+        # estimate the biased weighted standard deviation
+        std = np.sqrt(np.sum(labels2d * (data1d - mean[:, np.newaxis]) ** 2, axis=1) / sum_labels_nonzero)
         for i_label in range(0, nb_labels):
-            # check if all labels are equal to zero
-            if sum(labels2d[i_label, :]) == 0:
-                print 'WARNING: labels #' + str(i_label) + ' contains only null voxels. Mean and std are set to 0.'
-                metric_mean[i_label] = 0
-                metric_std[i_label] = 0
-            else:
-                # estimate the weighted average
-                metric_mean[i_label] = sum(data1d * labels2d[i_label, :]) / sum(labels2d[i_label, :])
-                # estimate the biased weighted standard deviation
-                metric_std[i_label] = np.sqrt(
-                    sum(labels2d[i_label, :] * (data1d - metric_mean[i_label]) ** 2) / sum(labels2d[i_label, :]))
+            metric_mean[i_label] = mean[i_label]
+            metric_std[i_label] = std[i_label]
 
     return metric_mean, metric_std
 
 
+def estimate_metric_within_tract_per_slices_groups(data, labels, method, slices_groups, verbose, clustered_labels=[], matching_cluster_labels=[], adv_param=[], im_weight=None):
+    """Extract metric within labels, for several groups of slices at once.
+    The sums needed by the estimators (normal equations for ml/map, weighted moments for wa/wath/bin/max) are computed
+    once per slice in a single pass over the data, then added within each group of slices and solved for all labels.
+    :data: (nx,ny,nz) numpy array
+    :labels: nlabel tuple of (nx,ny,nz) array. Not modified.
+    :slices_groups: list of lists of slice indices. Example: [[0, 1, 2], [3, 4, 5, 6]]
+    :return: metric_mean, metric_std: (ngroups, nlabel) numpy arrays
+    """
+
+    nb_labels = len(labels)
+    nb_groups = len(slices_groups)
+    nz = data.shape[2]
+    if im_weight:
+        data_weight = im_weight.data
+    else:
+        data_weight = np.ones(data.shape)
+
+    # sums per slice
+    sct.printv('  Compute sums within labels slice by slice...', verbose)
+    if method == 'ml' or method == 'map':
+        xtx_slices = np.zeros([nz, nb_labels, nb_labels])
+        xty_slices = np.zeros([nz, nb_labels])
+        if method == 'map':
+            nb_clusters = len(clustered_labels)
+            xtx_apriori_slices = np.zeros([nz, nb_clusters, nb_clusters])
+            xty_apriori_slices = np.zeros([nz, nb_clusters])
+    else:
+        sum_labels_slices = np.zeros([nz, nb_labels])
+        sum_data_slices = np.zeros([nz, nb_labels])
+        sum_data2_slices = np.zeros([nz, nb_labels])
+    for iz in sorted(set([iz for group in slices_groups for iz in group])):
+        labels_slice = np.array([labels[i_label][..., iz] for i_label in range(nb_labels)], dtype=float)
+        if method == 'bin':
+            labels_slice = (labels_slice >= 0.5).astype(float)
+        elif method == 'wath':
+            labels_slice[labels_slice < 0.5] = 0
+        ind_positive = np.sum(labels_slice, axis=0) > ALMOST_ZERO
+        labels2d = labels_slice[:, ind_positive]
+        data1d = data[..., iz][ind_positive]
+        if method == 'ml' or method == 'map':
+            xtx_slices[iz], xty_slices[iz] = get_weighted_normal_equations(labels2d, data1d, data_weight[..., iz][ind_positive])
+            if method == 'map':
+                clustered_slice = np.array([clustered_labels[i_cluster][..., iz] for i_cluster in range(nb_clusters)], dtype=float)
+                ind_positive_clustered = np.sum(clustered_slice, axis=0) > ALMOST_ZERO
+                xtx_apriori_slices[iz], xty_apriori_slices[iz] = get_weighted_normal_equations(clustered_slice[:, ind_positive_clustered], data[..., iz][ind_positive_clustered], data_weight[..., iz][ind_positive_clustered])
+        else:
+            sum_labels_slices[iz] = np.sum(labels2d, axis=1)
+            sum_data_slices[iz] = np.dot(labels2d, data1d)
+            sum_data2_slices[iz] = np.dot(labels2d, data1d ** 2)
+
+    # estimation within each group of slices
+    metric_mean = np.zeros([nb_groups, nb_labels])
+    metric_std = np.zeros([nb_groups, nb_labels])
+    for i_group, group in enumerate(slices_groups):
+        if method == 'ml':
+            metric_mean[i_group] = estimate_ml(np.sum(xtx_slices[group], axis=0), np.sum(xty_slices[group], axis=0))
+        elif method == 'map':
+            beta = estimate_ml(np.sum(xtx_apriori_slices[group], axis=0), np.sum(xty_apriori_slices[group], axis=0))
+            beta0 = np.zeros(nb_labels)
+            for i_cluster in range(nb_clusters):
+                beta0[np.where(np.asarray(matching_cluster_labels) == i_cluster)[0]] = beta[i_cluster]
+            metric_mean[i_group] = estimate_map(np.sum(xtx_slices[group], axis=0), np.sum(xty_slices[group], axis=0), beta0, adv_param)
+        else:
+            sum_labels = np.sum(sum_labels_slices[group], axis=0)
+            sum_labels_nonzero = np.where(sum_labels == 0, 1, sum_labels)
+            metric_mean[i_group] = np.sum(sum_data_slices[group], axis=0) / sum_labels_nonzero
+            variance = np.sum(sum_data2_slices[group], axis=0) / sum_labels_nonzero - metric_mean[i_group] ** 2
+            metric_std[i_group] = np.sqrt(np.maximum(variance, 0))
+
+    return metric_mean, metric_std
+
+
+def get_weighted_normal_equations(x, y, weight):
+    """Normal equations of the weighted least squares problem: y = x.T * beta, where each voxel is weighted.
+    Equivalent to X^T.W^T.W.X and X^T.W^T.W.y with W = diag(weight), without building the (nb_vox x nb_vox) matrix W.
+    :x: (nb_labels, nb_vox) numpy array
+    :y: (nb_vox) numpy array
+    :weight: (nb_vox) numpy array
+    :return: xtx (nb_labels, nb_labels), xty (nb_labels)
+    """
+    x_weighted = x * weight ** 2
+    return np.dot(x_weighted, x.T), np.dot(x_weighted, y)
+
+
+def estimate_ml(xtx, xty):
+    """Maximum likelihood estimation from the normal equations: beta = (Xt . X)-1 . Xt . y"""
+    return np.dot(np.linalg.pinv(xtx), xty)
+
+
+def estimate_map(xtx, xty, beta0, adv_param):
+    """Maximum a posteriori estimation from the normal equations, given the a priori beta0."""
+    # perc_var_label = int(adv_param[0])^2  # variance within label, in percentage of the mean (mean is estimated using cluster-based ML)
+    var_label = int(adv_param[0]) ^ 2  # variance within label
+    var_noise = int(adv_param[1]) ^ 2  # variance of the noise (assumed Gaussian)
+    # construct covariance matrix (variance between tracts). For simplicity, we set it to be the identity.
+    Rlabel = np.diag(np.ones(len(beta0)))
+    A = np.linalg.pinv(xtx + np.linalg.pinv(Rlabel) * var_noise / var_label)
+    # Xt . (y - X . beta0)
+    C = xty - np.dot(xtx, beta0)
+    return beta0 + np.dot(A, C)
+
+
 def get_clustered_labels(clusters_all_labels, labels, indiv_labels_ids, labels_user, averaging_flag, verbose):
     """
     Cluster labels according to selected options (labels and averaging).
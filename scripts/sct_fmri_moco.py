@@ -47,6 +47,8 @@ class Param:
         self.interp = 'spline'  # nn, linear, spline
         self.min_norm = 0.001
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.nb_iterative_averaging = 10  # number of first volumes averaged into the target (registered sequentially)
+        self.cpu_number = 1  # number of volumes registered in parallel
 
 
 #=======================================================================================================================
@@ -329,6 +331,12 @@ def get_parser():
                       mandatory=False,
                       default_value='linear',
                       example=['nn', 'linear', 'spline'])
+    parser.add_option(name='-cpu-nb',
+                      type_value='int',
+                      description='Number of volumes registered in parallel.',
+                      mandatory=False,
+                      default_value=param_default.cpu_number,
+                      example='4')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -364,6 +372,7 @@ if __name__ == "__main__":
     if '-param' in arguments:
         param_user = arguments['-param']
     param.interp = arguments['-x']
+    param.cpu_number = arguments['-cpu-nb']
     param.remove_tmp_files = arguments['-r']
     param.verbose = arguments['-v']
 
@@ -564,57 +564,77 @@ def normalize_array_histogram(array):
     return array
 
 
-def get_minimum_path(data, smooth_factor=np.sqrt(2), invert=1, verbose=1, debug=0):
+def get_minimum_path(data, smooth_factor=np.sqrt(2), invert=1, verbose=1, debug=0, dtype=np.float32, keep_costs=True):
     """
     This method returns the minimal path of the image
+    The cumulative costs are computed slice by slice along z in both directions, using preallocated buffers: the input
+    data are read one slice at a time (they can be memory-mapped) and no temporary volume is created.
     :param data: input data of the image
     :param smooth_factor:factor used to smooth the directions that are not up-down
     :param invert: inverts the image data for the algorithm. The algorithm works better if the image data is inverted
     :param verbose:
     :param debug:
-    :return:
+    :param dtype: type of the cumulative costs and of the result
+    :param keep_costs: if False, the result is computed in place of the costs J1 and J2, which are returned as None
+    :return: result, J1, J2
     """
     [m, n, p] = data.shape
     max_value = np.amax(data)
-    if invert:
-        data=max_value-data
-    J1 = np.ones([m, n, p])*np.inf
-    J2 = np.ones([m, n, p])*np.inf
-    J1[:, :, 0] = 0
-    for row in range(1, p):
-        pJ = J1[:, :, row-1]
-        cP = np.squeeze(data[1:-2, 1:-2, row])
-        VI = np.dstack((cP*smooth_factor, cP*smooth_factor, cP, cP*smooth_factor, cP*smooth_factor))
-
-        Jq = np.dstack((pJ[0:-3, 1:-2], pJ[1:-2, 0:-3], pJ[1:-2, 1:-2], pJ[1:-2, 2:-1], pJ[2:-1, 1:-2]))
-        J1[1:-2, 1:-2, row] = np.min(Jq+VI, 2)
-        pass
-
-    J2[:, :, p-1] = 0
-    for row in range(p-2, -1, -1):
-        pJ = J2[:, :, row+1]
-        cP = np.squeeze(data[1:-2, 1:-2, row])
-        VI = np.dstack((cP*smooth_factor, cP*smooth_factor, cP, cP*smooth_factor, cP*smooth_factor))
-
-        Jq = np.dstack((pJ[0:-3, 1:-2], pJ[1:-2, 0:-3], pJ[1:-2, 1:-2], pJ[1:-2, 2:-1], pJ[2:-1, 1:-2]))
-        J2[1:-2, 1:-2, row] = np.min(Jq+VI, 2)
-        pass
-
-    result = J1+J2
+    # costs are stored with z as first axis, so that each step of the propagation works on contiguous slices
+    J1 = np.empty([p, m, n], dtype=dtype)
+    J2 = np.empty([p, m, n], dtype=dtype)
+    J1.fill(np.inf)
+    J2.fill(np.inf)
+    J1[0] = 0
+    J2[p-1] = 0
+
+    # scratch buffers for one slice
+    cP = np.empty([m-3, n-3], dtype=dtype)
+    cP_smooth = np.empty([m-3, n-3], dtype=dtype)
+    cost = np.empty([m-3, n-3], dtype=dtype)
+
+    # J1: propagation from the first slice, J2: from the last slice
+    for J, rows, step in [(J1, range(1, p), 1), (J2, range(p-2, -1, -1), -1)]:
+        for row in rows:
+            pJ = J[row-step]
+            if invert:
+                np.subtract(max_value, data[1:-2, 1:-2, row], out=cP, casting='unsafe')
+            else:
+                cP[...] = data[1:-2, 1:-2, row]
+            np.multiply(cP, smooth_factor, out=cP_smooth, casting='unsafe')
+
+            # minimum over the five neighbours of the previous slice
+            J_row = J[row, 1:-2, 1:-2]
+            np.add(pJ[1:-2, 1:-2], cP, out=J_row)
+            for pJ_neighbour in [pJ[0:-3, 1:-2], pJ[1:-2, 0:-3], pJ[1:-2, 2:-1], pJ[2:-1, 1:-2]]:
+                np.add(pJ_neighbour, cP_smooth, out=cost)
+                np.minimum(J_row, cost, out=J_row)
+
+    if keep_costs:
+        result = J1 + J2
+    else:
+        result = J1
+        result += J2
+        del J2
+        J1, J2 = None, None
+
     if invert:
         percent = np.percentile(result, 50)
-        result[result > percent] = percent
+        np.minimum(result, percent, out=result)
 
         result_min = np.amin(result)
         result_max = np.amax(result)
-        result = np.divide(np.subtract(result, result_min), result_max)
-        result_max = np.amax(result)
+        result -= result_min
+        result /= result_max
 
-    result = 1-result
+    np.subtract(1, result, out=result)
 
     result[result == np.inf] = 0
     result[result == np.nan] = 0
 
+    result = result.transpose(1, 2, 0)
+    if keep_costs:
+        J1, J2 = J1.transpose(1, 2, 0), J2.transpose(1, 2, 0)
     return result, J1, J2
 
 
@@ -623,11 +643,36 @@ def get_minimum_path_nii(fname):
     data=Image(fname)
     vesselness_data = data.data
     raw_orient=data.change_orientation()
-    result ,J1, J2 = get_minimum_path(data.data, invert=1)
+    result, J1, J2 = get_minimum_path(data.data, invert=1, keep_costs=False)
     data.data = result
     data.change_orientation(raw_orient)
     data.file_name += '_minimalpath'
     data.save()
+    return data.absolutepath
+
+
+def get_minimum_path_batch(list_fname, cpu_number=1):
+    """
+    Compute the minimal path of several images (e.g., vesselness of several subjects) with a pool of processes.
+    Each result is saved next to its input, with suffix _minimalpath.
+    :param list_fname: list of file names
+    :param cpu_number: number of processes. 0 or 1: no multiprocessing.
+    :return: list of output file names
+    """
+    if cpu_number > 1:
+        from multiprocessing import Pool
+        pool = Pool(processes=cpu_number)
+        try:
+            list_fname_out = pool.map(get_minimum_path_nii, list_fname)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        list_fname_out = [get_minimum_path_nii(fname) for fname in list_fname]
+    return list_fname_out
 
 
 def ind2sub(array_shape, ind):
@@ -942,13 +987,15 @@ class SCAD(Algorithm):
         # load vesselness filter data and perform minimum path on it
         img = Image(vesselness_file_name)
         img.change_orientation()
-        self.minimum_path_data, self.J1_min_path, self.J2_min_path = get_minimum_path(img.data, invert=1, debug=1)
+        # costs J1 and J2 are only kept to be written as debug files
+        self.minimum_path_data, self.J1_min_path, self.J2_min_path = get_minimum_path(img.data, invert=1, debug=1, keep_costs=self.verbose == 2)
         self.output_debug_file(img, self.minimum_path_data, 'minimal_path')
         self.output_debug_file(img, self.J1_min_path, 'J1_minimal_path')
         self.output_debug_file(img, self.J2_min_path, 'J2_minimal_path')
 
         # Apply an exponent to the minimum path
-        self.minimum_path_powered = np.power(self.minimum_path_data, self.minimum_path_exponent)
+        # in double precision: high exponents would underflow in single precision
+        self.minimum_path_powered = np.power(self.minimum_path_data, self.minimum_path_exponent, dtype=np.float64)
         self.output_debug_file(img, self.minimum_path_powered, 'minimal_path_power_'+str(self.minimum_path_exponent))
 
         # Saving in Image since smooth_minimal_path needs pixel dimensions
@@ -11,7 +11,7 @@
 #########################################################################################
 
 import sys, os
-from numpy import concatenate, shape, newaxis
+from numpy import shape, newaxis, cumsum
 from msct_parser import Parser
 from msct_image import Image, get_dimension
 from sct_utils import printv, add_suffix, extract_fname, run, tmp_create
@@ -306,23 +306,20 @@ def split_data(im_in, dim):
     Split data
     :param im_in: input image.
     :param dim: dimension: 0, 1, 2, 3.
-    :return: list of split images
+    :return: list of split images. The data of the split images are views of the data of im_in (no copy): modifying
+    them in place modifies im_in. Each split image has its own copy of the header.
     """
-    from numpy import array_split
     dim_list = ['x', 'y', 'z', 't']
-    # Parse file name
-    # Open first file.
     data = im_in.data
     if dim+1 > len(shape(data)):  # in case input volume is 3d and dim=t
         data = data[..., newaxis]
-    # Split data into list
-    data_split = array_split(data, data.shape[dim], dim)
-    # Write each file
+    # Split data into a list of views, keeping the split dimension (of size 1)
+    index = [slice(None)] * len(data.shape)
     im_out_list = []
-    for i, dat in enumerate(data_split):
-        im_out = im_in.copy()
-        im_out.data = dat
-        im_out.setFileName(im_out.file_name+'_'+dim_list[dim].upper()+str(i).zfill(4)+im_out.ext)
+    for i in range(data.shape[dim]):
+        index[dim] = slice(i, i+1)
+        im_out = image_like(im_in, data[tuple(index)])
+        im_out.setFileName(im_in.file_name+'_'+dim_list[dim].upper()+str(i).zfill(4)+im_in.ext)
         im_out_list.append(im_out)
 
     return im_out_list
@@ -331,61 +328,62 @@ def split_data(im_in, dim):
 def concat_data(fname_in_list, dim):
     """
     Concatenate data
-    :param im_in_list: list of images.
+    :param fname_in_list: list of images: Image objects, or file names. Files are loaded one at a time.
     :param dim: dimension: 0, 1, 2, 3.
-    :return im_out: concatenated image
+    :return im_out: concatenated image, with the header of the first image
     """
-    # WARNING: calling concat_data in python instead of in command line causes a non understood issue (results are different with both options)
-    from numpy import concatenate, expand_dims, squeeze
-
-    dat_list = []
-    data_concat_list = []
+    from numpy import empty, result_type, can_cast
+    from nibabel import load
 
+    # get the shape of the images without loading the data of the files (only their header is read)
+    list_shape = [im.data.shape if isinstance(im, Image) else load(im).shape for im in fname_in_list]
     # check if shape of first image is smaller than asked dim to concatenate along
-    data0 = Image(fname_in_list[0]).data
-    if len(data0.shape) <= dim:
-        expand_dim = True
-    else:
-        expand_dim = False
-
-    for i, fname in enumerate(fname_in_list):
-        # if there is more than 100 images to concatenate, then it does it iteratively to avoid memory issue.
-        if i != 0 and i % 100 == 0:
-            data_concat_list.append(concatenate(dat_list, axis=dim))
-            im = Image(fname)
-            dat = im.data
-            if expand_dim:
-                dat = expand_dims(dat, dim)
-            dat_list = [dat]
-            del im
-            del dat
-        else:
-            im = Image(fname)
-            dat = im.data
-            if expand_dim:
-                dat = expand_dims(dat, dim)
-            dat_list.append(dat)
-            del im
-            del dat
-    if data_concat_list:
-        data_concat_list.append(concatenate(dat_list, axis=dim))
-        data_concat = concatenate(data_concat_list, axis=dim)
-    else:
-        data_concat = concatenate(dat_list, axis=dim)
-    # write file
-    im_out = Image(fname_in_list[0]).copy()
-    im_out.data = data_concat
-    im_out.setFileName(im_out.file_name+'_concat'+im_out.ext)
+    expand_dim = len(list_shape[0]) <= dim
+    if expand_dim:
+        list_shape = [tuple(s[:dim]) + (1,) * (dim - len(s)) + (1,) + tuple(s[dim:]) for s in list_shape]
+    list_end = list(cumsum([s[dim] for s in list_shape]))
+    shape_out = list(list_shape[0])
+    shape_out[dim] = list_end[-1]
+
+    data_concat = None
+    index = [slice(None)] * len(shape_out)
+    for i, im in enumerate(fname_in_list):
+        if not isinstance(im, Image):
+            im = Image(im)
+        if i == 0:
+            im0 = im
+        dat = im.data.reshape(list_shape[i])
+        # preallocate the output with the type of the first image, and upcast it if a next image needs it
+        if data_concat is None:
+            data_concat = empty(shape_out, dtype=dat.dtype)
+        elif not can_cast(dat.dtype, data_concat.dtype):
+            data_concat = data_concat.astype(result_type(data_concat, dat))
+        index[dim] = slice(list_end[i] - list_shape[i][dim], list_end[i])
+        data_concat[tuple(index)] = dat
+        del im, dat
+
+    im_out = image_like(im0, data_concat)
+    im_out.setFileName(im0.file_name+'_concat'+im0.ext)
 
     return im_out
 
 
+def image_like(im_ref, data):
+    """
+    Create an image with the header, orientation, file name and dimension of im_ref and the given data, without
+    copying the data of im_ref (unlike im_ref.copy()).
+    """
+    from copy import deepcopy
+    return Image(data, hdr=deepcopy(im_ref.hdr), orientation=im_ref.orientation, absolutepath=im_ref.absolutepath,
+                 dim=deepcopy(im_ref.dim))
+
+
 def concat_warp2d(fname_list, fname_warp3d, fname_dest):
     """
     Concatenate 2d warping fields into a 3d warping field along z dimension. The 3rd dimension of the resulting warping
     field will be zeroed.
     :param
-    fname_list: list of 2d warping fields (along X and Y).
+    fname_list: list of 2d warping fields (along X and Y): file names, or arrays of shape (nx, ny, 1, 1, 2).
     fname_warp3d: output name of 3d warping field
     fname_dest: 3d destination file (used to copy header information)
     :return: none
@@ -397,12 +395,15 @@ def concat_warp2d(fname_list, fname_warp3d, fname_dest):
     # get dimensions
     # nib.load(fname_list[0])
     # im_0 = Image(fname_list[0])
-    nx, ny = nib.load(fname_list[0]).shape[0:2]
+    if isinstance(fname_list[0], basestring):
+        nx, ny = nib.load(fname_list[0]).shape[0:2]
+    else:
+        nx, ny = fname_list[0].shape[0:2]
     nz = len(fname_list)
     # warp3d = tuple([nx, ny, nz, 1, 3])
     warp3d = zeros([nx, ny, nz, 1, 3])
     for iz, fname in enumerate(fname_list):
-        warp2d = nib.load(fname).get_data()
+        warp2d = nib.load(fname).get_data() if isinstance(fname, basestring) else fname
         warp3d[:, :, iz, 0, 0] = warp2d[:, :, 0, 0, 0]
         warp3d[:, :, iz, 0, 1] = warp2d[:, :, 0, 0, 1]
         del warp2d
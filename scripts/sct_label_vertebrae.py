@@ -25,7 +25,7 @@ import msct_qc
 # from glob import glob
 import numpy as np
 from sct_utils import extract_fname, printv, run, generate_output_file, slash_at_the_end, tmp_create
-from sct_maths import mutual_information
+from sct_maths import mutual_information_batch
 from msct_parser import Parser
 from msct_image import Image
 import sct_utils as sct
@@ -713,6 +713,9 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
     allzeros = 0
     # current_z = 0
     ind_I = 0
+    # subject patterns (1d) for which the mutual information is computed, and their index in I_corr
+    list_data_chunk1d = []
+    list_ind_I = []
     # loop across range of z defined by src
     for iz in zrange:
         # if pattern extends towards the top part of the image, then crop and pad with zeros
@@ -764,11 +767,15 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
             #I_corr[ind_I] = np.corrcoef(data_chunk1d, pattern1d)[0, 1]
             # data_chunk2d = np.mean(data_chunk3d, 1)
             # pattern2d = np.mean(pattern, 1)
-            I_corr[ind_I] = mutual_information(data_chunk1d, pattern1d, nbins=16)
+            list_data_chunk1d.append(data_chunk1d)
+            list_ind_I.append(ind_I)
         else:
             allzeros = 1
             # printv('.. WARNING: iz='+str(iz)+': Data only contains zero. Set correlation to 0.', verbose)
         ind_I = ind_I + 1
+    # compute mutual information for all z at once
+    if list_data_chunk1d:
+        I_corr[list_ind_I] = mutual_information_batch(np.array(list_data_chunk1d), pattern1d, nbins=16)
     # ind_y = ind_y + 1
     if allzeros:
         printv('.. WARNING: Data contained zero. We probably hit the edge of the image.', verbose)
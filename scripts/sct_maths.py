@@ -144,6 +144,15 @@ def get_parser():
                       mandatory=False,
                       example="")
 
+    parser.usage.addSection("\nPipeline")
+    parser.add_option(name='-pipe',
+                      type_value='str',
+                      description='Sequence of operations done in one pass, separated with ";" (use quotes), each written as operation:argument. '
+                        'Operations: add, sub, mul, div (number or image(s) separated with ","), thr, bin (threshold), mean, std (x, y, z or t), smooth (standard deviations in mm, as -smooth). '
+                        'Operations are done in float32, in place when possible, and images are broadcast along t (e.g., a 3d mask can multiply a 4d image).',
+                      mandatory=False,
+                      example='"thr:0.1;mul:mask.nii.gz;mean:t"')
+
     parser.usage.addSection("\nMisc")
     parser.add_option(name='-symmetrize',
                       type_value='multiple_choice',
@@ -181,7 +190,10 @@ def main(args = None):
     dim = im.dim
 
     # run command
-    if '-otsu' in arguments:
+    if '-pipe' in arguments:
+        data_out = run_pipeline(data, parse_pipeline(arguments['-pipe']), dim[4:7], verbose)
+
+    elif '-otsu' in arguments:
         param = arguments['-otsu']
         data_out = otsu(data, param)
 
@@ -206,10 +218,7 @@ def main(args = None):
         data_out = binarise(data, bin_thr=bin_thr)
 
     elif '-add' in arguments:
-        from numpy import sum
-        data2 = get_data_or_scalar(arguments["-add"], data)
-        data_concat = concatenate_along_4th_dimension(data, data2)
-        data_out = sum(data_concat, axis=3)
+        data_out = reduce_along_4th_dimension(data, arguments["-add"], np.add)
 
     elif '-sub' in arguments:
         data2 = get_data_or_scalar(arguments['-sub'], data)
@@ -227,10 +236,7 @@ def main(args = None):
         data_out = laplacian(data, sigmas)
 
     elif '-mul' in arguments:
-        from numpy import prod
-        data2 = get_data_or_scalar(arguments["-mul"], data)
-        data_concat = concatenate_along_4th_dimension(data, data2)
-        data_out = prod(data_concat, axis=3)
+        data_out = reduce_along_4th_dimension(data, arguments["-mul"], np.multiply)
 
     elif '-div' in arguments:
         from numpy import divide
@@ -306,7 +312,7 @@ def main(args = None):
 
     if data_out is not None:
         # Write output
-        nii_out = Image(fname_in)  # use header of input file
+        nii_out = im  # use header of input file
         nii_out.data = data_out
         nii_out.setFileName(fname_out)
         nii_out.save()
@@ -454,6 +460,130 @@ def get_data_or_scalar(argument, data_in):
     return data_out
 
 
+def get_list_fname(argument):
+    """
+    Parse file names separated by "," and check their existence
+    :param argument: str
+    :return: list of file names
+    """
+    parser2 = Parser(__file__)
+    parser2.add_option(name='-i', type_value=[[','], 'file'])
+    return parser2.parse(['-i', argument]).get('-i')
+
+
+def reduce_along_4th_dimension(data, argument, ufunc):
+    """
+    Add (or multiply) data with a number or with images, and add (or multiply) the result along the 4th dimension. Same
+    result as concatenating the input data with the number (or the images) along the 4th dimension and summing (or
+    multiplying) along the 4th dimension, without building the concatenated array: the images are loaded one at a time.
+    :param data: 3d or 4d array
+    :param argument: number, or file names separated by ","
+    :param ufunc: numpy.add or numpy.multiply
+    :return: 3d array
+    """
+    def reduce_data(data_in, dtype):
+        if len(data_in.shape) == 3:
+            return np.array(data_in, dtype=dtype)
+        return ufunc.reduce(data_in, axis=3, dtype=dtype)
+
+    # type of numpy.sum and numpy.prod (small integers are promoted)
+    def get_dtype(*list_dtype):
+        return ufunc.reduce(np.zeros(1, dtype=np.result_type(*list_dtype))).dtype
+
+    try:
+        value = float(argument)
+    except ValueError:
+        list_fname = get_list_fname(argument)
+        dtype_concat = data.dtype
+        dtype = get_dtype(dtype_concat)
+        data_out = reduce_data(data, dtype)
+        shape0 = None
+        for fname in list_fname:
+            data2 = Image(fname).data
+            if shape0 is None:
+                shape0 = data2.shape
+            elif data2.shape != shape0:
+                printv('\nWARNING: shape('+fname+')='+str(data2.shape)+' incompatible with shape('+list_fname[0]+')='+str(shape0), 1, 'warning')
+                printv('\nERROR: All input images must have same dimensions.', 1, 'error')
+            dtype_concat = np.result_type(dtype_concat, data2.dtype)
+            if get_dtype(dtype_concat) != dtype:
+                dtype = get_dtype(dtype_concat)
+                data_out = data_out.astype(dtype)
+            ufunc(data_out, reduce_data(data2, dtype), out=data_out)
+    else:
+        # the number is repeated along the 4th dimension as many times as the input data
+        dtype = get_dtype(data.dtype, (data.ravel()[:1] * 0 + value).dtype)
+        nt = data.shape[3] if len(data.shape) == 4 else 1
+        data_out = reduce_data(data, dtype)
+        ufunc(data_out, ufunc.reduce(np.full(nt, value, dtype=dtype)), out=data_out)
+    return data_out
+
+
+def parse_pipeline(pipeline):
+    """
+    Parse the operations of flag -pipe
+    :param pipeline: operations separated by ";", each written as operation:argument. E.g.: "thr:0.1;smooth:1;mean:t"
+    :return: list of (operation, argument)
+    """
+    list_operations = []
+    for operation in pipeline.split(';'):
+        if not operation.strip():
+            continue
+        name, sep, argument = operation.strip().partition(':')
+        if name not in ['add', 'sub', 'mul', 'div', 'thr', 'bin', 'mean', 'std', 'smooth'] or not argument:
+            printv('ERROR: wrong operation in -pipe: '+operation, 1, 'error')
+        list_operations.append((name, argument))
+    return list_operations
+
+
+def run_pipeline(data, list_operations, pixdim, verbose=1):
+    """
+    Apply a sequence of operations to data in float32. Voxelwise operations are done in place and the images used as
+    operands are loaded one at a time, so that no intermediate copy of the data is kept.
+    :param data: 3d or 4d array
+    :param list_operations: list of (operation, argument) (see parse_pipeline)
+    :param pixdim: voxel size along x, y and z (mm), used to convert the standard deviations of smooth
+    :return: float32 array
+    """
+    dim_list = ['x', 'y', 'z', 't']
+    ufuncs = {'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.divide}
+    data = np.require(data, dtype=np.float32, requirements=['W'])
+    for operation, argument in list_operations:
+        printv('  '+operation+': '+argument, verbose)
+        if operation in ufuncs:
+            try:
+                list_operand = [float(argument)]
+            except ValueError:
+                list_operand = get_list_fname(argument)
+            for operand in list_operand:
+                if not isinstance(operand, float):
+                    operand = Image(operand).data
+                    if operand.shape[:3] != data.shape[:3]:
+                        printv('ERROR: shape '+str(operand.shape)+' of operand of '+operation+' incompatible with shape '+str(data.shape), 1, 'error')
+                    if len(operand.shape) < len(data.shape):
+                        operand = operand[..., np.newaxis]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    ufuncs[operation](data, operand, out=data, casting='unsafe')
+        elif operation == 'thr':
+            data[data < float(argument)] = 0
+        elif operation == 'bin':
+            np.greater(data, float(argument), out=data)
+        elif operation in ['mean', 'std']:
+            axis = dim_list.index(argument)
+            if axis+1 > len(data.shape):  # in case data is 3d and dim=t
+                data = data[..., np.newaxis]
+            data = getattr(np, operation)(data, axis=axis, dtype=np.float64).astype(np.float32)
+        elif operation == 'smooth':
+            from scipy.ndimage.filters import gaussian_filter
+            sigmas = [float(sigma) for sigma in argument.split(',')]
+            if len(sigmas) == 1:
+                sigmas = sigmas * 3
+            # adjust sigma based on voxel size, no smoothing along t
+            sigmas = [sigmas[i] / pixdim[i] for i in range(3)] + [0] * (len(data.shape) - 3)
+            data = gaussian_filter(data, sigmas[:len(data.shape)], order=0, truncate=4.0, output=np.float32)
+    return data
+
+
 def concatenate_along_4th_dimension(data1, data2):
     """
     Concatenate two data along 4th dimension.
@@ -561,6 +691,46 @@ def mutual_information(x, y, nbins=32, normalized=False):
     # mi = adjusted_mutual_info_score(None, None, contingency=c_xy)
     return mi
 
+
+def mutual_information_batch(x, y, nbins=32):
+    """
+    Compute mutual information between each row of x and y, in one pass. Equivalent to calling mutual_information(x[i],
+    y, nbins) for each row: the joint histograms (with bins adapted to the range of each row, as in numpy.histogram2d)
+    are computed for all rows at once.
+    :param x: 2D numpy.array [n x nvox]: flatten data, one row per sample
+    :param y: 1D numpy.array [nvox]: flatten data
+    :param nbins: number of bins to compute the contingency matrices
+    :return: 1D numpy.array [n]: mutual information
+    """
+    x = np.atleast_2d(x)
+    n = x.shape[0]
+
+    def get_bin_indices(data):
+        # bins of numpy.histogram2d: nbins regular bins between min and max, the last bin including max
+        data_min, data_max = data.min(axis=1), data.max(axis=1)
+        ind_flat = data_min == data_max
+        data_min = np.where(ind_flat, data_min - 0.5, data_min)
+        data_max = np.where(ind_flat, data_max + 0.5, data_max)
+        ind_bin = np.zeros(data.shape, dtype=np.int64)
+        for i in range(data.shape[0]):
+            edges = np.linspace(data_min[i], data_max[i], nbins + 1)
+            ind_bin[i] = np.searchsorted(edges[1:-1], data[i], side='right')
+        return ind_bin
+
+    ind_x = get_bin_indices(x)
+    ind_y = get_bin_indices(y[np.newaxis, :])
+    # contingency matrices [n x nbins x nbins]
+    ind_flat = (np.arange(n)[:, np.newaxis] * nbins + ind_x) * nbins + ind_y
+    c_xy = np.bincount(ind_flat.ravel(), minlength=n * nbins * nbins).reshape(n, nbins, nbins).astype(float)
+    # mutual information from contingency matrices (same as sklearn.metrics.mutual_info_score)
+    c_sum = c_xy.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+    pi = c_xy.sum(axis=2)[:, :, np.newaxis]
+    pj = c_xy.sum(axis=1)[:, np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mi = c_xy / c_sum * (np.log(c_xy) - np.log(c_sum) - np.log(pi * pj) + 2 * np.log(c_sum))
+    mi[c_xy == 0] = 0
+    return mi.sum(axis=(1, 2))
+
 def correlation(x, y, type='pearson'):
     """
     Compute pearson or spearman correlation coeff
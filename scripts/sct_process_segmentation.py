@@ -451,7 +451,6 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
 # ==========================================================================================
 def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, figure_fit, slices, vert_levels, fname_vertebral_labeling='', algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True):
 
-    from math import degrees
     import pandas as pd
     import pickle
 
@@ -484,44 +483,8 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
 
-    # # Extract min and max index in Z direction
-    X, Y, Z = (data_seg > 0).nonzero()
-    min_z_index, max_z_index = min(Z), max(Z)
-
-    # fit centerline, smooth it and return the first derivative (in voxel space but FITTED coordinates)
-    x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('segmentation_RPI.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
-
-    # correct centerline fitted coordinates according to the data resolution
-    x_centerline_fit_rescorr, y_centerline_fit_rescorr, z_centerline_rescorr, x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr = x_centerline_fit*px, y_centerline_fit*py, z_centerline*pz, x_centerline_deriv*px, y_centerline_deriv*py, z_centerline_deriv*pz
-
     # Compute CSA
-    sct.printv('\nCompute CSA...', verbose)
-
-    # Empty arrays in which CSA for each z slice will be stored
-    csa = np.zeros(max_z_index-min_z_index+1)
-    angles = np.zeros(max_z_index - min_z_index + 1)
-
-    for iz in xrange(min_z_index, max_z_index+1):
-        if angle_correction:
-            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
-            try:
-                # normalize the tangent vector to the centerline (i.e. its derivative)
-                tangent_vect = normalize(np.array([x_centerline_deriv_rescorr[iz-min_z_index], y_centerline_deriv_rescorr[iz-min_z_index], z_centerline_deriv_rescorr[iz-min_z_index]]))
-
-            except IndexError:
-                sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
-
-            # compute the angle between the normal vector of the plane and the vector z
-            angle = np.arccos(np.vdot(tangent_vect, [0.0, 0.0, 1.0]))
-        else:
-            angle = 0.0
-
-        # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
-        number_voxels = np.sum(data_seg[:, :, iz])
-
-        # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
-        csa[iz-min_z_index] = number_voxels * px * py * np.cos(angle)
-        angles[iz - min_z_index] = degrees(angle)
+    min_z_index, max_z_index, csa, angles, z_centerline = compute_csa_per_slice(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, angle_correction=angle_correction, verbose=verbose)
 
     sct.printv('\nSmooth CSA across slices...', verbose)
     if smoothing_param:
@@ -547,18 +510,7 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
 
     # output volume of csa values
     sct.printv('\nCreate volume of CSA values...', verbose)
-    data_csa = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index+1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_csa[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i],y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_csa[i[0], i[1], iz] = csa[iz-min_z_index]
-    # replace data
-    im_seg.data = data_csa
+    im_seg.data = get_map_per_slice(data_seg, csa, min_z_index)
     # set original orientation
     # TODO: FIND ANOTHER WAY!!
     # im_seg.change_orientation(orientation) --> DOES NOT WORK!
@@ -570,18 +522,7 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
 
     # output volume of csa values
     sct.printv('\nCreate volume of angle values...', verbose)
-    data_angle = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_angle[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_angle[i[0], i[1], iz] = angles[iz - min_z_index]
-    # replace data
-    im_seg.data = data_angle
+    im_seg.data = get_map_per_slice(data_seg, angles, min_z_index)
     # set original orientation
     # TODO: FIND ANOTHER WAY!!
     # im_seg.change_orientation(orientation) --> DOES NOT WORK!
@@ -722,6 +663,89 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
         sct.printv('Output result files of the mean CSA across the selected slices: \n\t\t'+output_folder+'csa_mean.txt\n\t\t'+output_folder+'csa_mean.xls\n\t\t'+output_folder+'csa_mean.pickle', param.verbose, 'info')
         sct.printv('Output result files of the volume in between the selected slices: \n\t\t'+output_folder+'csa_volume.txt\n\t\t'+output_folder+'csa_volume.xls\n\t\t'+output_folder+'csa_volume.pickle', param.verbose, 'info')
 
+
+def compute_csa_per_slice(im_seg, algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, verbose=1):
+    """
+    Compute the cross-sectional area and the angle between the centerline and the I-S direction, for each slice of a
+    segmentation.
+    :param im_seg: Image of the segmentation, in RPI orientation
+    :return: min_z_index, max_z_index, csa (in mm^2), angles (in degrees), z_centerline
+    """
+    data_seg = im_seg.data
+    nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
+
+    # Extract min and max index in Z direction
+    Z = np.where(np.any(data_seg > 0, axis=(0, 1)))[0]
+    min_z_index, max_z_index = min(Z), max(Z)
+
+    # fit centerline, smooth it and return the first derivative (in voxel space but FITTED coordinates)
+    x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
+
+    # Compute CSA
+    sct.printv('\nCompute CSA...', verbose)
+    nb_slices = max_z_index - min_z_index + 1
+
+    if angle_correction:
+        # tangent vectors to the centerline (i.e. its derivative), corrected according to the data resolution
+        tangent_vect = np.array([np.asarray(x_centerline_deriv) * px, np.asarray(y_centerline_deriv) * py, np.asarray(z_centerline_deriv) * pz]).T
+        # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash: the last tangent vector is used for the slices without centerline
+        if len(tangent_vect) < nb_slices:
+            sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
+            tangent_vect = np.concatenate((tangent_vect, np.tile(tangent_vect[-1], (nb_slices - len(tangent_vect), 1))))
+        tangent_vect = tangent_vect[:nb_slices]
+        # normalize the tangent vectors
+        tangent_vect = tangent_vect / np.linalg.norm(tangent_vect, axis=1)[:, np.newaxis]
+        # compute the angle between the normal vector of the plane and the vector z
+        angle = np.arccos(tangent_vect[:, 2])
+    else:
+        angle = np.zeros(nb_slices)
+
+    # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
+    number_voxels = np.sum(data_seg[:, :, min_z_index:max_z_index + 1], axis=(0, 1))
+
+    # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
+    csa = number_voxels * px * py * np.cos(angle)
+    angles = np.degrees(angle)
+
+    return min_z_index, max_z_index, csa, angles, z_centerline
+
+
+def get_map_per_slice(data_seg, values, min_z_index):
+    """
+    Assign to each voxel of the segmentation the value of its slice.
+    :param data_seg: 3d array of the segmentation
+    :param values: 1d array of values per slice, starting at slice min_z_index
+    :return: 3d float32 array
+    """
+    data_map = np.array(data_seg, dtype=np.float32)
+    slab = data_map[:, :, min_z_index:min_z_index + len(values)]
+    slab[...] = np.where(slab > 0, np.asarray(values, dtype=np.float32)[np.newaxis, np.newaxis, :], slab)
+    return data_map
+
+
+def compute_csa_batch(list_fname_seg, smoothing_param=0, algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, verbose=0):
+    """
+    Compute CSA and angle per slice for several segmentations, without temporary files.
+    :param list_fname_seg: list of segmentation file names
+    :param smoothing_param: window size (in mm) for smoothing CSA along z. 0 for no smoothing.
+    :return: pandas DataFrame with one row per segmentation and slice (slice indices are in RPI orientation)
+    """
+    import pandas as pd
+    list_results = []
+    for fname_seg in list_fname_seg:
+        sct.printv('\nCompute CSA: '+fname_seg, verbose)
+        im_seg = Image(fname_seg)
+        im_seg.change_orientation('RPI')
+        min_z_index, max_z_index, csa, angles, z_centerline = compute_csa_per_slice(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, angle_correction=angle_correction, verbose=verbose)
+        if smoothing_param:
+            from msct_smooth import smoothing_window
+            csa = smoothing_window(csa, window_len=smoothing_param/im_seg.dim[6], window='hanning', verbose=0)
+        list_results.append(pd.DataFrame({'Segmentation': os.path.abspath(fname_seg),
+                                          'Slice (z)': range(min_z_index, max_z_index+1),
+                                          'CSA (mm^2)': csa,
+                                          'Angle with respect to the I-S direction (degrees)': angles}))
+    return pd.concat(list_results, ignore_index=True)[['Segmentation', 'Slice (z)', 'CSA (mm^2)', 'Angle with respect to the I-S direction (degrees)']]
+
 def label_vert(fname_seg, fname_label, verbose=1):
     """
     Label segmentation using vertebral labeling information
@@ -163,6 +163,12 @@ def get_parser(paramreg=None):
                       description="Output folder",
                       mandatory=False,
                       example='reg_results/')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="""Number of slices registered in parallel (only for slicewise registration with ANTs algorithms).""",
+                      mandatory=False,
+                      default_value=Param().cpu_number,
+                      example=['4'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -188,6 +194,7 @@ class Param:
         self.outSuffix  = "_reg"
         self.padding = 5
         self.path_qc = os.path.abspath(os.curdir)+'/qc/'
+        self.cpu_number = 1  # number of slices registered in parallel (slicewise ANTs registration)
 
 # Parameters for registration
 class Paramreg(object):
@@ -343,6 +350,7 @@ def main(args=None):
     param.padding = padding
     param.fname_mask = fname_mask
     param.remove_temp_files = remove_temp_files
+    param.cpu_number = arguments['-cpu-nb']
 
     # Get if input is 3D
     sct.printv('\nCheck if input data are 3D...', verbose)
@@ -666,6 +674,7 @@ def register(src, dest, paramreg, param, i_step_str):
                                warp_inverse_out=warp_inverse_out,
                                ants_registration_params=ants_registration_params,
                                path_qc=param.path_qc,
+                               cpu_number=param.cpu_number,
                                verbose=param.verbose)
 
     # slice-wise transfo
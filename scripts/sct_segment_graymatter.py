@@ -19,6 +19,7 @@ The model used in this function is compound of:
   - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.pklz]
   - the averaged median intensity in the white and gray matter in the model [intensities.pklz]
   - an information file indicating which parameters were used to construct this model, and te date of computation [info.txt]
+These elements are stored as numpy arrays in the folder model_arrays/ (memory-mapped when loading the model). Models in the former format (.pklz files) are converted when they are loaded for the first time.
 
 A constructed model is provided in the toolbox here: $PATH_SCT/data/gm_model.
 It's made from T2* images of 80 subjects and computed with the parameters that gives the best gray matter segmentation results.
@@ -48,7 +49,7 @@ from sct_image import set_orientation
 from msct_image import Image
 from msct_parser import *
 import sct_maths, sct_register_multimodal
-from math import exp
+from scipy.spatial.distance import cdist
 import numpy as np
 import shutil, os, sys, time
 import msct_qc
@@ -381,59 +382,62 @@ class SegmentGM:
             target_slice.set(im_m=norm_im_M)
 
     def project_target(self):
-        projected_target_slices = []
-        for target_slice in self.target_im:
-            # get slice data in the good shape
-            slice_data = target_slice.im_M.flatten()
-            slice_data = slice_data.reshape(1, -1) # data with single sample
-            # project slice data into the model
-            slice_data_projected = self.model.fitted_model.transform(slice_data)
-            projected_target_slices.append(slice_data_projected)
-        # store projected target slices
-        self.projected_target = projected_target_slices
+        # get all target slices data in the good shape: one sample per slice
+        target_data = np.array([target_slice.im_M.flatten() for target_slice in self.target_im])
+        # project all slices into the model in a single call
+        self.projected_target = self.model.fitted_model.transform(target_data)
 
     def compute_similarities(self):
-        list_dic_indexes_by_slice = []
-        for i, target_coord in enumerate(self.projected_target):
-            list_dic_similarities = []
-            for j, dic_coord in enumerate(self.model.fitted_data):
-                # compute square norm using coordinates in the model space
-                square_norm = np.linalg.norm((target_coord - dic_coord), 2)
-                # compute similarity with or without levels
-                if self.param_seg.fname_level is not None:
-                    # EQUATION WITH LEVELS
-                    similarity = exp(-self.param_seg.weight_level * abs(self.target_im[i].level - self.model.slices[j].level)) * exp(-self.param_seg.weight_coord * square_norm)
-                else:
-                    # EQUATION WITHOUT LEVELS
-                    similarity = exp(-self.param_seg.weight_coord * square_norm)
-                # add similarity to list
-                list_dic_similarities.append(similarity)
-            list_norm_similarities =  [float(s)/sum(list_dic_similarities) for s in list_dic_similarities]
-            # select indexes of most similar slices
-            list_dic_indexes = []
-            for j, norm_sim in enumerate(list_norm_similarities):
-                if norm_sim >= self.param_seg.thr_similarity:
-                    list_dic_indexes.append(j)
-            # save list of indexes into list by slice
-            list_dic_indexes_by_slice.append(list_dic_indexes)
-
-        return list_dic_indexes_by_slice
+        target_coord = np.asarray(self.projected_target, dtype=np.float64).reshape(len(self.target_im), -1)
+        dic_coord = np.asarray(self.model.fitted_data, dtype=np.float64)
+        # euclidean distance between each target slice and each dictionary slice in the model space (n_target x n_dic)
+        square_norm = cdist(target_coord, dic_coord, 'euclidean')
+        # compute similarities with or without levels
+        similarities = np.exp(-self.param_seg.weight_coord * square_norm)
+        if self.param_seg.fname_level is not None:
+            # EQUATION WITH LEVELS
+            target_levels = np.array([target_slice.level for target_slice in self.target_im], dtype=np.float64)
+            dic_levels = np.array([dic_slice.level for dic_slice in self.model.slices], dtype=np.float64)
+            similarities *= np.exp(-self.param_seg.weight_level * np.abs(target_levels[:, np.newaxis] - dic_levels[np.newaxis, :]))
+        # normalize similarities by target slice
+        norm_similarities = similarities / similarities.sum(axis=1)[:, np.newaxis]
+        # select indexes of most similar slices
+        selected = norm_similarities >= self.param_seg.thr_similarity
+
+        return [list(np.flatnonzero(selected_slice)) for selected_slice in selected]
 
     def label_fusion(self, list_dic_indexes_by_slice):
-        for target_slice in self.target_im:
-            # get list of slices corresponding to the indexes
-            list_dic_slices = [self.model.slices[j] for j in list_dic_indexes_by_slice[target_slice.id]]
-            # average slices GM and WM
-            data_mean_gm, data_mean_wm = average_gm_wm(list_dic_slices)
-            if self.param_seg.type_seg == 'bin':
-                # binarize GM seg
-                data_mean_gm[data_mean_gm >= 0.5] = 1
-                data_mean_gm[data_mean_gm < 0.5] = 0
-                # binarize WM seg
-                data_mean_wm[data_mean_wm >= 0.5] = 1
-                data_mean_wm[data_mean_wm < 0.5] = 0
-            # store segmentation into target_im
-            target_slice.set(gm_seg_m=data_mean_gm, wm_seg_m=data_mean_wm)
+        # stack dictionary segmentations: sum over the manual segmentations of each slice (n_dic x n_pixels)
+        shape_seg = self.target_im[0].im_M.shape
+        n_dic = len(self.model.slices)
+        dic_gm = np.zeros((n_dic, np.prod(shape_seg)))
+        dic_wm = np.zeros((n_dic, np.prod(shape_seg)))
+        dic_nb_gm = np.zeros(n_dic)
+        dic_nb_wm = np.zeros(n_dic)
+        for j, dic_slice in enumerate(self.model.slices):
+            gm_seg = np.asarray(dic_slice.gm_seg_M, dtype=np.float64).reshape(-1, dic_gm.shape[1])
+            wm_seg = np.asarray(dic_slice.wm_seg_M, dtype=np.float64).reshape(-1, dic_wm.shape[1])
+            dic_gm[j] = gm_seg.sum(axis=0)
+            dic_wm[j] = wm_seg.sum(axis=0)
+            dic_nb_gm[j] = gm_seg.shape[0]
+            dic_nb_wm[j] = wm_seg.shape[0]
+        # selection matrix of the dictionary slices used for each target slice (n_target x n_dic)
+        selection = np.zeros((len(self.target_im), n_dic))
+        for i, target_slice in enumerate(self.target_im):
+            selection[i, list_dic_indexes_by_slice[target_slice.id]] = 1
+        # average selected slices GM and WM for all target slices at once
+        data_mean_gm = selection.dot(dic_gm) / selection.dot(dic_nb_gm)[:, np.newaxis]
+        data_mean_wm = selection.dot(dic_wm) / selection.dot(dic_nb_wm)[:, np.newaxis]
+        if self.param_seg.type_seg == 'bin':
+            # binarize GM seg
+            data_mean_gm[data_mean_gm >= 0.5] = 1
+            data_mean_gm[data_mean_gm < 0.5] = 0
+            # binarize WM seg
+            data_mean_wm[data_mean_wm >= 0.5] = 1
+            data_mean_wm[data_mean_wm < 0.5] = 0
+        # store segmentation into target_im
+        for i, target_slice in enumerate(self.target_im):
+            target_slice.set(gm_seg_m=data_mean_gm[i].reshape(shape_seg), wm_seg_m=data_mean_wm[i].reshape(shape_seg))
 
     def warp_back_seg(self, path_warp):
         # get 3D images from list of slices
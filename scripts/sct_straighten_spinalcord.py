@@ -27,9 +27,108 @@ from math import sqrt
 import numpy as np
 
 
+class CenterlineCache(object):
+    """
+    Persistent cache of the results of smooth_centerline, shared by all SCT tools (and by successive calls within a
+    batch). Entries are keyed by a hash of the voxel data, of the image geometry and of the fitting parameters, and
+    stored as one uncompressed .npz file per centerline. When the cache exceeds max_bytes, the least recently used
+    entries are removed (the modification time of a file is updated each time it is read).
+    The cache directory is given by the environment variable SCT_CENTERLINE_CACHE (default: ~/.cache/sct/centerline).
+    Set SCT_CENTERLINE_CACHE=0 to disable the cache.
+    """
+    version = 1  # increment when the fitting algorithms change, to invalidate previous entries
+    names = ['x_centerline_fit', 'y_centerline_fit', 'z_centerline_fit',
+             'x_centerline_deriv', 'y_centerline_deriv', 'z_centerline_deriv']
+
+    def __init__(self, max_bytes=200 * 1024 ** 2):
+        self.max_bytes = max_bytes
+
+    @property
+    def folder(self):
+        folder = os.environ.get('SCT_CENTERLINE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sct', 'centerline'))
+        if folder == '0':
+            return None
+        return folder
+
+    def key(self, image, *params):
+        """
+        :param image: Image of the centerline/segmentation
+        :param params: fitting parameters
+        :return: key of the centerline, or None if the cache is disabled
+        """
+        import hashlib
+        if self.folder is None:
+            return None
+        h = hashlib.sha1()
+        data = np.ascontiguousarray(image.data)
+        h.update(str((self.version, data.shape, data.dtype.str, tuple(image.dim), params)))
+        h.update(np.asarray(image.hdr.get_sform(), dtype=np.float64).tobytes())
+        h.update(data.tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        :param key: key returned by CenterlineCache.key
+        :return: tuple of the six arrays returned by smooth_centerline, or None if the centerline is not in the cache
+        """
+        if key is None or self.folder is None:
+            return None
+        fname = os.path.join(self.folder, key + '.npz')
+        try:
+            with np.load(fname) as npz:
+                centerline = tuple(npz[name] for name in self.names)
+            os.utime(fname, None)  # most recently used
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return centerline
+
+    def put(self, key, centerline):
+        if key is None or self.folder is None:
+            return
+        folder = self.folder
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # write then rename, so that concurrent processes never read a partial file
+            fname_tmp = os.path.join(folder, key + '.' + str(os.getpid()) + '.tmp.npz')
+            np.savez(fname_tmp, **dict((name, np.asarray(value)) for name, value in zip(self.names, centerline)))
+            os.rename(fname_tmp, os.path.join(folder, key + '.npz'))
+            self.evict(folder)
+        except (IOError, OSError) as e:
+            sct.printv('WARNING: could not write centerline cache in ' + folder + ': ' + str(e), 1, 'warning')
+
+    def evict(self, folder):
+        entries = []
+        for fname in os.listdir(folder):
+            if fname.endswith('.npz') and not fname.endswith('.tmp.npz'):
+                stat = os.stat(os.path.join(folder, fname))
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        total_size = sum(size for mtime, size, fname in entries)
+        for mtime, size, fname in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(folder, fname))
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        folder = self.folder
+        if folder is not None and os.path.isdir(folder):
+            for fname in os.listdir(folder):
+                if fname.endswith('.npz'):
+                    os.remove(os.path.join(folder, fname))
+
+
+centerline_cache = CenterlineCache()
+
+
 def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='hanning', window_length=80, verbose=0, nurbs_pts_number=1000, all_slices=True, phys_coordinates=False, remove_outliers=False):
     """
     :param fname_centerline: centerline in RPI orientation, or an Image
+    Results are kept in a persistent cache (see CenterlineCache), so that fitting the same centerline with the same
+    parameters again is immediate.
     :return: x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
     """
     # window_length = param.window_length
@@ -51,6 +150,13 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
 
     nx, ny, nz, nt, px, py, pz, pt = file_image.dim
 
+    cache_key = centerline_cache.key(file_image, algo_fitting, type_window, window_length, nurbs_pts_number, all_slices,
+                                     phys_coordinates, remove_outliers)
+    centerline_fit = centerline_cache.get(cache_key)
+    if centerline_fit is not None:
+        sct.printv('.. Smoothed centerline found in cache', verbose)
+        return centerline_fit
+
     # open centerline
     data = file_image.data
 
@@ -160,8 +266,123 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
     else:
         sct.printv("ERROR: wrong algorithm for fitting", 1, "error")
 
-    return x_centerline_fit, y_centerline_fit, z_centerline_fit, \
-            x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
+    centerline_fit = x_centerline_fit, y_centerline_fit, z_centerline_fit, \
+        x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
+    centerline_cache.put(cache_key, centerline_fit)
+    return centerline_fit
+
+
+# Data shared with the processes that compute the warping fields. They are set before the pool of processes is created,
+# so that the processes inherit them when they are forked, instead of having them pickled for each chunk of slices.
+warp_context = {}
+
+
+def compute_warp_chunk(direction, z_start, z_stop):
+    """
+    Compute the displacements of a chunk of slices [z_start, z_stop[ of a warping field, all slices at once.
+    The data needed (image transformation, centerlines, look-up tables) are read from warp_context.
+    :param direction: 'curved2straight' or 'straight2curved'
+    :return: z_start, z_stop, warping field of the chunk. float32 array of shape (nx, ny, z_stop-z_start, 3)
+    """
+    context = warp_context[direction]
+    nx, ny = context['shape']
+    centerline_space, centerline_other, lookup = context['centerline_space'], context['centerline_other'], context['lookup']
+    threshold_distance = context['threshold_distance']
+    nz_chunk = z_stop - z_start
+
+    # physical coordinates of all voxels of the chunk, ordered as np.mgrid[0:nx, 0:ny, z_start:z_stop]
+    physical_coordinates = context['buffer_coordinates'][:, :nz_chunk, :]
+    np.add(context['coordinates_xy'][:, np.newaxis, :], np.outer(np.arange(z_start, z_stop), context['axis_z'])[np.newaxis, :, :], out=physical_coordinates)
+    physical_coordinates = physical_coordinates.reshape(-1, 3)
+
+    nearest_indexes = centerline_space.find_nearest_indexes(physical_coordinates)
+    distances = centerline_space.get_distances_from_planes(physical_coordinates, nearest_indexes)
+    indexes_out_distance = np.logical_or(distances > threshold_distance, distances < -threshold_distance)
+    projected_points = centerline_space.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+    coord_in_planes = centerline_space.get_in_plans_coordinates(projected_points, nearest_indexes)
+
+    if direction == 'curved2straight':
+        coord_other = centerline_other.get_inverse_plans_coordinates(coord_in_planes, lookup[nearest_indexes])
+    else:
+        coord_other = centerline_other.points[lookup[nearest_indexes]]
+        coord_other[:, 0:2] += coord_in_planes[:, 0:2]
+        coord_other[:, 2] += distances
+
+    displacements = coord_other - physical_coordinates
+    # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
+    displacements[:, 2] = -displacements[:, 2]
+    displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+
+    warp_chunk = np.empty((nx, ny, nz_chunk, 3), dtype=np.float32)
+    np.negative(displacements.reshape(nx, ny, nz_chunk, 3), out=warp_chunk)
+    return z_start, z_stop, warp_chunk
+
+
+def compute_warp_chunk_star(args):
+    return compute_warp_chunk(*args)
+
+
+def compute_warping_field(direction, image_space, centerline_space, centerline_other, lookup, threshold_distance,
+                          data_warp, size_chunk=500000, cpu_number=1, verbose=1):
+    """
+    Fill a warping field by blocks of slices. Each block is processed with array operations on all its voxels at once,
+    and written in place in data_warp.
+    :param direction: 'curved2straight' or 'straight2curved'
+    :param image_space: Image defining the space of the warping field
+    :param centerline_space: Centerline in the space of the warping field
+    :param centerline_other: Centerline in the other space
+    :param lookup: look-up table from the points of centerline_space to the points of centerline_other
+    :param threshold_distance: voxels farther than this distance from the nearest plane are not displaced
+    :param data_warp: preallocated array of shape (nx, ny, nz, 1, 3), filled in place
+    :param size_chunk: approximate number of voxels processed at once. Controls memory usage.
+    :param cpu_number: number of processes. 0 or 1: no multiprocessing.
+    :return: data_warp
+    """
+    nx, ny, nz = data_warp.shape[:3]
+    nz_chunk = int(max(1, min(nz, size_chunk / (nx * ny))))
+    list_chunks = [(direction, z, min(z + nz_chunk, nz)) for z in range(0, nz, nz_chunk)]
+
+    # voxel to physical transformation: coordinates of the first slice, and step along z
+    m_p2f = image_space.hdr.get_sform()
+    x, y = np.mgrid[0:nx, 0:ny]
+    coordinates_xy = np.outer(x.ravel(), m_p2f[0:3, 0]) + np.outer(y.ravel(), m_p2f[0:3, 1]) + m_p2f[0:3, 3]
+    warp_context[direction] = {'shape': (nx, ny),
+                               'coordinates_xy': coordinates_xy,
+                               'axis_z': m_p2f[0:3, 2],
+                               'buffer_coordinates': np.empty((nx * ny, nz_chunk, 3)),
+                               'centerline_space': centerline_space,
+                               'centerline_other': centerline_other,
+                               'lookup': lookup,
+                               'threshold_distance': threshold_distance}
+
+    sct.printv('.. '+direction+': '+str(nz)+' slices, '+str(len(list_chunks))+' blocks of '+str(nz_chunk)+' slices', verbose)
+    timer = sct.Timer(number_of_iteration=nz)
+    timer.start()
+    if cpu_number > 1:
+        from multiprocessing import Pool
+        pool = Pool(processes=cpu_number)
+        try:
+            for z_start, z_stop, warp_chunk in pool.imap_unordered(compute_warp_chunk_star, list_chunks):
+                data_warp[:, :, z_start:z_stop, 0, :] = warp_chunk
+                if verbose:
+                    timer.add_iteration(z_stop - z_start)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for chunk in list_chunks:
+            z_start, z_stop, warp_chunk = compute_warp_chunk(*chunk)
+            data_warp[:, :, z_start:z_stop, 0, :] = warp_chunk
+            if verbose:
+                timer.add_iteration(z_stop - z_start)
+    if verbose:
+        timer.stop()
+    del warp_context[direction]
+
+    return data_warp
 
 
 class SpinalCordStraightener(object):
@@ -199,6 +420,9 @@ class SpinalCordStraightener(object):
         self.curved2straight = True
         self.straight2curved = True
 
+        self.cpu_number = 1  # number of processes used to compute the warping fields
+        self.size_chunk = 500000  # number of voxels processed at once when computing the warping fields
+
 
     def straighten(self):
         # Initialization
@@ -523,58 +747,26 @@ class SpinalCordStraightener(object):
 
             # Create volumes containing curved and straight warping fields
             time_generation_volumes = time.time()
-            data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-            data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
+            data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3), dtype=np.float32)
+            data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3), dtype=np.float32)
 
             # 5. compute transformations
             # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
             # b. determine which plane of spinal cord centreline it is included
-            #print nx * ny * nz, nx_s * ny_s * nz_s
-
+            # Slices are processed by blocks: for each voxel of a block, find the nearest centerline plane, compute its
+            # coordinates in that plane and get the corresponding point in the other space.
             if self.curved2straight:
-                for u in range(nz_s):
-                    print u+1, '/', nz_s
-                    x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, u:u+1]
-                    indexes_straight = np.array(zip(x_s.ravel(), y_s.ravel(), z_s.ravel()))
-                    physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-                    nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-                    distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    indexes_out_distance_straight = np.logical_or(distances_straight > self.threshold_distance, distances_straight < -self.threshold_distance)
-                    projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight, nearest_indexes_straight)
-
-                    coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, lookup_straight2curved[nearest_indexes_straight])
-                    displacements_straight = coord_straight2curved - physical_coordinates_straight
-                    # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
-                    #displacements_straight[:, 0] = -displacements_straight[:, 0]
-                    displacements_straight[:, 2] = -displacements_straight[:, 2]
-                    displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :] = -displacements_straight
+                compute_warping_field('curved2straight', image_centerline_straight, centerline_straight, centerline,
+                                      lookup_straight2curved, self.threshold_distance, data_warp_curved2straight,
+                                      size_chunk=self.size_chunk, cpu_number=self.cpu_number, verbose=verbose)
 
             if self.straight2curved:
-                for u in range(nz):
-                    print u + 1, '/', nz
-                    x, y, z = np.mgrid[0:nx, 0:ny, u:u+1]
-                    indexes = np.array(zip(x.ravel(), y.ravel(), z.ravel()))
-                    physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-                    nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-                    distances_curved = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes_curved)
-                    indexes_out_distance_curved = np.logical_or(distances_curved > self.threshold_distance, distances_curved < -self.threshold_distance)
-                    projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes_curved)
-                    coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved, nearest_indexes_curved)
-
-                    coord_curved2straight = centerline_straight.points[lookup_curved2straight[nearest_indexes_curved]]
-                    coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-                    coord_curved2straight[:, 2] += distances_curved
-
-                    displacements_curved = coord_curved2straight - physical_coordinates
-                    # for some reason, displacement in Z is inverted. Probably due to left/right-hended definition of referential.
-                    #displacements_curved[:, 0] = -displacements_curved[:, 0]
-                    displacements_curved[:, 2] = -displacements_curved[:, 2]
-                    displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
+                compute_warping_field('straight2curved', image_centerline_pad, centerline, centerline_straight,
+                                      lookup_curved2straight, self.threshold_distance, data_warp_straight2curved,
+                                      size_chunk=self.size_chunk, cpu_number=self.cpu_number, verbose=verbose)
+
+            time_generation_volumes = time.time() - time_generation_volumes
+            sct.printv('Time to generate warping fields: ' + str(np.round(time_generation_volumes * 1000.0)) + ' ms', verbose)
 
             # Creation of the safe zone based on pre-calculated safe boundaries
             coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
@@ -766,6 +958,12 @@ def get_parser():
                       mandatory=False,
                       example=['0', '1', '2'],
                       default_value='1')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for computing the warping fields. 0 or 1: no multiprocessing.",
+                      mandatory=False,
+                      default_value=1,
+                      example="4")
 
     parser.add_option(name="-param",
                       type_value=[[','], 'str'],
@@ -834,8 +1032,8 @@ if __name__ == "__main__":
         sc_straight.path_output = './'
     if "-v" in arguments:
         sc_straight.verbose = int(arguments["-v"])
-    # if "-cpu-nb" in arguments:
-    #     sc_straight.cpu_number = int(arguments["-cpu-nb"])
+    if "-cpu-nb" in arguments:
+        sc_straight.cpu_number = int(arguments["-cpu-nb"])
     if '-qc' in arguments:
         sc_straight.qc = int(arguments['-qc'])
 
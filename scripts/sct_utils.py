@@ -75,25 +75,36 @@ def run_old(cmd, verbose=1):
         return status, output
 
 
+# SCT python tools that run() can call in-process, i.e. by calling their main(args) function instead of starting a new
+# shell and a new python interpreter (which reloads numpy, scipy and nibabel at each call). These tools must accept the
+# list of arguments in main() and must not rely on global variables defined under __main__.
+# Set the environment variable SCT_RUN_IN_PROCESS=0 to always use a subprocess.
+LIST_RUN_IN_PROCESS = ['sct_apply_transfo', 'sct_convert', 'sct_crop_image', 'sct_image', 'sct_maths']
+
+
 def run(cmd, verbose=1, error_exit='error', raise_exception=False):
     if verbose==2:
         printv(sys._getframe().f_back.f_code.co_name, 1, 'process')
     if verbose:
         print(bcolors.blue+cmd+bcolors.normal)
-    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output_final = ''
-    while True:
-        output = process.stdout.readline()
-        if output == '' and process.poll() is not None:
-            break
-        if output:
-            if verbose == 2:
-                print output.strip()
-            output_final += output.strip()+'\n'
-    status_output = process.returncode
-    # process.stdin.close()
-    # process.stdout.close()
-    # process.terminate()
+    module_name, args = get_module_in_process(cmd)
+    if module_name is not None:
+        status_output, output_final = run_in_process(module_name, args, verbose)
+    else:
+        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output_final = ''
+        while True:
+            output = process.stdout.readline()
+            if output == '' and process.poll() is not None:
+                break
+            if output:
+                if verbose == 2:
+                    print output.strip()
+                output_final += output.strip()+'\n'
+        status_output = process.returncode
+        # process.stdin.close()
+        # process.stdout.close()
+        # process.terminate()
 
     # need to remove the last \n character in the output -> return output_final[0:-1]
     if status_output:
@@ -108,6 +119,112 @@ def run(cmd, verbose=1, error_exit='error', raise_exception=False):
         return status_output, output_final[0:-1]
 
 
+def get_module_in_process(cmd):
+    """
+    Check if a command line can be run in-process by run().
+    :param cmd: command line. Example: 'sct_maths -i t2.nii.gz -bin 0.5 -o t2_bin.nii.gz'
+    :return: module_name, args. module_name is None if the command must be run in a subprocess.
+    """
+    import shlex
+    import threading
+    if os.environ.get('SCT_RUN_IN_PROCESS', '1') == '0':
+        return None, None
+    # redirection of stdout and change of directory are global to the process: only the main thread can use them
+    if threading.current_thread().name != 'MainThread':
+        return None, None
+    # commands that need a shell (pipes, redirections, wildcards, variables, several commands)
+    if re.search(r'[|<>;&*?$`]', cmd):
+        return None, None
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None, None
+    if not args:
+        return None, None
+    module_name = os.path.basename(args[0])
+    if module_name.endswith('.py'):
+        module_name = module_name[:-3]
+    if module_name not in LIST_RUN_IN_PROCESS:
+        return None, None
+    return module_name, args[1:]
+
+
+# True once the image cache is set to be cleared at exit (see run_in_process)
+cache_clear_registered = False
+
+
+class OutputCapture(object):
+    """
+    File-like object that stores everything written to it, and optionally forwards each line to another stream.
+    """
+    def __init__(self, stream_forward=None):
+        self.stream_forward = stream_forward
+        self.output = ''
+
+    def write(self, string):
+        self.output += string
+        if self.stream_forward is not None:
+            self.stream_forward.write(string)
+
+    def flush(self):
+        if self.stream_forward is not None:
+            self.stream_forward.flush()
+
+    def isatty(self):
+        return False
+
+
+def run_in_process(module_name, args, verbose=1):
+    """
+    Run an SCT python tool by calling its main() function within the current python interpreter. Output and status are
+    the same as those of a subprocess: the output is captured and SystemExit is converted into a status.
+    Images read and written by the tool are kept in the in-memory image cache (see msct_image.ImageCache), so that the
+    next steps of the pipeline do not need to read them from disk again. The cache is only enabled while the tool is
+    running, and it is cleared when the calling script ends.
+    :param module_name: name of the SCT tool. Example: 'sct_maths'
+    :param args: list of arguments
+    :param verbose: if 2, the output is also displayed while the tool is running
+    :return: status, output
+    """
+    import importlib
+    import traceback
+    import atexit
+    from msct_image import image_cache
+    global cache_clear_registered
+    if not cache_clear_registered:
+        # free the cache at the end of the pipeline
+        atexit.register(image_cache.clear)
+        cache_clear_registered = True
+    # images read or written by the calling script itself are not cached: the flag is restored after the run
+    cache_enabled_orig = image_cache.enabled
+    image_cache.enabled = True
+    capture = OutputCapture(sys.stdout if verbose == 2 else None)
+    stdout_orig, stderr_orig, argv_orig, path_orig = sys.stdout, sys.stderr, sys.argv, os.getcwd()
+    sys.stdout, sys.stderr, sys.argv = capture, capture, [module_name]+args
+    status = 0
+    try:
+        module = importlib.import_module(module_name)
+        module.main(args)
+    except SystemExit, e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            capture.write(str(e.code)+'\n')
+            status = 1
+    except Exception:
+        capture.write(traceback.format_exc())
+        status = 1
+    finally:
+        sys.stdout, sys.stderr, sys.argv = stdout_orig, stderr_orig, argv_orig
+        # tools may change directory (e.g., to work in a temporary folder) and exit before going back
+        os.chdir(path_orig)
+        image_cache.enabled = cache_enabled_orig
+        image_cache.prune()
+    output = ''.join([line.strip()+'\n' for line in capture.output.splitlines()])
+    return status, output
+
 
 #=======================================================================================================================
 # check RAM usage
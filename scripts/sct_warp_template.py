@@ -22,6 +22,7 @@ import time
 from msct_parser import Parser
 import sct_utils as sct
 from sct_extract_metric import read_label_file
+from sct_apply_transfo import read_transfo_list, resample_transfo_batch
 
 
 # get path of the script and the toolbox
@@ -146,13 +147,19 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
     else:
         # create output folder
         sct.run('mkdir '+path_out+folder_label, param.verbose)
-        # Warp label
-        for i in xrange(0, len(template_label_file)):
-            fname_label = path_label+folder_label+template_label_file[i]
-            # check if file exists
-            # sct.check_file_exist(fname_label)
-            # apply transfo
-            sct.run('sct_apply_transfo -i '+fname_label+' -o '+path_out+folder_label+template_label_file[i] +' -d '+fname_src+' -w '+fname_transfo+' -x '+get_interp(template_label_file[i]), param.verbose)
+        # Warp label: the warping field is read and the sampling grid is computed once for all files
+        list_transfo = read_transfo_list([fname_transfo], [''])
+        if list_transfo is not None:
+            resample_transfo_batch([path_label+folder_label+file_label_i for file_label_i in template_label_file], fname_src,
+                                   [path_out+folder_label+file_label_i for file_label_i in template_label_file], list_transfo,
+                                   [get_interp(file_label_i) for file_label_i in template_label_file], verbose=param.verbose)
+        else:
+            for i in xrange(0, len(template_label_file)):
+                fname_label = path_label+folder_label+template_label_file[i]
+                # check if file exists
+                # sct.check_file_exist(fname_label)
+                # apply transfo
+                sct.run('sct_apply_transfo -i '+fname_label+' -o '+path_out+folder_label+template_label_file[i] +' -d '+fname_src+' -w '+fname_transfo+' -x '+get_interp(template_label_file[i]), param.verbose)
         # Copy list.txt
         sct.run('cp '+path_label+folder_label+param.file_info_label+' '+path_out+folder_label, 0)
 
@@ -45,6 +45,38 @@ def test(data_path):
     status += s
     output += o
 
+    # test with a warping field followed by an affine transformation, which do not commute: the output of the python
+    # implementation must be the same as the output of isct_antsApplyTransforms, which gets the reversed list
+    file_affine = 'affine_rotation.txt'
+    open(file_affine, 'w').write('#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n'
+                                 'Parameters: 0.98 -0.17 0 0.17 0.98 0 0 0 1 2 -3 1\nFixedParameters: 0 0 0\n')
+    cmd = 'sct_apply_transfo -i ' + data_path + folder_data[0] + file_data[0] \
+          + ' -d ' + data_path + folder_data[1] + file_data[1] \
+          + ' -w ' + data_path + folder_data[1] + file_data[2] + ',' + file_affine \
+          + ' -x linear -o apply_transfo_python.nii.gz'
+    output += cmd+'\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+    cmd = 'isct_antsApplyTransforms -d 3 -i ' + data_path + folder_data[0] + file_data[0] \
+          + ' -r ' + data_path + folder_data[1] + file_data[1] \
+          + ' -t ' + file_affine + ' ' + data_path + folder_data[1] + file_data[2] \
+          + ' -n Linear -o apply_transfo_ants.nii.gz'
+    output += cmd+'\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+    if status == 0:
+        from msct_image import Image
+        from numpy import abs
+        data_python = Image('apply_transfo_python.nii.gz').data
+        data_ants = Image('apply_transfo_ants.nii.gz').data
+        diff = abs(data_python - data_ants).max()
+        output += '\nMaximum difference with isct_antsApplyTransforms: ' + str(diff)
+        if diff > 1e-3 * abs(data_ants).max():
+            status = 99
+            output += '\nERROR: the python implementation and isct_antsApplyTransforms give different results.'
+
     # return
     #return sct.run(cmd, 0)
     return status, output
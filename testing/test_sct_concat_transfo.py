@@ -24,14 +24,39 @@ def test(data_path):
                  'warp_t22mt1.nii.gz',
                  get_file_label(data_path+'template/template/', 'T2-weighted')]
 
+    output = ''
+    status = 0
+
     # define command
     cmd = 'sct_concat_transfo -w ' + data_path + folder_data[0] + file_data[0] + ',' \
           + data_path + folder_data[1] + file_data[1]\
-          + ' -d ' + data_path + folder_data[2] + file_data[2]
+          + ' -d ' + data_path + folder_data[2] + file_data[2] + ' -o warp_concat_python.nii.gz'
+    output += cmd+'\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
+    # the python implementation must give the same warping field as isct_ComposeMultiTransform, which gets the reversed
+    # list (N.B. isct_ComposeMultiTransform returns a wrong status, so only the output file is checked)
+    cmd = 'isct_ComposeMultiTransform 3 warp_concat_ants.nii.gz -R ' + data_path + folder_data[2] + file_data[2] + ' ' \
+          + data_path + folder_data[1] + file_data[1] + ' ' + data_path + folder_data[0] + file_data[0]
+    output += cmd+'\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    output += o
+    if status == 0:
+        from msct_image import Image
+        from numpy import abs
+        data_python = Image('warp_concat_python.nii.gz').data
+        data_ants = Image('warp_concat_ants.nii.gz').data
+        diff = abs(data_python - data_ants).max()
+        output += '\nMaximum difference with isct_ComposeMultiTransform: ' + str(diff)
+        if diff > 1e-3 * abs(data_ants).max():
+            status = 99
+            output += '\nERROR: the python implementation and isct_ComposeMultiTransform give different results.'
 
     # return
     #return sct.run(cmd, 0)
-    return commands.getstatusoutput(cmd)
+    return status, output
 
 
 if __name__ == "__main__":
@@ -22,6 +22,8 @@ def test(path_data='', parameters=''):
     output = ''
     status = 0
     verbose = 0
+    # the warping fields of affine transformations are only checked with the default parameters
+    check_affine = not parameters
 
     if not parameters:
         folder_data = 'mt/'
@@ -184,6 +186,11 @@ def test(path_data='', parameters=''):
             status += s
             output += o
 
+    if check_affine:
+        s, o = check_affine_to_warp2d(path_data + folder_data + file_data[1])
+        status += s
+        output += o
+
     results = DataFrame(data={'status': int(status), 'output': output, 'duration [s]': duration}, index=[path_data])
 
     return status, output, results
@@ -219,6 +226,58 @@ def check_integrity(algo='', fname_result='', fname_goldstandard=''):
         output += '\nWARNING: Difference is higher than threshold.'
     return status, output
 
+def check_affine_to_warp2d(fname_dest):
+    """
+    Compare the 2d warping fields of an affine transformation generated by msct_register.affine_to_warp2d with the
+    fields generated by isct_ComposeMultiTransform (composition with a null warping field), for the forward and inverse
+    transformations. The affine transformation is defined on the first slice of fname_dest.
+    :return: status, output
+    """
+    import nibabel as nib
+    from collections import OrderedDict
+    from numpy import abs, array, concatenate, newaxis, zeros
+    from scipy.io import savemat
+    from msct_image import Image
+    from msct_register import affine_to_warp2d
+    status = 0
+    output = '\nChecking affine_to_warp2d with isct_ComposeMultiTransform...'
+    # first slice of the image, and null 2d warping field on this slice
+    im_dest = nib.load(fname_dest)
+    affine = im_dest.get_affine()
+    nib.save(nib.Nifti1Image(im_dest.get_data()[:, :, 0:1], affine), 'affine2d_dest.nii.gz')
+    im_null = nib.Nifti1Image(zeros(im_dest.shape[:2] + (1, 1, 2)), affine)
+    im_null.header.set_intent('vector', (), '')
+    nib.save(im_null, 'affine2d_null_warp.nii.gz')
+    # rotation, shear, anisotropic scaling and translation around the center of the slice (ITK file, LPS coordinates)
+    matrix = array([[0.95, -0.2], [0.15, 1.1]])
+    translation = array([2.5, -1.5])
+    center = -(affine[:2, :2].dot(array(im_dest.shape[:2]) / 2.) + affine[:2, 3])
+    params = concatenate((matrix.flatten(), translation))
+    savemat('affine2d_0GenericAffine.mat', OrderedDict([('AffineTransform_double_2_2', params[:, newaxis]),
+                                                        ('fixed', center[:, newaxis])]), format='4')
+    im_ref = Image('affine2d_dest.nii.gz')
+    for inverse in [False, True]:
+        fname_warp_ants = 'affine2d_warp_ants_inv.nii.gz' if inverse else 'affine2d_warp_ants.nii.gz'
+        # N.B. isct_ComposeMultiTransform returns a wrong status, so only the output file is checked
+        cmd = 'isct_ComposeMultiTransform 2 ' + fname_warp_ants + ' -R affine2d_dest.nii.gz affine2d_null_warp.nii.gz ' \
+              + ('-i ' if inverse else '') + 'affine2d_0GenericAffine.mat'
+        output += '\n' + cmd + '\n'  # copy command
+        s, o = commands.getstatusoutput(cmd)
+        output += o
+        if not os.path.isfile(fname_warp_ants):
+            status = 99
+            output += '\nERROR: isct_ComposeMultiTransform did not generate ' + fname_warp_ants
+            continue
+        data_python = affine_to_warp2d('affine2d_0GenericAffine.mat', im_ref, inverse=inverse)
+        data_ants = nib.load(fname_warp_ants).get_data().reshape(data_python.shape)
+        diff = abs(data_python - data_ants).max()
+        output += '\nMaximum difference with isct_ComposeMultiTransform (inverse=' + str(inverse) + '): ' + str(diff)
+        if diff > 1e-3 * abs(data_ants).max():
+            status = 99
+            output += '\nERROR: affine_to_warp2d and isct_ComposeMultiTransform give different results.'
+    return status, output
+
+
 if __name__ == "__main__":
     # call main function
     test()
\ No newline at end of file